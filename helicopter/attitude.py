@@ -0,0 +1,101 @@
+"""
+Attitude estimation and pitch/roll stabilisation.
+
+Body axes are x forwards, y left and z up, so with the IMU mounted that way round:
+ - +ve pitch is nose down (as for SwashPlate.set_pitch, i.e. for forwards movement)
+ - +ve roll is right side down (as for SwashPlate.set_roll)
+"""
+import numpy as np
+from imu_sampler import SAMPLE_TIME, SAMPLE_ACCELERATION, SAMPLE_RATES
+
+class AttitudeEstimator:
+    """
+    Complementary filter fusing the accelerometer (gravity direction - right on average, but noisy and upset by
+    vibration) with the gyro (smooth, but drifts once integrated) into pitch & roll angles, in degrees.
+
+    Works on a whole window of IMU samples at once. For a fixed blend factor 'a', each step of the filter is
+        angle[k] = a * angle[k-1] + u[k],    where u[k] = a * rate[k] * dt[k] + (1 - a) * accel_angle[k]
+    so after n samples
+        angle[n] = a^n * angle[0] + sum(a^(n-k) * u[k])
+    which is a single dot product with a precomputed weight vector, rather than a Python loop over the samples.
+    """
+
+    # [gy, gx] columns of the IMU samples
+    _pitch_roll_rate_columns = [SAMPLE_RATES.start + 1, SAMPLE_RATES.start]
+
+    def __init__(self, sample_rate_hz:float, time_constant:float=0.5, rate_scales=(1, 1)):
+        """
+        'time_constant' (s) sets the crossover between trusting the gyro (faster changes) and the accelerometer.
+        'rate_scales' are the deg/s equivalent to a (normalised) pitch & roll rate of 1
+        """
+        sample_period = 1 / sample_rate_hz
+        self.blend = time_constant / (time_constant + sample_period)
+        self.rate_scales = np.array(rate_scales, dtype=float)
+        # The filter itself works in radians. Fold the gyro's share of the blend into the rate scaling up front
+        self._blended_rate_scales = self.blend * np.radians(self.rate_scales)
+        self._angles = None
+        # [pitch, roll] angles (deg) and rates (deg/s)
+        self.angles = None
+        self.rates = np.zeros(2)
+        self.last_sample_time = None
+        self._weights = {}
+
+    def _weights_for(self, samples:int):
+        """ (a^n, [a^(n-1), ..., a, 1]) for a window of n samples. Windows are usually the same few sizes, so cache them """
+        if samples not in self._weights:
+            self._weights[samples] = (self.blend ** samples, self.blend ** np.arange(samples - 1, -1, -1))
+        return self._weights[samples]
+
+    def update(self, samples):
+        """ Fold in a window of IMU samples (oldest first, as from ImuSampler) and return the [pitch, roll] angles """
+        if not len(samples):
+            return self.angles
+        ax, ay, az = samples[:, SAMPLE_ACCELERATION].T
+        accel_angles = np.column_stack((np.arctan2(-ax, np.hypot(ay, az)), np.arctan2(ay, az)))
+        # Pitch is about the y axis, roll about the x axis
+        rates = samples[:, self._pitch_roll_rate_columns]
+        times = samples[:, SAMPLE_TIME]
+        if self._angles is None:
+            # Start from wherever gravity says we are
+            self._angles = accel_angles[0]
+            self.last_sample_time = times[0]
+        # (np.diff with prepend does the same, but is several times slower for the small windows we normally get)
+        dts = times - np.concatenate(((self.last_sample_time,), times[:-1]))
+        inputs = rates * dts[:, np.newaxis] * self._blended_rate_scales + (1 - self.blend) * accel_angles
+        decay, weights = self._weights_for(len(samples))
+        self._angles = decay * self._angles + weights @ inputs
+        self.angles = np.degrees(self._angles)
+        self.rates = rates[-1] * self.rate_scales
+        self.last_sample_time = times[-1]
+        return self.angles
+
+
+class AttitudeController:
+    """
+    Cascaded angle -> rate controller for pitch & roll.
+    The stick demands (-1 -> +1) set a target angle, the angle error sets a target rate, and the rate error sets
+    the cyclic (swash plate pitch/roll, -1 -> +1)
+    """
+
+    def __init__(self, max_angle:float=20, angle_gain:float=3, max_rate:float=90, rate_gain:float=0.005,
+                 max_cyclic:float=0.5):
+        """
+        'max_angle' (deg) is the angle at full stick, 'angle_gain' is the target rate (deg/s) per degree of angle
+        error, up to 'max_rate', and 'rate_gain' is the cyclic per deg/s of rate error, up to 'max_cyclic'
+        """
+        self.max_angle = max_angle
+        self.angle_gain = angle_gain
+        self.max_rate = max_rate
+        self.rate_gain = rate_gain
+        self.max_cyclic = max_cyclic
+
+    def update(self, pitch_demand:float, roll_demand:float, angles, rates):
+        """ Returns the (pitch, roll) cyclic needed to bring the heli to the demanded attitude """
+        return (self._axis_cyclic(pitch_demand, angles[0], rates[0]),
+                self._axis_cyclic(roll_demand, angles[1], rates[1]))
+
+    def _axis_cyclic(self, demand, angle, rate):
+        max_rate = self.max_rate
+        target_rate = max(-max_rate, min(max_rate, self.angle_gain * (demand * self.max_angle - angle)))
+        max_cyclic = self.max_cyclic
+        return max(-max_cyclic, min(max_cyclic, self.rate_gain * (target_rate - rate)))
@@ -0,0 +1,64 @@
+"""
+Benchmarks the per-tick cost of the attitude estimator & controller against the control loop budget.
+Run with: python bench_attitude.py [loop_rate_hz] [imu_sample_rate_hz]
+"""
+import math
+import sys
+import timeit
+import numpy as np
+from attitude import AttitudeEstimator, AttitudeController
+from imu_sampler import SAMPLE_WIDTH
+
+def synthetic_samples(count, sample_rate_hz, seed=0):
+    """ A level, stationary heli with some sensor noise """
+    rng = np.random.default_rng(seed)
+    samples = np.zeros((count, SAMPLE_WIDTH))
+    samples[:, 0] = np.arange(count) / sample_rate_hz
+    samples[:, 1:] = rng.normal(0, 0.02, (count, 6))
+    samples[:, 3] += 1
+    return samples
+
+def scalar_update(estimator, samples):
+    """ The same filter, one sample at a time in plain Python, for comparison """
+    blend = estimator.blend
+    pitch, roll = estimator.angles.tolist()
+    pitch_scale, roll_scale = estimator.rate_scales.tolist()
+    last_time = estimator.last_sample_time
+    for t, ax, ay, az, gx, gy, gz in samples.tolist():
+        accel_pitch = math.degrees(math.atan2(-ax, math.hypot(ay, az)))
+        accel_roll = math.degrees(math.atan2(ay, az))
+        dt = t - last_time
+        pitch = blend * (pitch + gy * pitch_scale * dt) + (1 - blend) * accel_pitch
+        roll = blend * (roll + gx * roll_scale * dt) + (1 - blend) * accel_roll
+        last_time = t
+    return pitch, roll
+
+def per_call_us(statement, number=5000):
+    return 1e6 * min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+if __name__ == "__main__":
+    loop_rate_hz = float(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sample_rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 500
+    budget_us = 1e6 / loop_rate_hz
+    controller = AttitudeController()
+    # Typical window is however many samples arrive per loop tick. Bigger ones happen after a stall
+    typical_window = int(np.ceil(sample_rate_hz / loop_rate_hz))
+    print(f"Loop budget at {loop_rate_hz:.0f}Hz: {budget_us:.0f}us. IMU at {sample_rate_hz:.0f}Hz, so ~{typical_window} samples per tick")
+    # Both timings include the controller update
+    print(f"{'window':>8}{'vectorised (us)':>18}{'scalar (us)':>14}{'% of budget':>14}")
+    for window in sorted({1, typical_window, 10, 50, 250}):
+        estimator = AttitudeEstimator(sample_rate_hz, rate_scales=(50, 50))
+        samples = synthetic_samples(window, sample_rate_hz)
+        estimator.update(samples)
+
+        def tick():
+            angles = estimator.update(samples)
+            controller.update(0.1, -0.1, angles, estimator.rates)
+
+        def scalar_tick():
+            angles = scalar_update(estimator, samples)
+            controller.update(0.1, -0.1, angles, estimator.rates)
+
+        vectorised = per_call_us(tick)
+        scalar = per_call_us(scalar_tick, number=max(50, 5000 // window))
+        print(f"{window:>8}{vectorised:>18.1f}{scalar:>14.1f}{100 * vectorised / budget_us:>13.2f}%")
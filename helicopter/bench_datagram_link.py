@@ -0,0 +1,53 @@
+"""
+Loopback check of the datagram demand transport through the packet-drop shim.
+Sends a stream of demand frames to a DatagramDemandReceiver over 127.0.0.1, randomly dropping, reordering and
+duplicating them on the way, then checks the receiver only ever moved forwards and reports the link stats.
+
+Run with: python bench_datagram_link.py [drop_rate] [reorder_rate]
+"""
+import socket
+import sys
+import time
+from heli_protocol import DemandFrameCodec
+from datagram_link import DatagramDemandReceiver, LossyDatagramSocket
+
+def run(frames=5000, rate_hz=1000, drop_rate=0.05, reorder_rate=0.05, duplicate_rate=0.01, seed=1):
+    receiver = DatagramDemandReceiver('127.0.0.1', bind_host='127.0.0.1')
+    sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_socket.connect(('127.0.0.1', receiver.port))
+    sender = LossyDatagramSocket(sender_socket, drop_rate=drop_rate, reorder_rate=reorder_rate,
+                                 duplicate_rate=duplicate_rate, seed=seed)
+    codec = DemandFrameCodec()
+    applied = []
+    period = 1 / rate_hz
+    next_send = time.monotonic()
+    for i in range(frames):
+        # Ramp the throttle so each frame's demands can be told apart
+        sender.send(codec.encode({'throttle_demand': i / frames}))
+        demands = receiver.receive_latest()
+        if demands is not None:
+            applied.append(demands['throttle_demand'])
+        next_send += period
+        time.sleep(max(0, next_send - time.monotonic()))
+    # Send one last frame without the shim, so we know what the newest demands should be
+    sender_socket.send(codec.encode({'throttle_demand': 1}))
+    time.sleep(0.05)
+    demands = receiver.receive_latest()
+    if demands is not None:
+        applied.append(demands['throttle_demand'])
+
+    went_backwards = sum(1 for previous, current in zip(applied, applied[1:]) if current < previous)
+    print(f"Sent {frames + 1} frames at {rate_hz}Hz, shim dropped {sender.dropped}")
+    print(f"Link stats: {receiver.stats}")
+    print(f"Demand updates applied: {len(applied)}, went backwards: {went_backwards}, final throttle: {applied[-1]:.3f}")
+    receiver.close()
+    sender.close()
+    return went_backwards == 0 and applied[-1] == 1
+
+if __name__ == "__main__":
+    drop_rate = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    reorder_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    if not run(drop_rate=drop_rate, reorder_rate=reorder_rate):
+        print("FAILED: stale demands were applied")
+        sys.exit(1)
+    print("OK")
@@ -0,0 +1,209 @@
+"""
+Times what the pilot's control loop spends on the demands each tick - picking up new ones and acting on them - for:
+ - string chain: the original loop, walking every key of the demands dict through a chain of string comparisons.
+   Kept as a historical reference: it's a copy of the loop as it was, on stand-in actuators that just count the calls
+ - fly_step: a HelicopterPilot on the simulated hardware, flown a step at a time - its own demand path (the
+   'pilot_demands' stage: reading the demand slot and dispatching whatever's changed through its DemandDispatcher)
+ - dispatch only: the same pilot's dispatcher.dispatch(), handed each new demand record directly
+A 200Hz control loop is fed a 100Hz stream of demands from a made up session - mostly heartbeats and small stick
+movements. Actuator calls are those made acting on the demands (the swash plate and tail are driven from the attitude
+and yaw controllers every tick whatever the demands, so aren't counted for the pilot).
+Run from this directory with: python bench_demand_dispatch.py [ticks]
+"""
+import os
+import random
+import sys
+import time
+from array import array
+from contextlib import redirect_stdout
+os.environ['HELI_HARDWARE'] = 'sim'
+from helicopter import HelicopterConfig
+from pilot import HelicopterPilot
+from demand_slot import DEMAND_FIELDS
+from heli_protocol import DEMAND_BUTTONS, DEMAND_AXES
+from stage_timing import timings
+
+MIN_THROTTLE = 0.3
+
+
+class CountingHeli:
+    """ Stands in for the Helicopter, counting what's asked of it """
+
+    def __init__(self):
+        self.calls = 0
+
+    def stop(self):
+        self.calls += 1
+
+    def set_motor_speed(self, speed):
+        self.calls += 1
+
+    def set_attitude(self, collective, pitch, roll):
+        self.calls += 1
+
+    def set_yaw(self, amount):
+        self.calls += 1
+
+
+def session(ticks, seed=0):
+    """ Demands for each tick: a new dict every other tick (100Hz), None in between """
+    rng = random.Random(seed)
+    demands = {button: False for button in DEMAND_BUTTONS}
+    demands.update({axis: 0.0 for axis in DEMAND_AXES})
+    demands.update(start_demand=True, battery_connected=True, throttle_demand=0.5)
+    frames = []
+    for tick in range(ticks):
+        if tick % 2:
+            frames.append(None)
+            continue
+        demands = dict(demands)
+        # Sticks moving about a third of the time, one or two axes at once. Otherwise it's a heartbeat
+        if rng.random() < 0.3:
+            for axis in rng.sample(DEMAND_AXES, rng.choice((1, 2))):
+                demands[axis] = max(-1, min(1, demands[axis] + rng.uniform(-0.05, 0.05)))
+        if rng.random() < 0.002:
+            demands['request_gyro_state_demand'] = not demands['request_gyro_state_demand']
+        frames.append(demands)
+    return frames
+
+
+class StringChain:
+    """ The original loop (as it was before the demand slot and dispatcher) """
+
+    def __init__(self, heli):
+        self.heli = heli
+        self.flying = True
+        self.demands = {}
+        self.shown = 0
+
+    def update_demands(self, demands):
+        self.demands = demands
+
+    def tick(self):
+        heli = self.heli
+        for demand in self.demands:
+            demand_value = self.demands[demand]
+            if demand == 'stop_demand':
+                if demand_value:
+                    heli.stop()
+                    self.flying = False
+            if demand == 'start_demand':
+                pass
+            if demand == 'throttle_demand':
+                throttle_demand = max(MIN_THROTTLE, abs(demand_value))
+                if self.flying:
+                    heli.set_motor_speed(throttle_demand)
+                    heli.set_attitude(demand_value, 0, 0)
+            if demand == 'yaw_demand':
+                heli.set_yaw(demand_value)
+            if demand == 'pitch_demand':
+                pass
+            if demand == 'roll_demand':
+                pass
+            if demand == 'request_gyro_state_demand':
+                if demand_value:
+                    self.shown += 1
+
+
+def timing_overhead():
+    """ What timing nothing costs (s), to take off """
+    clock = time.perf_counter
+    return min(-clock() + clock() for _ in range(1000))
+
+
+def count_calls(heli, *names):
+    """ Have 'heli' count the calls made to its 'names' methods. Returns the count, as a one item list """
+    calls = [0]
+    for name in names:
+        method = getattr(heli, name)
+
+        def counted(*args, method=method):
+            calls[0] += 1
+            return method(*args)
+        setattr(heli, name, counted)
+    return calls
+
+
+def run_string_chain(frames):
+    """ Returns (mean time per tick (s), actuator calls per tick) """
+    heli = CountingHeli()
+    loop = StringChain(heli)
+    clock = time.perf_counter
+    overhead = timing_overhead()
+    total = 0
+    for demands in frames:
+        if demands is not None:
+            # (From the server thread - not part of the tick)
+            loop.update_demands(demands)
+        started = clock()
+        loop.tick()
+        total += clock() - started - overhead
+    return total / len(frames), heli.calls / len(frames)
+
+
+def make_pilot():
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.logging = {'level': 'warning'}
+    pilot = HelicopterPilot(config, start=False)
+    # The calls the demand handlers make
+    calls = count_calls(pilot.heli, 'stop', 'set_motor_speed')
+    return pilot, calls
+
+
+def run_fly_step(frames):
+    """ Returns (mean time per tick in the pilot's demand path (s), actuator calls per tick) """
+    pilot, calls = make_pilot()
+    stage = timings.stage('pilot_demands')
+    timings.enabled = True
+    try:
+        for tick, demands in enumerate(frames):
+            if demands is not None:
+                pilot.update_demands(demands)
+            if tick == 0:
+                # Starting the motor isn't part of the demand handling
+                calls[0] = 0
+                stage.reset()
+            pilot.fly_step()
+    finally:
+        timings.enabled = False
+        pilot.stop_flying()
+        pilot.close()
+    return stage.total / stage.count - timing_overhead(), calls[0] / len(frames)
+
+
+def run_dispatch(frames):
+    """ Returns (mean time per tick in the pilot's dispatcher (s), actuator calls per tick) """
+    pilot, calls = make_pilot()
+    # Flying, as the dispatcher would only be called while it is
+    pilot.update_demands(frames[0])
+    calls[0] = 0
+    # (As the pilot reads them out of the demand slot)
+    records = [None if demands is None else array('d', (float(demands[field]) for field in DEMAND_FIELDS))
+               for demands in frames]
+    dispatch = pilot.dispatcher.dispatch
+    clock = time.perf_counter
+    overhead = timing_overhead()
+    total = 0
+    try:
+        for record in records:
+            if record is not None:
+                started = clock()
+                dispatch(record)
+                total += clock() - started - overhead
+    finally:
+        pilot.stop_flying()
+        pilot.close()
+    return total / len(frames), calls[0] / len(frames)
+
+
+if __name__ == "__main__":
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    frames = session(ticks)
+    print(f"{ticks} ticks at 200Hz, demands at 100Hz")
+    print(f"{'loop':>14}{'per tick (ns)':>15}{'actuator calls per tick':>25}")
+    for name, run in (('string chain', run_string_chain), ('fly_step', run_fly_step), ('dispatch only', run_dispatch)):
+        # Best of a few runs, to keep other things going on out of it (and the sim motor's chatter off the table)
+        with redirect_stdout(None):
+            per_tick, calls = min(run(frames) for _ in range(3))
+        print(f"{name:>14}{1e9 * per_tick:>15.0f}{calls:>25.2f}")
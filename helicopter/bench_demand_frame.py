@@ -0,0 +1,38 @@
+""" Micro-benchmark comparing the JSON and binary demand encodings. Run with: python bench_demand_frame.py """
+import timeit
+from heli_protocol import DemandFrameCodec, JsonDemandCodec
+
+# A typical mid-flight set of demands
+_demands = {
+    'stop_demand': False,
+    'start_demand': True,
+    'calibration_demand': False,
+    'throttle_demand': 0.62353,
+    'yaw_demand': -0.04112,
+    'pitch_demand': 0.18021,
+    'roll_demand': -0.3311,
+    'init_connection_demand': True,
+    'battery_connected': True,
+    'request_gyro_state_demand': False,
+}
+
+def benchmark(codec, number=100000):
+    """ Returns (bytes per update, encode us, decode us) for 'codec' """
+    encoded = codec.encode(_demands)
+    # The server strips the trailing newline off JSON demands before decoding them, so do the same here
+    wire_data = encoded.strip() if isinstance(codec, JsonDemandCodec) else encoded
+    encode_time = min(timeit.repeat(lambda: codec.encode(_demands), number=number, repeat=5)) / number
+    decode_time = min(timeit.repeat(lambda: codec.decode(wire_data), number=number, repeat=5)) / number
+    return len(encoded), encode_time * 1e6, decode_time * 1e6
+
+if __name__ == "__main__":
+    print(f"{'encoding':<10}{'bytes':>8}{'encode (us)':>14}{'decode (us)':>14}")
+    results = {}
+    for name, codec in (('json', JsonDemandCodec()), ('binary', DemandFrameCodec())):
+        results[name] = benchmark(codec)
+        size, encode_us, decode_us = results[name]
+        print(f"{name:<10}{size:>8}{encode_us:>14.2f}{decode_us:>14.2f}")
+    json_size, json_encode, json_decode = results['json']
+    binary_size, binary_encode, binary_decode = results['binary']
+    print(f"Binary frames are {json_size / binary_size:.1f}x smaller, "
+          f"{json_encode / binary_encode:.1f}x faster to encode and {json_decode / binary_decode:.1f}x faster to decode")
@@ -0,0 +1,54 @@
+"""
+Measures how long a FlightLog call adds to a control loop iteration, against print() to the same stream.
+Calls are timed one at a time while the flush thread runs, so the figures include any contention with it.
+Run with: python bench_flight_log.py [calls] [loop_rate_hz]
+Output goes to /dev/null, so this times the logging rather than the terminal - a real terminal (or SSH) is slower still
+for print(), but makes no difference to the log call.
+"""
+import os
+import sys
+import time
+import numpy as np
+from flight_log import FlightLog
+
+def time_calls(call, calls, pace=0.0):
+    """ Per-call durations (us). 'pace' spaces the calls out, like a loop that logs once per iteration """
+    durations = np.empty(calls)
+    perf_counter = time.perf_counter
+    for i in range(calls):
+        start = perf_counter()
+        call(i)
+        durations[i] = perf_counter() - start
+        if pace:
+            time.sleep(pace)
+    return durations * 1e6
+
+def summary(durations):
+    p50, p99, p999 = np.percentile(durations, [50, 99, 99.9])
+    return p50, p99, p999, durations.max()
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    loop_rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    budget_us = 1e6 / loop_rate_hz
+    rates = np.array([0.01, -0.02, 0.5])
+    with open(os.devnull, 'w') as null:
+        log = FlightLog(capacity=4096, stream=null, rate_limits_hz={'gyro_state': 5}).start()
+        results = {
+            'print()': time_calls(lambda i: print(f"Gyro rates: {rates}, iteration {i}", file=null, flush=True), calls),
+            'log, accepted': time_calls(lambda i: log.info('yaw', "Gyro rates: %s, iteration %d", rates, i), calls,
+                                        pace=0.0001),
+            'log, rate limited': time_calls(lambda i: log.info('gyro_state', "Gyro rates: %s, iteration %d", rates, i), calls),
+            'log, below level': time_calls(lambda i: log.debug('yaw', "Gyro rates: %s, iteration %d", rates, i), calls),
+        }
+        log.stop()
+        # Nothing drains the ring here, so every call after it fills up is a drop
+        full_log = FlightLog(capacity=16, stream=null)
+        results['log, ring full'] = time_calls(lambda i: full_log.info('yaw', "Gyro rates: %s, iteration %d", rates, i), calls)
+    print(f"{calls} calls each. Loop budget at {loop_rate_hz:.0f}Hz: {budget_us:.0f}us")
+    print(f"{'':>20}{'p50 (us)':>10}{'p99 (us)':>10}{'p99.9 (us)':>12}{'max (us)':>10}{'max % budget':>14}")
+    for label, durations in results.items():
+        p50, p99, p999, worst = summary(durations)
+        print(f"{label:>20}{p50:>10.2f}{p99:>10.2f}{p999:>12.2f}{worst:>10.1f}{100 * worst / budget_us:>13.2f}%")
+    print(f"Log: {log}")
+    print(f"Full log: {full_log}")
@@ -0,0 +1,162 @@
+"""
+Measures the CPU the controller and the heli server use while there's nothing for them to do, and how often their
+threads wake up to do it. A busy-wait shows up as a whole core, and polling as hundreds of wakeups a second.
+The server (on the simulated hardware, in real time) and the controller each run in their own process, with a
+stand-in gamepad that feeds raw evdev events down a pipe, like the real device does. Each is measured:
+ - waiting: the controller's up, but START hasn't been pressed
+ - connected: connected to the server, but the pilot's not been woken
+ - flying: the pilot's awake and the motor's running (on the ground), with the sticks still. The server's control
+   loop is working away here, so its figures aren't idle - the controller's should still be little more than its
+   heartbeats and the telemetry coming back
+Uses the controller's shipped settings (heli_server_config.json), pointed at the local server.
+Linux only (reads the processes' figures from /proc).
+Run from this directory with: python bench_idle_cpu.py [seconds_per_phase]
+"""
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+from collections import namedtuple
+os.environ['HELI_HARDWARE'] = 'sim'
+os.environ['HELI_SIM_TIME'] = 'real'
+from inputs import devices, EVENT_FORMAT, EVENT_SIZE
+controller_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller')
+
+# Event type numbers for the codes a gamepad sends
+EVENT_TYPES = {name: number for number, name in devices.codes['types'].items()}
+EVENT_CODES = {name: (EVENT_TYPES[event_type], code)
+               for event_type in ('Sync', 'Key', 'Absolute') for code, name in devices.codes[event_type].items()}
+
+PipeEvent = namedtuple('PipeEvent', ['code', 'state'])
+
+
+class PipeGamePad:
+    """
+    Stands in for an inputs gamepad device, with the events sent to it coming out of a pipe as raw evdev events, the
+    same as the real device's character device. Has the blocking read() of an inputs device too
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def fileno(self):
+        return self.read_fd
+
+    def read(self):
+        """ The next event (as a list of one, like an inputs device) - waits for it """
+        _, _, event_type, code, state = struct.unpack(EVENT_FORMAT, os.read(self.read_fd, EVENT_SIZE))
+        event_type = devices.get_event_type(event_type)
+        return [PipeEvent(devices.get_event_string(event_type, code), state)]
+
+    def send(self, *events):
+        """ Send a report with each of the (code, state) events in it """
+        seconds = time.time()
+        data = b''
+        for code, state in list(events) + [('SYN_REPORT', 0)]:
+            data += struct.pack(EVENT_FORMAT, int(seconds), int(seconds % 1 * 1e6), *EVENT_CODES[code], state)
+        os.write(self.write_fd, data)
+
+
+def quietly():
+    """ Keep a child process's chatter off the screen """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+
+def run_server(port_pipe):
+    quietly()
+    from helicopter import HelicopterConfig
+    from heli_server import HelicopterServer
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config) as server:
+        port_pipe.send(server.server_address[1])
+        server.serve()
+
+
+def run_controller(config_file, device):
+    quietly()
+    sys.path.append(controller_dir)
+    from controller import HelicopterController
+    from gamepad import GamePad
+
+    class PipeController(HelicopterController):
+        def _get_gamepad(self):
+            return GamePad(device)
+
+    PipeController(config_file)
+
+
+def usage(pid):
+    """ (CPU time (s), voluntary context switches) so far, over all the process's threads """
+    with open(f'/proc/{pid}/stat') as file:
+        # (Everything after the command name, which might have spaces in)
+        fields = file.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    switches = 0
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/status') as file:
+                switches += next(int(line.split()[1]) for line in file if line.startswith('voluntary_ctxt_switches'))
+        except FileNotFoundError:
+            # Thread's finished
+            pass
+    return cpu, switches
+
+
+def measure(processes, seconds):
+    """ {name: (CPU %, wakeups/s)} over 'seconds' """
+    before = {name: usage(process.pid) for name, process in processes.items()}
+    started = time.monotonic()
+    time.sleep(seconds)
+    elapsed = time.monotonic() - started
+    after = {name: usage(process.pid) for name, process in processes.items()}
+    return {name: (100 * (after[name][0] - before[name][0]) / elapsed, (after[name][1] - before[name][1]) / elapsed)
+            for name in processes}
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    context = multiprocessing.get_context('fork')
+    port_pipe, server_end = context.Pipe()
+    server = context.Process(target=run_server, args=(server_end,), daemon=True)
+    server.start()
+    with open(os.path.join(controller_dir, 'heli_server_config.json')) as file:
+        conf = json.load(file)
+    conf.update(server_ip='127.0.0.1', server_port=port_pipe.recv())
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+        json.dump(conf, conf_file)
+    device = PipeGamePad()
+    controller = context.Process(target=run_controller, args=(conf_file.name, device), daemon=True)
+    controller.start()
+    processes = {'controller': controller, 'server': server}
+    results = {}
+    try:
+        # Let everything get going
+        time.sleep(1)
+        results['waiting'] = measure(processes, seconds)
+        # Connects on release
+        device.send(('BTN_START', 1))
+        device.send(('BTN_START', 0))
+        time.sleep(0.5)
+        results['connected'] = measure(processes, seconds)
+        device.send(('BTN_SOUTH', 1))
+        time.sleep(1)
+        device.send(('BTN_TL', 1), ('BTN_TR', 1))
+        time.sleep(0.5)
+        results['flying'] = measure(processes, seconds)
+        device.send(('BTN_MODE', 1))
+        time.sleep(0.2)
+    finally:
+        controller.terminate()
+        server.terminate()
+        os.unlink(conf_file.name)
+    print(f"\n{seconds:.0f}s per phase, on {os.cpu_count()} CPUs (100% = one core)")
+    print(f"{'phase':>10}{'controller CPU %':>18}{'wakeups/s':>11}{'server CPU %':>14}{'wakeups/s':>11}")
+    for phase, result in results.items():
+        (controller_cpu, controller_wakeups), (server_cpu, server_wakeups) = result['controller'], result['server']
+        print(f"{phase:>10}{controller_cpu:>18.1f}{controller_wakeups:>11.0f}{server_cpu:>14.1f}{server_wakeups:>11.0f}")
@@ -0,0 +1,154 @@
+"""
+Times what the controller spends applying each gamepad event, for:
+ - string chain: the original GamePad, running every event down a chain of 'if event.code == ...' checks and
+   dividing/clamping the axes
+ - table: the GamePad through its input mapping - the event's handler looked up by its code, and the axes through
+   their response curves' lookup tables
+Fed a made up session of reports: sticks held still (with a little sensor noise) most of the time, some stick
+movements, and the odd button. Also counts the reports that change the demands - the deadzone keeps the noise out.
+Run from this directory with: python bench_input_mapping.py [reports]
+"""
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from gamepad import GamePad, GamePadEvent
+from input_mapping import InputMapping
+
+STICKS = ('ABS_X', 'ABS_Y', 'ABS_RX', 'ABS_RY')
+BUTTONS = ('BTN_WEST', 'BTN_TL', 'BTN_TR', 'BTN_SELECT')
+# Raw noise on a stick that's being left alone
+NOISE = 300
+
+
+def session(reports, seed=0):
+    """ The events of 'reports' reports, each ending in a sync report """
+    rng = random.Random(seed)
+    positions = {stick: 0 for stick in STICKS}
+    events = []
+    for _ in range(reports):
+        if rng.random() < 0.2:
+            # Sticks moving, one or two at once
+            for stick in rng.sample(STICKS, rng.choice((1, 2))):
+                positions[stick] = max(-32768, min(32767, positions[stick] + rng.randint(-3000, 3000)))
+                events.append(GamePadEvent(stick, positions[stick]))
+        elif rng.random() < 0.01:
+            button = rng.choice(BUTTONS)
+            events.append(GamePadEvent(button, rng.choice((0, 1))))
+        else:
+            # A stick at rest, jittering about
+            stick = rng.choice(STICKS)
+            events.append(GamePadEvent(stick, max(-32768, min(32767, positions[stick] + rng.randint(-NOISE, NOISE)))))
+        events.append(GamePadEvent('SYN_REPORT', 0))
+    return events
+
+
+class StringChain(GamePad):
+    """ The original event handling """
+
+    _max_joystick_value = 32000
+
+    def _take_event(self, event):
+        if event.code != 'SYN_REPORT':
+            self._apply_event(event)
+            self._report_updated = True
+            return False
+        if self.left_trigger_pressed and self.right_trigger_pressed:
+            self.log.info('start', "Both right and left triggers depressed")
+            self.stop_demand = False
+            self.start_demand = True
+        updated, self._report_updated = self._report_updated, False
+        return updated
+
+    def _apply_event(self, event):
+        if event.code == 'ABS_X':
+            self.yaw_demand = -min(1,max(-1,event.state/self._max_joystick_value))
+        if event.code == 'ABS_Y':
+            self.throttle_demand = -min(1,max(-1,event.state/self._max_joystick_value))
+        if event.code == 'ABS_RX':
+            self.roll_demand = min(1,max(-1,event.state/self._max_joystick_value))
+        if event.code == 'ABS_RY':
+            self.pitch_demand = -min(1,max(-1,event.state/self._max_joystick_value))
+        if event.code == 'ABS_Z':
+            self.log.info('lower_trigger', "Left lower trigger pressed, but currently does nothing")
+        if event.code == 'ABS_RZ':
+            self.log.info('lower_trigger', "Right lower trigger pressed, but currently does nothing")
+        if event.code == 'BTN_NORTH':
+            self.log.info('button', "X button pressed, but currently does nothing")
+        if event.code == 'BTN_WEST':
+            if event.state == 1:
+                self.log.info('button', "Y button pressed, requesting gyro readings")
+                self.request_gyro_state = True
+            else:
+                self.log.info('button', "Y button released, not requesting gyro readings")
+                self.request_gyro_state = False
+        if event.code == 'BTN_EAST':
+            if event.state == 1:
+                self.log.info('button', "B button pressed, handing over control")
+                self.handover_demand = True
+            else:
+                self.handover_demand = False
+        if event.code == 'BTN_SOUTH':
+            if event.state == 1:
+                self.log.info('button', "A button pressed, waking up the pilot...")
+                self.battery_connected = True
+        if event.code == 'BTN_SELECT':
+            if event.state == 1:
+                self.calibration_demand = True
+                self.log.info('button', "Select button pressed, initiating Gyro calibration")
+            else:
+                self.calibration_demand = False
+        if event.code == 'BTN_START' and event.state == 0:
+            self.log.info('button', "Start button pressed, Trying to connect to helicopter server.")
+            self.init_connection_demand = True
+        if event.code == 'BTN_MODE':
+            self.log.info('button', "XBox button pressed, stopping the motor!")
+            if event.state == 1:
+                self.stop_demand = True
+                self.start_demand = False
+        if event.code == 'BTN_TR':
+            if event.state == 1:
+                self.log.info('button', "Right trigger button pressed")
+                self.right_trigger_pressed = True
+            else:
+                self.log.info('button', "Right trigger button released")
+                self.right_trigger_pressed = False
+        if event.code == 'BTN_TL':
+            if event.state == 1:
+                self.log.info('button', "Left trigger button pressed")
+                self.left_trigger_pressed = True
+            else:
+                self.log.info('button', "Left trigger button released")
+                self.left_trigger_pressed = False
+
+
+def run(gamepad_class, mapping, events):
+    """ Returns (mean time per event (s), reports that changed the demands) """
+    gamepad = gamepad_class(object(), mapping)
+    # Keep the button presses off the screen
+    gamepad.log.level = 100
+    clock = time.perf_counter_ns
+    take_event = gamepad._take_event
+    reports = 0
+    started = clock()
+    for event in events:
+        if take_event(event):
+            reports += 1
+    elapsed = clock() - started
+    gamepad.log.stop()
+    return elapsed / len(events) / 1e9, reports
+
+
+if __name__ == "__main__":
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    events = session(reports)
+    started = time.perf_counter()
+    mapping = InputMapping.from_file()
+    print(f"Loaded {len(mapping.profiles)} input profiles in {1000 * (time.perf_counter() - started):.0f}ms")
+    print(f"{reports} reports, {len(events)} events (sync reports included)")
+    print(f"{'gamepad':>14}{'per event (ns)':>16}{'reports changing the demands':>30}")
+    for name, gamepad_class in (('string chain', StringChain), ('table', GamePad)):
+        # Best of a few runs, to keep other things going on out of it
+        per_event, changed = min(run(gamepad_class, mapping, events) for _ in range(3))
+        print(f"{name:>14}{1e9 * per_event:>16.0f}{changed:>30}")
@@ -0,0 +1,122 @@
+"""
+Checks that observers can't slow down the pilot's demand path.
+Runs a heli server (on the simulated hardware) with a controller sending demands over loopback, and times how long
+each demand frame takes to reach the pilot with more and more observers attached. Half the observers read their
+telemetry, and half never read anything (so on a long enough run their sockets fill up, and they start missing frames).
+The observers run in their own process, so they don't compete with the server for the GIL as they would in this one.
+Run from this directory with: python bench_observers.py [duration_s] [demand_rate_hz]
+"""
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+import numpy as np
+os.environ['HELI_HARDWARE'] = 'sim'
+import sim_hardware
+from helicopter import HelicopterConfig
+from heli_protocol import OBSERVER_REQUEST, TELEMETRY_RATE, SESSION_ID
+from heli_server import HelicopterServer, HeliServerConnectionHandler
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+# Roughly what the real hardware costs, as in bench_pilot_loop
+sim_hardware.Gyro.read_latency = 0.0004
+sim_hardware.Servo.write_latency = 0.00003
+sim_hardware.Motor.write_latency = 0.00003
+
+OBSERVER_COUNTS = (0, 10, 50, 200)
+OBSERVER_RATE_HZ = 50
+
+
+class TimedHandler(HeliServerConnectionHandler):
+    """ Notes how long each demand frame took to get from the controller to the pilot """
+
+    latencies = None
+
+    def apply_demands(self, sequence, sent_time, demands):
+        super().apply_demands(sequence, sent_time, demands)
+        self.latencies.append(time.time() - sent_time)
+
+
+def run_observers(port, count, duration, results):
+    """ (In its own process) Connect 'count' observers, read from every other one for 'duration', then hang up """
+    observers = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.sendall(bytes([OBSERVER_REQUEST]) + TELEMETRY_RATE.pack(OBSERVER_RATE_HZ))
+        reply = sock.recv(1 + TELEMETRY_RATE.size + SESSION_ID.size, socket.MSG_WAITALL)
+        if reply[:1] != bytes([OBSERVER_REQUEST]):
+            raise ConnectionRefusedError("Observer refused")
+        observers.append(sock)
+    results.put('connected')
+    received = 0
+    with selectors.DefaultSelector() as selector:
+        for sock in observers[::2]:
+            selector.register(sock, selectors.EVENT_READ)
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            for key, _ in selector.select(0.1):
+                received += len(key.fileobj.recv(65536))
+    for sock in observers:
+        sock.close()
+    results.put(received)
+
+
+def run(observer_count, duration, demand_rate_hz):
+    """ Returns (uplink latencies (s), telemetry bytes the reading observers received, server's observer stats) """
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    config.server = {'max_observers': max(OBSERVER_COUNTS), 'observer_rate_hz': OBSERVER_RATE_HZ}
+    TimedHandler.latencies = []
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config, handler=TimedHandler) as server:
+        Thread(target=server.serve, daemon=True).start()
+        port = server.server_address[1]
+        results = multiprocessing.Queue()
+        observers = multiprocessing.Process(target=run_observers, args=(port, observer_count, duration + 1, results))
+        observers.start()
+        results.get()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': port, 'demand_encoding': 'binary',
+                       'telemetry_rate_hz': 50}, conf_file)
+        try:
+            with ControllerConnection(conf_file.name) as connection:
+                connection.init_connection()
+                connection.set_battery_connected()
+                period = 1 / demand_rate_hz
+                next_send = time.monotonic()
+                for i in range(int(duration * demand_rate_hz)):
+                    # Sweep the throttle so every frame's different
+                    connection.send_input_demands({'start_demand': True, 'throttle_demand': 0.3 + 0.2 * (i % 100) / 100})
+                    next_send += period
+                    time.sleep(max(0, next_send - time.monotonic()))
+                observer_stats = [(observer.frames_sent, observer.frames_dropped) for observer in server.session.observers]
+        finally:
+            os.unlink(conf_file.name)
+        received = results.get()
+        observers.join()
+        server.shutdown()
+    return np.array(TimedHandler.latencies), received, observer_stats
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    demand_rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    results = [(count, *run(count, duration, demand_rate_hz)) for count in OBSERVER_COUNTS]
+    print(f"\nDemands at {demand_rate_hz:.0f}Hz for {duration:.0f}s per run over loopback, observers asking for "
+          f"{OBSERVER_RATE_HZ}Hz telemetry (half reading it, half not)")
+    print(f"{'observers':>10}{'frames':>8}{'p50 (us)':>10}{'p99 (us)':>10}{'max (us)':>10}"
+          f"{'telemetry sent':>16}{'dropped':>9}{'KB read':>9}")
+    for count, latencies, received, observer_stats in results:
+        p50, p99 = 1e6 * np.percentile(latencies, [50, 99])
+        sent = sum(stats[0] for stats in observer_stats)
+        dropped = sum(stats[1] for stats in observer_stats)
+        print(f"{count:>10}{len(latencies):>8}{p50:>10.0f}{p99:>10.0f}{1e6 * latencies.max():>10.0f}"
+              f"{sent:>16}{dropped:>9}{received / 1024:>9.0f}")
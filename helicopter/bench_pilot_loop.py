@@ -0,0 +1,40 @@
+"""
+Times the pilot's control loop against the simulated hardware, with representative I2C/pigpio latencies.
+Run from this directory with: python bench_pilot_loop.py [loop_rate_hz] [duration_s]
+"""
+import os
+import sys
+import tempfile
+import time
+os.environ['HELI_HARDWARE'] = 'sim'
+import sim_hardware
+from helicopter import HelicopterConfig
+from pilot import HelicopterPilot
+
+# Roughly what the real hardware costs: a 14-byte I2C burst read at 400kHz and a pigpio write per actuator
+sim_hardware.Gyro.read_latency = 0.0004
+sim_hardware.Servo.write_latency = 0.00003
+sim_hardware.Motor.write_latency = 0.00003
+
+def run(loop_rate_hz, duration):
+    config = HelicopterConfig()
+    config.pilot['loop_rate_hz'] = loop_rate_hz
+    # Record the flight as usual, but somewhere out of the way
+    config.recorder['path'] = os.path.join(tempfile.gettempdir(), 'bench_pilot_loop.fdr')
+    start_cpu = time.process_time()
+    pilot = HelicopterPilot(config)
+    pilot.update_demands({'start_demand': True, 'stop_demand': False, 'throttle_demand': 0.5, 'yaw_demand': 0,
+                          'pitch_demand': 0, 'roll_demand': 0})
+    time.sleep(duration)
+    pilot.thread_running = False
+    pilot.pilot_thread.join()
+    cpu_time = time.process_time() - start_cpu
+    # The pilot prints its loop stats when it stops
+    print(f"Loop rate: {loop_rate_hz}Hz for {duration}s, IMU reads: {pilot.gyro.reads}, "
+          f"CPU used: {100 * cpu_time / duration:.1f}%")
+    return pilot.scheduler.stats
+
+if __name__ == "__main__":
+    loop_rate_hz = float(sys.argv[1]) if len(sys.argv) > 1 else 200
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run(loop_rate_hz, duration)
@@ -0,0 +1,130 @@
+"""
+Compares the pilot's control loop jitter with the pilot flying on a thread in the server's process, and in a process
+of its own (see pilot_process) - each with the server otherwise idle, and under synthetic network load.
+The load is what the server's connection threads do: 'streams' loopback connections, each with a thread writing
+JSON demand lines as fast as it can and one reading them back with readline(), json.loads()-ing them and printing
+them (to /dev/null). The first stream's demands are handed to the pilot, as the controller's would be.
+Runs on the simulated hardware in real time, with the same stand-in I2C/pigpio latencies as bench_pilot_loop. The
+pilot process is pinned to the last CPU, and run both at the config's real-time priority (if the OS allows it - it
+warns if not) and without.
+Run from this directory with: python bench_pilot_process.py [seconds] [streams]
+"""
+import json
+import os
+import socket
+import sys
+import time
+from threading import Event, Thread
+os.environ['HELI_HARDWARE'] = 'sim'
+os.environ['HELI_SIM_TIME'] = 'real'
+import sim_hardware
+from helicopter import HelicopterConfig
+from pilot import HelicopterPilot
+from pilot_process import PilotProcess
+from loop_scheduler import LoopStats
+
+
+def sim_latencies():
+    """ Roughly what the real hardware costs (as bench_pilot_loop). Also run in the pilot process """
+    sim_hardware.Gyro.read_latency = 0.0004
+    sim_hardware.Servo.write_latency = 0.00003
+    sim_hardware.Motor.write_latency = 0.00003
+
+
+DEMANDS = {'start_demand': True, 'stop_demand': False, 'throttle_demand': 0.5, 'yaw_demand': 0.0,
+           'pitch_demand': 0.0, 'roll_demand': 0.0}
+
+
+def network_load(streams, pilot, stop):
+    """ Start 'streams' loopback demand streams (see above), until 'stop' is set. Returns their threads """
+    devnull = open(os.devnull, 'w')
+    threads = []
+    for stream in range(streams):
+        sender, receiver = socket.socketpair()
+
+        def send(sock=sender):
+            demands = dict(DEMANDS)
+            with sock:
+                while not stop.is_set():
+                    demands['yaw_demand'] = (demands['yaw_demand'] + 0.01) % 1
+                    try:
+                        sock.sendall((json.dumps(demands) + '\n').encode('utf-8'))
+                    except OSError:
+                        # The reader's finished
+                        return
+
+        def receive(sock=receiver, feeds_pilot=stream == 0):
+            with sock, sock.makefile('rb') as lines:
+                while not stop.is_set():
+                    line = lines.readline()
+                    if not line:
+                        return
+                    demands = json.loads(line.decode('utf-8'))
+                    print(f"Latest demands: {demands}", file=devnull)
+                    if feeds_pilot:
+                        pilot.update_demands(demands)
+
+        threads += [Thread(target=send, daemon=True), Thread(target=receive, daemon=True)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def fly_thread(config, seconds, streams):
+    """ The pilot on a thread of its own in this process. Returns its loop stats """
+    pilot = HelicopterPilot(config)
+    pilot.update_demands(DEMANDS)
+    stop = Event()
+    network_load(streams, pilot, stop)
+    time.sleep(seconds)
+    stop.set()
+    pilot.stop_flying()
+    pilot.pilot_thread.join()
+    return pilot.scheduler.stats
+
+
+def fly_process(config, seconds, streams, realtime=True):
+    """ The pilot in a process of its own (at the config's real-time priority, if 'realtime'). Returns its loop stats """
+    priority = {} if realtime else {'realtime_priority': None}
+    pilot = PilotProcess.from_config(config, cpu=os.cpu_count() - 1, initializer=sim_latencies, **priority).wake()
+    pilot.update_demands(DEMANDS)
+    stop = Event()
+    network_load(streams, pilot, stop)
+    time.sleep(seconds)
+    stop.set()
+    pilot.stop_flying()
+    return pilot.loop_stats
+
+
+def jitter_percentile(stats:LoopStats, percent:float):
+    """ The upper edge of the jitter histogram bin the 'percent'th percentile falls in (us) """
+    wanted = percent / 100 * sum(stats.jitter_histogram)
+    count = 0
+    for edge, bin_count in zip(stats.jitter_bin_edges_us, stats.jitter_histogram):
+        count += bin_count
+        if count >= wanted:
+            return f"<{edge}"
+    return f">={stats.jitter_bin_edges_us[-1]}"
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    streams = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    sim_latencies()
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    config.logging = {'level': 'warning'}
+    results = {}
+    for load in (0, streams):
+        for mode, fly in (('thread', fly_thread), ('process', fly_process),
+                          ('no RT', lambda *args: fly_process(*args, realtime=False))):
+            results[(mode, load)] = fly(config, seconds, load)
+    print(f"\n{seconds:.0f}s each at {config.pilot.get('loop_rate_hz', 200)}Hz, on {os.cpu_count()} CPUs. 'process' is at "
+          f"real-time priority {config.pilot.get('process', {}).get('realtime_priority')}, 'no RT' the process without")
+    print(f"{'pilot':>8}{'streams':>9}{'iterations':>12}{'overruns':>10}{'jitter p50/p99 (us)':>21}"
+          f"{'max jitter (us)':>17}{'mean work (us)':>16}")
+    for (mode, load), stats in results.items():
+        percentiles = f"{jitter_percentile(stats, 50)}/{jitter_percentile(stats, 99)}"
+        print(f"{mode:>8}{load:>9}{stats.iterations:>12}{stats.overruns:>10}{percentiles:>21}"
+              f"{1e6 * stats.max_jitter:>17.0f}{1e6 * stats.mean_work_time:>16.0f}")
@@ -0,0 +1,118 @@
+"""
+Measures how long it takes to get back to flying after the controller's link drops.
+Runs a heli server (on the simulated hardware) with a controller sending demands at 100Hz over loopback, and breaks
+the link over and over:
+ - drop: the controller's connection is cut (as if it had been reset), which both ends notice straight away
+ - silent: the controller stops sending without closing anything (as if it had gone out of range), so the server only
+   notices once the link timeout's up
+ - cold: the connection is cut with resuming turned off, so the pilot has to be woken up all over again
+For each it reports how long the server was without a controller, how long the controller took to reconnect, and the
+time from the link breaking to the controller's demands reaching the pilot again.
+Run from this directory with: python bench_reconnect.py [drops]
+"""
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+import numpy as np
+os.environ['HELI_HARDWARE'] = 'sim'
+import pilot_session
+from helicopter import HelicopterConfig
+from heli_server import HelicopterServer, HeliServerConnectionHandler
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+DEMAND_RATE_HZ = 100
+LINK_TIMEOUT = 0.1
+
+
+class TimedHandler(HeliServerConnectionHandler):
+    """ Notes when each demand frame reached the pilot """
+
+    applied = None
+
+    def apply_demands(self, sequence, sent_time, demands):
+        super().apply_demands(sequence, sent_time, demands)
+        if self.session.controller is self:
+            self.applied.append(time.monotonic())
+
+
+class CountedPilot(pilot_session.HelicopterPilot):
+    """ Counts how many times the pilot's woken up from scratch """
+
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        CountedPilot.created += 1
+        super().__init__(*args, **kwargs)
+
+
+def fly(connection, seconds):
+    """ Send demands for 'seconds', reconnecting if the link drops (and waking the pilot again if it can't resume) """
+    period = 1 / DEMAND_RATE_HZ
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        try:
+            connection.send_input_demands({'start_demand': True, 'throttle_demand': 0.5, 'pitch_demand': 0.2})
+        except OSError:
+            if not connection.reconnect():
+                connection.set_battery_connected()
+        time.sleep(period)
+
+
+def run(scenario, drops):
+    """ Returns a list of (server outage, reconnect time, link broken -> demands applied again) (s), one per drop """
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    config.server = {'link_timeout': LINK_TIMEOUT, 'resume_timeout': 0 if scenario == 'cold' else 5}
+    TimedHandler.applied = []
+    pilot_session.HelicopterPilot = CountedPilot
+    CountedPilot.created = 0
+    results = []
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config, handler=TimedHandler) as server:
+        Thread(target=server.serve, daemon=True).start()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': server.server_address[1], 'demand_encoding': 'binary',
+                       'telemetry_rate_hz': 20}, conf_file)
+        try:
+            with ControllerConnection(conf_file.name) as connection:
+                connection.init_connection()
+                connection.set_battery_connected()
+                for _ in range(drops):
+                    fly(connection, 0.2)
+                    broken = time.monotonic()
+                    if scenario == 'silent':
+                        # Say nothing for longer than the link timeout - the server closes the connection, so the next
+                        # sends fail
+                        time.sleep(2 * LINK_TIMEOUT)
+                    else:
+                        connection.s.shutdown(socket.SHUT_RDWR)
+                    fly(connection, 0.3)
+                    back = next(applied for applied in TimedHandler.applied if applied > broken)
+                    outage = server.session.last_outage if scenario != 'cold' else float('nan')
+                    results.append((outage, connection.last_reconnect_time, back - broken))
+        finally:
+            os.unlink(conf_file.name)
+        server.shutdown()
+    return results, CountedPilot.created
+
+
+if __name__ == "__main__":
+    drops = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    summary = []
+    for scenario in ('drop', 'silent', 'cold'):
+        results, pilots = run(scenario, drops)
+        summary.append((scenario, np.array(results), pilots))
+    print(f"\n{drops} link breaks per scenario, demands at {DEMAND_RATE_HZ}Hz, link timeout {1000 * LINK_TIMEOUT:.0f}ms")
+    print(f"{'scenario':>10}{'pilots woken':>14}{'outage p50/max (ms)':>22}{'reconnect p50/max (ms)':>25}"
+          f"{'flying again p50/max (ms)':>28}")
+    for scenario, results, pilots in summary:
+        # (No outage to speak of when the pilot isn't held - it's stopped straight away)
+        columns = [f"{1000 * np.median(column):.1f}/{1000 * column.max():.1f}" if not np.isnan(column).any() else "-"
+                   for column in results.T]
+        print(f"{scenario:>10}{pilots:>14}{columns[0]:>22}{columns[1]:>25}{columns[2]:>28}")
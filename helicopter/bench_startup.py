@@ -0,0 +1,68 @@
+"""
+Compares how long waking the pilot keeps the controller waiting:
+ - serial: each device brought up one after the other, as they used to be
+ - parallel: devices that don't depend on each other brought up at the same time
+ - prewarmed: as parallel, with the actuators already got ready at server start, so waking only has to arm the motor
+   and bring up the gyro
+Runs on the simulated hardware, with stand-in times for setting up each device (set below, to taste), and prints the
+startup timeline for each. Also compares checking pigpiod's there by connecting to it with spawning a shell.
+Run from this directory with: python bench_startup.py [wakes]
+"""
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+os.environ['HELI_HARDWARE'] = 'sim'
+import sim_hardware
+from helicopter import Helicopter, HelicopterConfig
+from pilot import HelicopterPilot
+from startup import StartupTimeline, pigpio_available
+
+# Stand-ins for what bringing up the real hardware costs (s)
+sim_hardware.Motor.init_latency = 0.02
+sim_hardware.Motor.arm_latency = 0.5
+sim_hardware.Servo.init_latency = 0.02
+sim_hardware.Gyro.init_latency = 0.3
+
+
+def wake(config, parallel, heli=None):
+    """ Returns the time taken to wake the pilot (s), and its startup timeline """
+    started = time.perf_counter()
+    pilot = HelicopterPilot(config, start=False, heli=heli, timeline=StartupTimeline(parallel))
+    woken = time.perf_counter() - started
+    pilot.close()
+    return woken, pilot.timeline
+
+
+def time_calls(function, calls=20):
+    """ Median time per call (s) """
+    times = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return np.median(times)
+
+
+if __name__ == "__main__":
+    wakes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.logging = {'level': 'warning'}
+    # At server start
+    prewarm = StartupTimeline()
+    heli = prewarm.run('prewarm', lambda: Helicopter(config, arm=False, timeline=prewarm))
+    results = {}
+    for mode, parallel, prewarmed in (('serial', False, None), ('parallel', True, None), ('prewarmed', True, heli)):
+        times, timeline = zip(*[wake(config, parallel, prewarmed) for _ in range(wakes)])
+        results[mode] = times
+        print(f"\n{mode} wake:\n{timeline[-1]}")
+    print(f"\nprewarm at server start:\n{prewarm}")
+    print(f"\nWaking the pilot ({wakes} wakes each, median/max):")
+    for mode, times in results.items():
+        print(f"{mode:>12}: {1000 * np.median(times):7.1f} / {1000 * max(times):7.1f}ms")
+    probe = time_calls(pigpio_available)
+    shell = time_calls(lambda: subprocess.run("true", shell=True))
+    print(f"\nChecking for pigpiod ({'running' if pigpio_available() else 'not running'} here): connecting "
+          f"{1000 * probe:.2f}ms, vs spawning a shell {1000 * shell:.2f}ms (median of 20)")
@@ -0,0 +1,272 @@
+"""
+Measures the end to end latency from a gamepad event to the pulse-width write it causes - the figure that matters
+most in flight.
+A synthetic gamepad stands in for the evdev device and plays a scripted session into a real HelicopterController,
+which talks over loopback to a HelicopterServer -> HelicopterPilot -> Helicopter running on the simulated hardware.
+The simulated actuators note when each write happens, and each stick event is matched to the first write it caused:
+ - throttle stick -> motor and swash plate (collective)
+ - yaw stick -> tail servo
+The heli's kept on the ground with a noiseless IMU, so the sticks are the only thing moving the actuators.
+Runs each demand encoding/transport in turn, and reports p50/p99/p99.9 latency, throughput and CPU per update.
+The results are also appended (as one JSON object per line) to a results file, to track regressions.
+Run from this directory with: python bench_stick_to_servo.py [duration_s] [event_rate_hz] [results_file]
+"""
+import bisect
+import datetime
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+from threading import Thread
+import numpy as np
+from inputs import devices, EVENT_FORMAT
+os.environ['HELI_HARDWARE'] = 'sim'
+# Latencies have to be measured in real time
+os.environ['HELI_SIM_TIME'] = 'real'
+import sim_hardware
+from helicopter import HelicopterConfig
+from heli_protocol import ENCODING_BINARY, ENCODING_JSON, TRANSPORT_TCP, TRANSPORT_UDP
+from heli_server import HelicopterServer
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from controller import HelicopterController
+from gamepad import GamePad
+from input_mapping import AXIS_FULL_SCALE
+
+# Roughly what the real hardware costs, as in bench_pilot_loop
+sim_hardware.Gyro.read_latency = 0.0004
+sim_hardware.Servo.write_latency = 0.00003
+sim_hardware.Motor.write_latency = 0.00003
+# Keep the actuators still unless a stick moves them
+sim_hardware.Gyro.noise = 0
+sim_hardware.heli.vibration = 0
+
+# (encoding, transport) for each run. Datagram demands need binary frames
+LINKS = [(ENCODING_JSON, TRANSPORT_TCP), (ENCODING_BINARY, TRANSPORT_TCP), (ENCODING_BINARY, TRANSPORT_UDP)]
+# Each throttle step goes to the next of these (all above the pilot's minimum throttle and too low to take off),
+# and every YAW_PERIOD reports the yaw stick is pushed to the next of YAW_STEPS, then let go half way through
+THROTTLE_STEPS = [0.32, 0.34, 0.36, 0.38, 0.40, 0.42, 0.44, 0.46, 0.44, 0.42, 0.40, 0.38, 0.36, 0.34]
+YAW_STEPS = [0.2, -0.3, 0.4, -0.2, 0.3, -0.4]
+YAW_PERIOD = 10
+# Seconds after the start the script gets to each stage
+IDLE_START = 1.0
+MEASURE_START = 2.0
+
+# Event type numbers for the codes a gamepad sends
+EVENT_TYPES = {name: number for number, name in devices.codes['types'].items()}
+EVENT_CODES = {name: (EVENT_TYPES[event_type], code)
+               for event_type in ('Sync', 'Key', 'Absolute') for code, name in devices.codes[event_type].items()}
+
+
+class SyntheticGamePad:
+    """
+    Stands in for a gamepad's evdev device. Once the controller starts waiting on it, plays the script into a pipe as
+    raw evdev events at the times it gives, each report followed by a sync report like the real device. Notes the
+    time each report was written (when the real events would have come off the USB). Calls on_finished (if set) once
+    the script's run out
+    """
+
+    def __init__(self, script):
+        """ 'script' is a list of (seconds from the controller starting to wait, [(code, state), ...], tag) """
+        self.script = script
+        self.on_finished = None
+        self.read_fd, self.write_fd = os.pipe()
+        self.player = None
+        # (tag, perf_counter time, process CPU time) for each report handed over
+        self.reads = []
+
+    def fileno(self):
+        if self.player is None:
+            self.player = Thread(target=self.play, daemon=True)
+            self.player.start()
+        return self.read_fd
+
+    def play(self):
+        start = time.perf_counter()
+        for due, events, tag in self.script:
+            time.sleep(max(0, start + due - time.perf_counter()))
+            seconds = time.time()
+            report = b''.join(struct.pack(EVENT_FORMAT, int(seconds), int(seconds % 1 * 1e6), *EVENT_CODES[code], state)
+                              for code, state in events + [('SYN_REPORT', 0)])
+            self.reads.append((tag, time.perf_counter(), time.process_time()))
+            os.write(self.write_fd, report)
+        if self.on_finished:
+            self.on_finished()
+
+
+def axis_state(demand):
+    """ Raw stick reading for a throttle/yaw stick position (both inverted by the input mapping) """
+    return round(-demand * AXIS_FULL_SCALE)
+
+
+def session_script(duration, event_rate_hz):
+    """
+    Connect, wake the pilot and start the motor, sit idle for a second (to measure the CPU used without any stick
+    movement), then move the sticks at event_rate_hz for 'duration' seconds and stop.
+    Each stick report lands at a random point in its period - at exactly the servo frame rate they'd all hit the same
+    point in the output frame, and the latency would just depend on where that happened to be
+    """
+    rng = random.Random(0)
+    script = [
+        (0.0, [('BTN_START', 1)], 'setup'),
+        # Connects on release
+        (0.05, [('BTN_START', 0)], 'setup'),
+        (0.3, [('BTN_SOUTH', 1)], 'setup'),
+        (0.6, [('BTN_TL', 1), ('BTN_TR', 1), ('ABS_Y', axis_state(0.3))], 'setup'),
+        (IDLE_START, [], 'idle'),
+    ]
+    for i in range(int(duration * event_rate_hz)):
+        events = [('ABS_Y', axis_state(THROTTLE_STEPS[i % len(THROTTLE_STEPS)]))]
+        tag = 'throttle'
+        if i % YAW_PERIOD == 0:
+            events.append(('ABS_X', axis_state(YAW_STEPS[(i // YAW_PERIOD) % len(YAW_STEPS)])))
+            tag = 'throttle+yaw'
+        elif i % YAW_PERIOD == YAW_PERIOD // 2:
+            events.append(('ABS_X', 0))
+            tag = 'throttle+yaw_release'
+        script.append((MEASURE_START + (i + rng.random()) / event_rate_hz, events, tag))
+    end = MEASURE_START + duration + 1 / event_rate_hz
+    script.append((end, [], 'end'))
+    script.append((end + 0.3, [('BTN_MODE', 1)], 'stop'))
+    script.append((end + 0.6, [], 'stop'))
+    return script
+
+
+class WriteTimer:
+    """ Notes the time of every simulated actuator write, by channel """
+
+    def __init__(self):
+        self.writes = {'motor': [], 'swash': [], 'tail': []}
+
+    def motor_write(self, motor, speed):
+        self.writes['motor'].append(time.perf_counter())
+
+    def servo_write(self, servo, position):
+        self.writes['tail' if hasattr(servo, 'max_deflection') else 'swash'].append(time.perf_counter())
+
+
+def match_latencies(event_times, bounds, write_times):
+    """
+    Latency from each event to the first write after it. An event with no write before the next change to the same
+    stick ('bounds') was overtaken by it, so is only counted. Returns (latencies (s), number overtaken)
+    """
+    latencies = []
+    overtaken = 0
+    for event_time, bound in zip(event_times, bounds):
+        j = bisect.bisect_right(write_times, event_time)
+        if j < len(write_times) and write_times[j] < bound:
+            latencies.append(write_times[j] - event_time)
+        else:
+            overtaken += 1
+    return np.array(latencies), overtaken
+
+
+def latency_summary(latencies, overtaken):
+    if not len(latencies):
+        return {'events': 0, 'overtaken': overtaken}
+    p50, p99, p999 = 1e6 * np.percentile(latencies, [50, 99, 99.9])
+    return {'events': len(latencies), 'overtaken': overtaken, 'p50_us': round(p50), 'p99_us': round(p99),
+            'p99_9_us': round(p999), 'max_us': round(1e6 * latencies.max())}
+
+
+class BenchController(HelicopterController):
+    """ HelicopterController reading the synthetic gamepad, and finishing when its script does """
+
+    def __init__(self, config_file, device):
+        self.device = device
+        super().__init__(config_file)
+
+    def _get_gamepad(self):
+        self.device.on_finished = self.exit_thread
+        return GamePad(self.device)
+
+
+def run(encoding, transport, duration, event_rate_hz):
+    """ One session over loopback. Returns its results """
+    config = HelicopterConfig()
+    config.recorder = {}
+    sim_hardware.heli.reset()
+    timer = WriteTimer()
+    sim_hardware.Motor.on_write = timer.motor_write
+    sim_hardware.Servo.on_write = timer.servo_write
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config) as server:
+        Thread(target=server.serve, daemon=True).start()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': server.server_address[1], 'demand_encoding': encoding,
+                       'demand_transport': transport}, conf_file)
+        device = SyntheticGamePad(session_script(duration, event_rate_hz))
+        try:
+            # Returns once the script's played out and the controller's hung up
+            controller = BenchController(conf_file.name, device)
+        finally:
+            os.unlink(conf_file.name)
+        # Let the server see the controller's gone before shutting it down
+        time.sleep(0.2)
+        server.shutdown()
+    sim_hardware.Motor.on_write = None
+    sim_hardware.Servo.on_write = None
+    if sim_hardware.heli.airborne:
+        raise RuntimeError("The simulated heli took off, so the attitude/yaw control will have moved the actuators")
+
+    reads = device.reads
+    sticks = [read for read in reads if read[0].startswith('throttle')]
+    # Every stick report moves the throttle, and the yaw moves on some of them (and is let go on others)
+    throttle_times = [read[1] for read in sticks]
+    yaw_changes = [read[1] for read in sticks if read[0] != 'throttle']
+    yaw_times = [read[1] for read in sticks if read[0] == 'throttle+yaw']
+    end_time = next(read[1] for read in reads if read[0] == 'end')
+    latency = {}
+    for channel in ('motor', 'swash'):
+        latency[channel] = latency_summary(*match_latencies(throttle_times, throttle_times[1:] + [end_time],
+                                                            timer.writes[channel]))
+    yaw_bounds = [yaw_changes[yaw_changes.index(t) + 1] if yaw_changes.index(t) + 1 < len(yaw_changes) else end_time
+                  for t in yaw_times]
+    latency['tail'] = latency_summary(*match_latencies(yaw_times, yaw_bounds, timer.writes['tail']))
+
+    # CPU for the whole stack (controller, server, pilot, simulated hardware), less what it uses sitting idle
+    idle = next(read for read in reads if read[0] == 'idle')
+    first, last = sticks[0], next(read for read in reads if read[0] == 'end')
+    idle_cpu_rate = (first[2] - idle[2]) / (first[1] - idle[1])
+    active_cpu = (last[2] - first[2]) - idle_cpu_rate * (last[1] - first[1])
+    return {
+        'encoding': encoding,
+        'transport': transport,
+        'stick_updates': len(sticks),
+        'latency': latency,
+        'throughput_hz': round(latency['motor']['events'] / (last[1] - first[1]), 1),
+        'idle_cpu_percent': round(100 * idle_cpu_rate, 1),
+        'cpu_per_update_us': round(1e6 * active_cpu / len(sticks)),
+        'demands_sent': controller.send_policy.sent,
+    }
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    event_rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    results_file = sys.argv[3] if len(sys.argv) > 3 else 'bench_stick_to_servo.jsonl'
+    runs = [run(encoding, transport, duration, event_rate_hz) for encoding, transport in LINKS]
+    print(f"\nStick events at {event_rate_hz:.0f}Hz for {duration:.0f}s per run, over loopback. Latency from the "
+          f"gamepad event to the pulse-width write (us)")
+    print(f"{'encoding':>9}{'transport':>10}{'output':>8}{'events':>8}{'overtaken':>10}{'p50':>8}{'p99':>8}"
+          f"{'p99.9':>8}{'max':>8}{'updates/s':>11}{'CPU/update (us)':>17}")
+    for result in runs:
+        for channel, summary in result['latency'].items():
+            print(f"{result['encoding']:>9}{result['transport']:>10}{channel:>8}{summary['events']:>8}"
+                  f"{summary['overtaken']:>10}{summary.get('p50_us', '-'):>8}{summary.get('p99_us', '-'):>8}"
+                  f"{summary.get('p99_9_us', '-'):>8}{summary.get('max_us', '-'):>8}{result['throughput_hz']:>11}"
+                  f"{result['cpu_per_update_us']:>17}")
+    with open(results_file, 'a') as file:
+        file.write(json.dumps({
+            'benchmark': 'stick_to_servo',
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'duration_s': duration,
+            'event_rate_hz': event_rate_hz,
+            'runs': runs,
+        }) + '\n')
+    print(f"\nResults appended to {results_file}")
@@ -0,0 +1,57 @@
+"""
+Benchmarks the cost of mixing collective/pitch/roll into swash plate servo positions each tick.
+The attitude alternates between two sets of inputs from tick to tick, so each tick really moves the servos.
+set_attitude skips the mixing when its inputs haven't changed, so what that costs is timed separately.
+Run from this directory with: python bench_swash_mixing.py
+"""
+import os
+import timeit
+os.environ['HELI_HARDWARE'] = 'sim'
+import numpy as np
+from helicopter import HelicopterConfig
+from swash_plate import SwashPlate
+
+def per_tick_us(statement, number=20000):
+    return 1e6 * min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+def writes_per_tick(swash_plate, update):
+    before = sum(servo.writes for servo in swash_plate.servos)
+    update()
+    return sum(servo.writes for servo in swash_plate.servos) - before
+
+if __name__ == "__main__":
+    swash_plate = SwashPlate(**HelicopterConfig().swash_servos)
+    mixer = swash_plate.mixer
+    matrix = np.array(mixer.matrix)
+    attitude = np.array([0.4, 0.1, -0.2])
+    # The inputs each tick, taking turns
+    attitudes = [(0.4, 0.1, -0.2), (0.35, 0.15, -0.1)]
+    ticks = [0]
+
+    def next_attitude():
+        ticks[0] += 1
+        return attitudes[ticks[0] % 2]
+
+    def separate_axes():
+        collective, pitch, roll = next_attitude()
+        swash_plate.set_height(collective)
+        swash_plate.set_pitch(pitch)
+        swash_plate.set_roll(roll)
+
+    def combined():
+        swash_plate.set_attitude(*next_attitude())
+
+    def unchanged():
+        swash_plate.set_attitude(0.4, 0.1, -0.2)
+
+    def numpy_mix():
+        return mixer.max_servo_delta * np.clip(matrix @ attitude, -1, 1)
+
+    print(f"{len(swash_plate.servos)} servos")
+    print(f"{'method':<40}{'us/tick':>10}{'writes/tick':>14}")
+    print(f"{'set_height + set_pitch + set_roll':<40}{per_tick_us(separate_axes):>10.2f}{writes_per_tick(swash_plate, separate_axes):>14}")
+    print(f"{'set_attitude':<40}{per_tick_us(combined):>10.2f}{writes_per_tick(swash_plate, combined):>14}")
+    unchanged()
+    print(f"{'set_attitude, inputs unchanged':<40}{per_tick_us(unchanged):>10.2f}{writes_per_tick(swash_plate, unchanged):>14}")
+    print(f"{'mixing only (SwashPlateMixer.mix)':<40}{per_tick_us(lambda: mixer.mix(0.4, 0.1, -0.2)):>10.2f}{'-':>14}")
+    print(f"{'mixing only (numpy matrix @ vector)':<40}{per_tick_us(numpy_mix):>10.2f}{'-':>14}")
@@ -0,0 +1,89 @@
+"""
+Measures how much the telemetry downlink adds to the uplink (demand) latency.
+Runs a heli server (on the simulated hardware) and a ControllerConnection over loopback, sends demand frames at a
+fixed rate and times how long each takes to reach the pilot, with the telemetry off and then at each rate.
+Run from this directory with: python bench_telemetry.py [duration_s] [demand_rate_hz]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from threading import Thread
+import numpy as np
+os.environ['HELI_HARDWARE'] = 'sim'
+import sim_hardware
+from helicopter import HelicopterConfig
+from heli_protocol import TRANSPORT_TCP, TRANSPORT_UDP
+from heli_server import HelicopterServer, HeliServerConnectionHandler
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+# Roughly what the real hardware costs, as in bench_pilot_loop
+sim_hardware.Gyro.read_latency = 0.0004
+sim_hardware.Servo.write_latency = 0.00003
+sim_hardware.Motor.write_latency = 0.00003
+
+
+class TimedHandler(HeliServerConnectionHandler):
+    """ Notes how long each demand frame took to get from the controller to the pilot """
+
+    latencies = None
+
+    def apply_demands(self, sequence, sent_time, demands):
+        super().apply_demands(sequence, sent_time, demands)
+        self.latencies.append(time.time() - sent_time)
+
+
+def run(transport, telemetry_rate_hz, duration, demand_rate_hz):
+    """ Returns (uplink latencies (s), telemetry reader) for one run """
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    TimedHandler.latencies = []
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config, handler=TimedHandler) as server:
+        Thread(target=server.serve, daemon=True).start()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': server.server_address[1], 'demand_encoding': 'binary',
+                       'demand_transport': transport, 'telemetry_rate_hz': telemetry_rate_hz}, conf_file)
+        try:
+            with ControllerConnection(conf_file.name) as connection:
+                connection.init_connection()
+                connection.set_battery_connected()
+                period = 1 / demand_rate_hz
+                next_send = time.monotonic()
+                for i in range(int(duration * demand_rate_hz)):
+                    # Sweep the throttle so every frame's different
+                    connection.send_input_demands({'start_demand': True, 'throttle_demand': 0.3 + 0.2 * (i % 100) / 100})
+                    next_send += period
+                    time.sleep(max(0, next_send - time.monotonic()))
+                telemetry = connection.telemetry
+                # Let the last frames land before hanging up
+                time.sleep(0.1)
+        finally:
+            os.unlink(conf_file.name)
+        server.shutdown()
+    return np.array(TimedHandler.latencies), telemetry
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    demand_rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    results = []
+    for transport in (TRANSPORT_TCP, TRANSPORT_UDP):
+        for telemetry_rate_hz in (0, 50, 100):
+            latencies, telemetry = run(transport, telemetry_rate_hz, duration, demand_rate_hz)
+            results.append((transport, telemetry_rate_hz, latencies, telemetry))
+    print(f"\nDemands at {demand_rate_hz:.0f}Hz for {duration:.0f}s per run, over loopback")
+    print(f"{'transport':>10}{'telemetry':>11}{'frames':>8}{'p50 (us)':>10}{'p99 (us)':>10}{'max (us)':>10}"
+          f"{'telemetry frames':>18}{'rtt (us)':>10}")
+    for transport, telemetry_rate_hz, latencies, telemetry in results:
+        p50, p99 = 1e6 * np.percentile(latencies, [50, 99])
+        if telemetry is None:
+            frames, rtt = '-', '-'
+        else:
+            frames = telemetry.frames
+            rtt = '-' if telemetry.smoothed_rtt is None else f"{1e6 * telemetry.smoothed_rtt:.0f}"
+        print(f"{transport:>10}{str(telemetry_rate_hz) + 'Hz':>11}{len(latencies):>8}{p50:>10.0f}{p99:>10.0f}"
+              f"{1e6 * latencies.max():>10.0f}{frames:>18}{rtt:>10}")
@@ -0,0 +1,176 @@
+""" UDP transport for the demand stream, with latest-wins semantics and per-session link statistics """
+import random
+import socket
+import time
+from heli_protocol import DemandFrameCodec, DemandFrameError
+
+_sequence_modulus = 1 << 32
+_sequence_half_range = 1 << 31
+
+def sequence_delta(sequence, reference):
+    """ Signed distance from 'reference' to 'sequence', allowing for the uint32 sequence number wrapping round """
+    delta = (sequence - reference) % _sequence_modulus
+    return delta - _sequence_modulus if delta >= _sequence_half_range else delta
+
+
+class LinkStats:
+    """ Loss, reordering and inter-arrival jitter for one datagram session """
+
+    def __init__(self):
+        self.received = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.lost = 0
+        self.rejected = 0
+        # Interarrival jitter (seconds), smoothed as per RFC 3550 section 6.4.1
+        self.jitter = 0.0
+        self._last_transit = None
+
+    def record_arrival(self, sent_time, arrival_time):
+        """ Update the jitter estimate. The two clocks needn't agree - only the change in transit time matters """
+        transit = arrival_time - sent_time
+        if self._last_transit is not None:
+            self.jitter += (abs(transit - self._last_transit) - self.jitter) / 16
+        self._last_transit = transit
+
+    @property
+    def loss_rate(self):
+        expected = self.accepted + self.lost
+        return self.lost / expected if expected else 0.0
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'lost': self.lost,
+            'rejected': self.rejected,
+            'loss_rate': self.loss_rate,
+            'jitter_ms': self.jitter * 1000,
+        }
+
+    def __str__(self):
+        return (f"received: {self.received}, accepted: {self.accepted}, lost: {self.lost} ({100 * self.loss_rate:.1f}%), "
+                f"reordered: {self.reordered}, duplicates: {self.duplicates}, rejected: {self.rejected}, "
+                f"jitter: {1000 * self.jitter:.2f}ms")
+
+
+class DatagramDemandReceiver:
+    """
+    Server end of the datagram demand transport.
+    Binds its own UDP port for the session and only accepts frames from the controller's address.
+    Frames that are older than (or the same as) the newest one already seen are dropped, so the pilot only ever
+    gets the latest demands, however the network has shuffled them.
+    """
+
+    # Room for this long of demands at the controller's send rate (its 'max_send_rate_hz'), so a burst doesn't
+    # overflow the kernel buffer while we're busy
+    _buffered_seconds = 2
+    _send_rate_hz = 100
+    # What the kernel charges each queued datagram against the receive buffer - not just its 22 bytes, but the whole
+    # buffer it arrived in (around 800 bytes on loopback, and can be more from a wifi driver). Linux doubles the size
+    # asked for to allow for that overhead, so half of this is asked for per frame
+    _datagram_truesize = 1024
+
+    def __init__(self, controller_ip, bind_host="0.0.0.0"):
+        self.controller_ip = controller_ip
+        self.codec = DemandFrameCodec()
+        self.stats = LinkStats()
+        self.last_sequence = None
+        self.last_sent_time = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        frames = int(self._buffered_seconds * self._send_rate_hz)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, frames * self._datagram_truesize // 2)
+        # What the kernel actually granted (it caps what's asked for at net.core.rmem_max), and about how many frames
+        # that holds
+        self.receive_buffer_size = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.buffered_frames = self.receive_buffer_size // self._datagram_truesize
+        self.socket.bind((bind_host, 0))
+        self.socket.setblocking(False)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+    def accept(self, datagram, arrival_time=None):
+        """ Returns the demands in 'datagram' if it's newer than everything seen so far, otherwise None """
+        self.stats.received += 1
+        try:
+            sequence, sent_time, demands = self.codec.decode(datagram)
+        except DemandFrameError:
+            self.stats.rejected += 1
+            return None
+        if self.last_sequence is not None:
+            delta = sequence_delta(sequence, self.last_sequence)
+            if delta == 0:
+                self.stats.duplicates += 1
+                return None
+            if delta < 0:
+                # Arrived after a newer frame. It was counted as lost when that frame arrived, so undo that
+                self.stats.reordered += 1
+                self.stats.lost = max(0, self.stats.lost - 1)
+                return None
+            self.stats.lost += delta - 1
+        self.last_sequence = sequence
+        self.last_sent_time = sent_time
+        self.stats.accepted += 1
+        self.stats.record_arrival(sent_time, time.time() if arrival_time is None else arrival_time)
+        return demands
+
+    def receive_latest(self):
+        """ Drain everything waiting on the socket and return the newest demands, or None if nothing new arrived """
+        latest = None
+        while True:
+            try:
+                datagram, address = self.socket.recvfrom(DemandFrameCodec.frame_size + 1)
+            except BlockingIOError:
+                return latest
+            if address[0] != self.controller_ip:
+                self.stats.rejected += 1
+                continue
+            demands = self.accept(datagram)
+            if demands is not None:
+                latest = demands
+
+
+class LossyDatagramSocket:
+    """
+    Wraps a UDP socket to randomly drop, duplicate and reorder outgoing datagrams.
+    For exercising the datagram transport over loopback - not for flying with!
+    """
+
+    def __init__(self, sock, drop_rate=0.0, reorder_rate=0.0, duplicate_rate=0.0, seed=None):
+        self.socket = sock
+        self.drop_rate = drop_rate
+        self.reorder_rate = reorder_rate
+        self.duplicate_rate = duplicate_rate
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.held_back = None
+
+    def send(self, data):
+        if self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return len(data)
+        if self.held_back is None and self.random.random() < self.reorder_rate:
+            # Hold this one back so it goes out after the next datagram
+            self.held_back = data
+            return len(data)
+        self.socket.send(data)
+        if self.random.random() < self.duplicate_rate:
+            self.socket.send(data)
+        if self.held_back is not None:
+            self.socket.send(self.held_back)
+            self.held_back = None
+        return len(data)
+
+    def close(self):
+        self.socket.close()
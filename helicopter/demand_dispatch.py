@@ -0,0 +1,44 @@
+""" Hands each demand in a demand record to its handler, only when it changes """
+import math
+from array import array
+from demand_slot import DEMAND_FIELDS, DEMAND_INDEX, demand_record
+
+# A record that doesn't match any demands (NaN doesn't equal anything, even itself)
+_UNSET = array('d', [math.nan] * len(DEMAND_FIELDS))
+
+
+class DemandDispatcher:
+    """
+    Calls the handler for each demand that's changed since the last dispatch, with its new value.
+
+    The handlers are looked up once, when the dispatcher's made, into a table of (record index, handler) pairs - so a
+    dispatch is just a walk down that table comparing each value with the last one handled. Demands without a handler
+    (e.g. init_connection_demand, once the pilot's awake) aren't looked at at all.
+    """
+    __slots__ = ['table', 'last', 'calls']
+
+    def __init__(self, handlers):
+        """ 'handlers' maps demand names to functions taking the new value. They're called in DEMAND_FIELDS order """
+        unknown = set(handlers) - set(DEMAND_FIELDS)
+        if unknown:
+            raise ValueError(f"No such demands: {sorted(unknown)}. Expected some of {list(DEMAND_FIELDS)}")
+        self.table = tuple((DEMAND_INDEX[field], handlers[field]) for field in DEMAND_FIELDS if field in handlers)
+        # The values last handed to the handlers
+        self.last = demand_record()
+        # Handler calls made
+        self.calls = 0
+        self.reset()
+
+    def reset(self):
+        """ Forget the values handled so far, so every handler is called on the next dispatch """
+        self.last[:] = _UNSET
+
+    def dispatch(self, record):
+        """ Call the handlers for the demands in 'record' (see demand_slot) that have changed """
+        last = self.last
+        for index, handler in self.table:
+            value = record[index]
+            if value != last[index]:
+                last[index] = value
+                self.calls += 1
+                handler(value)
@@ -0,0 +1,65 @@
+""" Latest-value slot for handing the demands from the server thread to the pilot thread """
+from array import array
+from time import sleep
+from heli_protocol import DEMAND_BUTTONS, DEMAND_AXES
+
+# Layout of the demand record: one float per demand, buttons first (as 0/1) then the axes
+DEMAND_FIELDS = DEMAND_BUTTONS + DEMAND_AXES
+DEMAND_INDEX = {field: i for i, field in enumerate(DEMAND_FIELDS)}
+
+def demand_record():
+    """ Returns a new, zeroed demand record to read the slot into """
+    return array('d', bytes(8 * len(DEMAND_FIELDS)))
+
+
+class DemandSlot:
+    """
+    Single-writer/single-reader, seqlock style slot holding the latest demands.
+
+    The writer bumps the sequence number to odd before touching the record and back to even once it's done, so the
+    reader can tell if it's copied a half-written record and go round again. This gives the reader a consistent view
+    of all the axes without either side taking a lock, and the writer never waits for the reader.
+
+    The generation (sequence number / 2) only moves on when the published demands actually differ from the last ones,
+    so the reader can skip its work entirely when the controller is just repeating itself.
+    """
+
+    def __init__(self):
+        self._record = demand_record()
+        self._scratch = demand_record()
+        self._sequence = 0
+
+    @property
+    def generation(self):
+        return self._sequence >> 1
+
+    def publish(self, demands):
+        """ Writer side - copy the demands dict into the slot, if it's changed """
+        scratch = self._scratch
+        for i, field in enumerate(DEMAND_FIELDS):
+            # Missing demands (e.g. from an older controller) read as 0/False
+            scratch[i] = demands.get(field, 0)
+        if scratch == self._record:
+            return False
+        self._sequence += 1
+        self._record[:] = scratch
+        self._sequence += 1
+        return True
+
+    def read_into(self, record):
+        """ Reader side - copy the latest demands into 'record' and return their generation """
+        while True:
+            sequence = self._sequence
+            if sequence & 1:
+                # Writer is part way through an update - let it finish
+                sleep(0)
+                continue
+            record[:] = self._record
+            if self._sequence == sequence:
+                return sequence >> 1
+
+    def read_if_changed(self, record, last_generation):
+        """ Like read_into(), but returns None without copying anything if nothing's changed since 'last_generation' """
+        if self._sequence >> 1 == last_generation:
+            return None
+        return self.read_into(record)
@@ -0,0 +1,148 @@
+"""
+Watchdog on the pilot the server's flying, stepping in if the controller's demands stop reaching it, the control loop
+stalls or the IMU stops sampling
+"""
+import math
+import time
+from collections import namedtuple
+from threading import Event, Thread
+
+# Stages of the response to the demands stopping, in order
+FLYING = 'flying'
+HOLD = 'hold'
+DESCEND = 'descend'
+STOP = 'stop'
+_STAGE_ORDER = {FLYING: 0, HOLD: 1, DESCEND: 2, STOP: 3}
+
+# A response the supervisor made: the stage it moved to, why, when (on its clock), and how late that was on the
+# deadline it was due at (s)
+FailsafeReaction = namedtuple('FailsafeReaction', ['stage', 'reason', 'time', 'lateness'])
+
+
+class FailsafeSupervisor:
+    """
+    Watches the pilot from a thread of its own, against deadlines on a monotonic clock:
+     - the demands: once none have reached the pilot for 'hold_after', it holds (levels off and stops turning, keeping
+       the collective). After 'descend_after' the swash is levelled and the collective cut, and after 'stop_after' the
+       motor's spun down (Helicopter.stop) and the pilot stopped. Demands reaching it again (e.g. the controller
+       resuming) put it back to flying on them
+     - the control loop: if it hasn't finished an iteration within 'loop_stall_timeout', the heli's stopped - nothing
+       is flying it
+     - the IMU: if its latest sample is older than 'imu_stale_timeout', the heli's stopped - it's flying blind
+    It goes on when the demands were last handed to the pilot (see demands_arrived()), not on the state of the
+    connection - so it steps in even if the connection's thread is stuck (e.g. part way through a read, or a write)
+    and never notices the link's gone. It backs up the session's link timeout, rather than replacing it.
+    It sleeps until the next link deadline, but for no longer than 'check_interval' (the loop and IMU are checked each
+    time it wakes) - so each response comes within 'check_interval' of being due. How late each one was is kept in
+    'reactions'. 'on_stop' is called with the reason to stop the pilot
+    """
+
+    # Settings in the config's 'failsafe' section that belong here
+    _settings = ('hold_after', 'descend_after', 'stop_after', 'loop_stall_timeout', 'imu_stale_timeout', 'check_interval')
+
+    def __init__(self, pilot, on_stop, hold_after:float=0.5, descend_after:float=2, stop_after:float=5,
+                 loop_stall_timeout:float=0.1, imu_stale_timeout:float=0.1, check_interval:float=0.02,
+                 clock=time.monotonic):
+        if not 0 < hold_after <= descend_after <= stop_after:
+            raise ValueError(f"Failsafe stages need 0 < hold_after <= descend_after <= stop_after, got "
+                             f"{hold_after}, {descend_after}, {stop_after}")
+        self.pilot = pilot
+        self.on_stop = on_stop
+        self.hold_after = hold_after
+        self.descend_after = descend_after
+        self.stop_after = stop_after
+        self.loop_stall_timeout = loop_stall_timeout
+        self.imu_stale_timeout = imu_stale_timeout
+        self.check_interval = check_interval
+        self.clock = clock
+        # Each link stage, and how long without demands it comes after
+        self._link_stages = ((HOLD, hold_after), (DESCEND, descend_after), (STOP, stop_after))
+        self.stage = FLYING
+        self.last_demands = clock()
+        self.reactions = []
+        self._stopped = Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, settings:dict, pilot, on_stop):
+        """ From the config's 'failsafe' section, using the defaults for anything not set """
+        return cls(pilot, on_stop, **{name: value for name, value in settings.items() if name in cls._settings})
+
+    def start(self):
+        self._thread = Thread(target=self._watch, name='failsafe', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching. Doesn't wait for the thread to finish, so it can be called with a lock 'on_stop' takes held
+        (or from 'on_stop' itself) - it makes no more responses once stopped
+        """
+        self._stopped.set()
+
+    def demands_arrived(self):
+        """ The controller's demands have just been handed to the pilot. Called for every frame, so it's just a store """
+        self.last_demands = self.clock()
+
+    def _watch(self):
+        started = self.clock()
+        # The loop's stalled if its iteration count hasn't moved on by this
+        last_iterations = None
+        loop_deadline = started + self.loop_stall_timeout
+        while not self._stopped.is_set():
+            now = self.clock()
+            # The control loop and IMU
+            iterations, imu_age = self.pilot.health()
+            if iterations != last_iterations:
+                last_iterations = iterations
+                loop_deadline = now + self.loop_stall_timeout
+            elif now >= loop_deadline:
+                self._react(STOP, f"Control loop stalled (no iterations for {now - loop_deadline + self.loop_stall_timeout:.3f}s)",
+                            now, loop_deadline)
+                return
+            if imu_age > self.imu_stale_timeout and now - started > self.imu_stale_timeout:
+                # (The first sample's allowed as long to arrive as any other)
+                since = now - imu_age if not math.isinf(imu_age) else started
+                self._react(STOP, f"IMU samples stale (latest {imu_age:.3f}s old)", now, since + self.imu_stale_timeout)
+                return
+            # The demands
+            silence = now - self.last_demands
+            if self.stage != FLYING and silence < self.hold_after:
+                print(f"Failsafe: demands reaching the pilot again - back to flying on them after the '{self.stage}' stage")
+                self.stage = FLYING
+            next_deadline = now + self.check_interval
+            for stage, after in self._link_stages:
+                if _STAGE_ORDER[stage] <= _STAGE_ORDER[self.stage]:
+                    continue
+                deadline = self.last_demands + after
+                if now < deadline:
+                    next_deadline = min(next_deadline, deadline)
+                    break
+                self._react(stage, f"No demands for {silence:.3f}s", now, deadline)
+                if stage == STOP:
+                    return
+            self._stopped.wait(max(0, next_deadline - self.clock()))
+
+    def _react(self, stage, reason:str, now:float, deadline:float):
+        """ Move to 'stage' for 'reason', 'now' - which was due at 'deadline' """
+        if self._stopped.is_set():
+            return
+        self.stage = stage
+        self.reactions.append(FailsafeReaction(stage, reason, now, max(0, now - deadline)))
+        print(f"Failsafe: {reason} - {stage} ({1000 * max(0, now - deadline):.1f}ms after it was due)")
+        if stage == HOLD:
+            self.pilot.hold()
+        elif stage == DESCEND:
+            self.pilot.hold(cut_collective=True)
+        else:
+            self.on_stop(reason)
+
+    @property
+    def max_lateness(self):
+        """ Latest any response has been on its deadline (s) """
+        return max((reaction.lateness for reaction in self.reactions), default=0.0)
+
+    def __str__(self):
+        return (f"stage: {self.stage}, responses: {len(self.reactions)} "
+                f"({', '.join(reaction.stage for reaction in self.reactions) or 'none'}), "
+                f"latest on its deadline: {1000 * self.max_lateness:.1f}ms")
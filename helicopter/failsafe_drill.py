@@ -0,0 +1,220 @@
+"""
+Drills the failsafe supervisor: runs a heli server (on the simulated hardware, in real time) with a controller flying
+it over loopback, then breaks something mid-flight and times each of the failsafe's responses from the moment it
+broke:
+ - frozen controller: the controller stops sending, but leaves its connection open - the server's link timeout is
+   turned off, so nothing but the failsafe notices
+ - stuck handler: the controller carries on, but the server's connection thread gets stuck handing the demands over
+ - stalled loop: the pilot's control loop gets stuck writing to a servo
+ - stale IMU: every read of the gyro fails
+For the first two it checks the pilot holds (levelling off), then descends (collective cut), then stops. For all of
+them it checks the heli's motor is spun down, and that each response came within the bound the failsafe promises
+(its check interval, plus 'slack' (ms) for the thread to get going) of being due. Exits non-zero if any don't.
+Run from this directory with: python failsafe_drill.py [slack]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from threading import Event, Thread
+os.environ['HELI_HARDWARE'] = 'sim'
+os.environ['HELI_SIM_TIME'] = 'real'
+import sim_hardware
+from helicopter import HelicopterConfig
+from heli_server import HelicopterServer, HeliServerConnectionHandler
+from demand_slot import DEMAND_FIELDS, demand_record
+from failsafe import HOLD, DESCEND, STOP
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+DEMAND_RATE_HZ = 100
+DEMANDS = {'start_demand': True, 'throttle_demand': 0.5, 'pitch_demand': 0.2, 'yaw_demand': 0.1}
+# Short stages, so the drill doesn't take long
+FAILSAFE = {'enabled': True, 'hold_after': 0.2, 'descend_after': 0.4, 'stop_after': 0.6, 'loop_stall_timeout': 0.1,
+            'imu_stale_timeout': 0.1, 'check_interval': 0.02}
+# How long to fly before breaking something, and the longest to wait for the heli to be stopped after (s)
+FLY_FOR = 0.5
+STOP_WITHIN = 2
+
+
+class DrillHandler(HeliServerConnectionHandler):
+    """ Notes when the demands reach the pilot, and can be made to get stuck handing them over """
+
+    applied = None
+    stuck = Event()
+    unstick = Event()
+
+    def apply_demands(self, sequence, sent_time, demands):
+        if DrillHandler.stuck.is_set():
+            DrillHandler.unstick.wait()
+        super().apply_demands(sequence, sent_time, demands)
+        if self.session.controller is self:
+            self.applied.append(time.monotonic())
+
+
+# When the sim's motor's been spun down (or E-stopped)
+spun_down = []
+
+
+def note_spin_downs():
+    """ Have the sim's motor note when it's spun down in 'spun_down' """
+    for name in ('spin_down', 'estop'):
+        original = getattr(sim_hardware.Motor, name)
+
+        def noted(motor, original=original):
+            spun_down.append(time.monotonic())
+            original(motor)
+        setattr(sim_hardware.Motor, name, noted)
+
+
+def pilot_demands(pilot):
+    """ The demands the pilot's flying on, as a dict """
+    demands = demand_record()
+    pilot.demand_slot.read_into(demands)
+    return dict(zip(DEMAND_FIELDS, demands))
+
+
+def break_frozen_controller(fly):
+    fly.clear()
+    # The failsafe goes on when the last demands reached the pilot
+    time.sleep(0.05)
+    return DrillHandler.applied[-1], None
+
+
+def break_stuck_handler(fly):
+    DrillHandler.stuck.set()
+    time.sleep(0.05)
+    return DrillHandler.applied[-1], DrillHandler.unstick.set
+
+
+def break_loop(fly):
+    latency = sim_hardware.Servo.write_latency
+    sim_hardware.Servo.write_latency = 5
+    return time.monotonic(), lambda: setattr(sim_hardware.Servo, 'write_latency', latency)
+
+
+def break_imu(fly):
+    read_motion = sim_hardware.Gyro.read_motion
+
+    def fail(gyro):
+        raise IOError("Simulated I2C failure")
+    sim_hardware.Gyro.read_motion = fail
+    return time.monotonic(), lambda: setattr(sim_hardware.Gyro, 'read_motion', read_motion)
+
+
+# (scenario, how to break it, the responses expected, with how long after the break each's due (s))
+SCENARIOS = (
+    ('frozen controller', break_frozen_controller,
+     ((HOLD, FAILSAFE['hold_after']), (DESCEND, FAILSAFE['descend_after']), (STOP, FAILSAFE['stop_after']))),
+    ('stuck handler', break_stuck_handler,
+     ((HOLD, FAILSAFE['hold_after']), (DESCEND, FAILSAFE['descend_after']), (STOP, FAILSAFE['stop_after']))),
+    # (The loop's seen to have stalled from the first check after its last iteration)
+    ('stalled loop', break_loop, ((STOP, FAILSAFE['loop_stall_timeout'] + FAILSAFE['check_interval']),)),
+    ('stale IMU', break_imu, ((STOP, FAILSAFE['imu_stale_timeout']),)),
+)
+
+
+def drill(scenario, breaker, expected, slack):
+    """ Returns (rows of (stage, due (s), reacted (s), lateness (s), ok), time to the motor spinning down (s), ok) """
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    config.logging = {'level': 'warning'}
+    # Nothing but the failsafe to notice the controller's gone
+    config.server = {'link_timeout': 0, 'resume_timeout': 0}
+    config.failsafe = FAILSAFE
+    DrillHandler.applied = []
+    DrillHandler.stuck.clear()
+    DrillHandler.unstick.clear()
+    spun_down.clear()
+    fly = Event()
+    fly.set()
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config, handler=DrillHandler) as server:
+        Thread(target=server.serve, daemon=True).start()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': server.server_address[1], 'demand_encoding': 'binary',
+                       'telemetry_rate_hz': 20}, conf_file)
+        try:
+            with ControllerConnection(conf_file.name) as connection:
+                connection.init_connection()
+                connection.set_battery_connected()
+
+                def send():
+                    while fly.is_set():
+                        try:
+                            connection.send_input_demands(DEMANDS)
+                        except OSError:
+                            return
+                        time.sleep(1 / DEMAND_RATE_HZ)
+                sender = Thread(target=send, daemon=True)
+                sender.start()
+                time.sleep(FLY_FOR)
+                failsafe, pilot = server.session.failsafe, server.session.pilot
+                held = descended = None
+                broken, repair = breaker(fly)
+                # Watch the demands the pilot's flying on as the failsafe steps in
+                end = broken + STOP_WITHIN
+                while time.monotonic() < end and failsafe.stage != STOP:
+                    if failsafe.stage == HOLD and held is None:
+                        time.sleep(0.01)
+                        held = pilot_demands(pilot)
+                    elif failsafe.stage == DESCEND and descended is None:
+                        time.sleep(0.01)
+                        descended = pilot_demands(pilot)
+                    time.sleep(0.002)
+                # Give the stop a moment to reach the motor
+                time.sleep(0.05)
+                fly.clear()
+                if repair:
+                    repair()
+                sender.join()
+        finally:
+            os.unlink(conf_file.name)
+        server.shutdown()
+    ok = True
+    rows = []
+    reactions = {reaction.stage: reaction for reaction in failsafe.reactions}
+    for stage, due in expected:
+        reaction = reactions.get(stage)
+        if reaction is None:
+            rows.append((stage, due, None, None, False))
+            ok = False
+            continue
+        reacted = reaction.time - broken
+        # Within its check interval of being due, from the break as well as on the failsafe's own deadline
+        stage_ok = (reaction.lateness <= FAILSAFE['check_interval'] + slack and
+                    reacted <= due + FAILSAFE['check_interval'] + slack)
+        rows.append((stage, due, reacted, reaction.lateness, stage_ok))
+        ok &= stage_ok
+    if held is not None and (held['pitch_demand'] or held['yaw_demand'] or not held['throttle_demand']):
+        print(f"{scenario}: holding should level off and keep the collective, but flying on {held}")
+        ok = False
+    if descended is not None and (descended['pitch_demand'] or descended['throttle_demand']):
+        print(f"{scenario}: descending should level off and cut the collective, but flying on {descended}")
+        ok = False
+    motor_stopped = next((at - broken for at in spun_down if at > broken), None)
+    ok &= motor_stopped is not None and sim_hardware.heli.motor.speed == 0
+    return rows, motor_stopped, ok
+
+
+if __name__ == "__main__":
+    slack = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.02
+    note_spin_downs()
+    results = [(scenario, *drill(scenario, breaker, expected, slack)) for scenario, breaker, expected in SCENARIOS]
+    print(f"\nFailsafe: {FAILSAFE}. Responses should come within {1000 * FAILSAFE['check_interval']:.0f}ms "
+          f"(+{1000 * slack:.0f}ms slack) of being due")
+    print(f"{'scenario':>18}{'response':>10}{'due (ms)':>10}{'after (ms)':>12}{'late (ms)':>11}{'':>6}"
+          f"{'motor stopped (ms)':>20}")
+    passed = True
+    for scenario, rows, motor_stopped, ok in results:
+        for i, (stage, due, reacted, lateness, stage_ok) in enumerate(rows):
+            reacted = f"{1000 * reacted:.1f}" if reacted is not None else "never"
+            lateness = f"{1000 * lateness:.1f}" if lateness is not None else "-"
+            stopped = (f"{1000 * motor_stopped:.1f}" if motor_stopped is not None else "never") if i == 0 else ""
+            print(f"{scenario if i == 0 else '':>18}{stage:>10}{1000 * due:>10.0f}{reacted:>12}{lateness:>11}"
+                  f"{'ok' if stage_ok else 'FAIL':>6}{stopped:>20}")
+        passed &= ok
+    print("All responses in time" if passed else "FAILED")
+    sys.exit(0 if passed else 1)
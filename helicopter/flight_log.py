@@ -0,0 +1,204 @@
+"""
+Logging that's safe to call from the control loop.
+Records go into a preallocated ring buffer, and are only formatted and written out (to the terminal by default)
+by a background thread, so a log call never waits on stdout/SSH. Each record has a message class (e.g. 'yaw',
+'gyro_state', 'button') which can be rate limited, so something logged every loop iteration can't flood the link.
+"""
+import json
+import sys
+import time
+from threading import Thread, Lock, Event
+
+# Severity levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+
+
+class FlightLog:
+    """
+    Non-blocking, rate limited log.
+    A call that's below the level, or over its class's rate limit, returns after a couple of comparisons. One that's
+    accepted stores a reference to the format string and its arguments in the next slot of the ring - the formatting
+    happens on the flush thread. If the flush thread falls behind and the ring fills up, new records are dropped (and
+    counted) rather than blocking the caller.
+    The flush thread sleeps until something's logged, then writes out everything logged within flush_interval of it
+    in one go.
+    """
+
+    def __init__(self, capacity:int=1024, level:int=INFO, rate_limits_hz=None, flush_interval:float=0.1,
+                 stream=None, output_format:str=FORMAT_TEXT, name:str='heli', clock=time.time):
+        """ 'rate_limits_hz' is {message class: most records per second}. Classes not in it aren't limited """
+        self.capacity = capacity
+        self.level = LEVELS[level.lower()] if isinstance(level, str) else level
+        self.flush_interval = flush_interval
+        self.stream = stream
+        self.output_format = output_format
+        self.name = name
+        self.clock = clock
+        # The ring. Parallel lists, so a record is just a few stores into existing slots
+        self._times = [0.0] * capacity
+        self._levels = [0] * capacity
+        self._classes = [None] * capacity
+        self._messages = [None] * capacity
+        self._args = [None] * capacity
+        self._suppressed_before = [0] * capacity
+        # Records written and read so far. Slot for record n is n % capacity
+        self._write_count = 0
+        self._read_count = 0
+        self._lock = Lock()
+        # Rate limiting - minimum time between records of each class, when the next one's allowed, and how many
+        # were skipped since the last one that got through
+        self._min_intervals = {message_class: 1 / rate for message_class, rate in (rate_limits_hz or {}).items()}
+        self._next_allowed = {}
+        self._suppressed = {}
+        # Counters
+        self.dropped = 0
+        self.suppressed = 0
+        self._running = False
+        # Set when there's something to write out, and when it shouldn't wait for the rest of a burst to arrive
+        self._wakeup = Event()
+        self._urgent = Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, conf, **defaults):
+        """ Build a log from a config section, e.g. {"level": "info", "capacity": 1024, "rate_limits_hz": {"yaw": 5}} """
+        return cls(**{**defaults, **conf})
+
+    def start(self):
+        """ Start the background flush thread. Returns self, so it can be chained onto the constructor """
+        if not self._running:
+            self._running = True
+            self._thread = Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the flush thread, writing out anything still in the ring """
+        self._running = False
+        self._wakeup.set()
+        self._urgent.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def debug(self, message_class:str, message:str, *args):
+        if self.level <= DEBUG:
+            self.log(DEBUG, message_class, message, *args)
+
+    def info(self, message_class:str, message:str, *args):
+        if self.level <= INFO:
+            self.log(INFO, message_class, message, *args)
+
+    def warning(self, message_class:str, message:str, *args):
+        if self.level <= WARNING:
+            self.log(WARNING, message_class, message, *args)
+
+    def error(self, message_class:str, message:str, *args):
+        if self.level <= ERROR:
+            self.log(ERROR, message_class, message, *args)
+
+    def log(self, level:int, message_class:str, message:str, *args):
+        """
+        Queue a record. 'message' is a %-style format string for 'args', only applied when the record is written out,
+        so args should be values that won't change in the meantime (e.g. a copy of a sample, not a view into a buffer)
+        """
+        if level < self.level:
+            return False
+        now = self.clock()
+        min_interval = self._min_intervals.get(message_class)
+        if min_interval is not None:
+            if now < self._next_allowed.get(message_class, 0):
+                self._suppressed[message_class] = self._suppressed.get(message_class, 0) + 1
+                self.suppressed += 1
+                return False
+            self._next_allowed[message_class] = now + min_interval
+        with self._lock:
+            count = self._write_count
+            if count - self._read_count >= self.capacity:
+                # Ring's full - drop this one rather than wait for the flush thread
+                self.dropped += 1
+                return False
+            # The first record since the flush thread last wrote everything out wakes it up
+            first = count == self._read_count
+            slot = count % self.capacity
+            self._times[slot] = now
+            self._levels[slot] = level
+            self._classes[slot] = message_class
+            self._messages[slot] = message
+            self._args[slot] = args
+            self._suppressed_before[slot] = self._suppressed.pop(message_class, 0) if min_interval is not None else 0
+            self._write_count = count + 1
+        if level >= ERROR:
+            # Don't hang around for the next flush
+            self._urgent.set()
+            self._wakeup.set()
+        elif first:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """ Format and write out everything in the ring """
+        lines = []
+        read_count = self._read_count
+        # Records up to the write count are complete - it's only bumped once the slot's been filled in
+        write_count = self._write_count
+        for count in range(read_count, write_count):
+            slot = count % self.capacity
+            lines.append(self._format(slot))
+            # Let go of the arguments now they've been used
+            self._args[slot] = None
+        self._read_count = write_count
+        if lines:
+            stream = self.stream or sys.stdout
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    def _format(self, slot):
+        message = self._messages[slot]
+        args = self._args[slot]
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError) as e:
+                message = f"{message} {args!r} (bad log format: {e})"
+        suppressed = self._suppressed_before[slot]
+        if self.output_format == FORMAT_JSON:
+            record = {'time': self._times[slot], 'source': self.name, 'level': LEVEL_NAMES.get(self._levels[slot]),
+                      'class': self._classes[slot], 'message': message}
+            if suppressed:
+                record['suppressed'] = suppressed
+            return json.dumps(record)
+        timestamp = time.strftime('%H:%M:%S', time.localtime(self._times[slot])) + f"{self._times[slot] % 1:.3f}"[1:]
+        line = f"{timestamp} {self.name} {LEVEL_NAMES.get(self._levels[slot], self._levels[slot])} [{self._classes[slot]}] {message}"
+        if suppressed:
+            line += f" ({suppressed} more suppressed)"
+        return line
+
+    def _flush_loop(self):
+        while self._running:
+            if not self.pending:
+                # Nothing to do until something's logged
+                self._wakeup.wait()
+            # Give anything logged along with it a moment to arrive, so it all goes out together (unless it's an error,
+            # or the log's stopping)
+            self._urgent.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._urgent.clear()
+            self.flush()
+
+    @property
+    def pending(self):
+        """ Records waiting to be written out """
+        return self._write_count - self._read_count
+
+    def __str__(self):
+        return f"records: {self._write_count}, pending: {self.pending}, rate limited: {self.suppressed}, dropped (ring full): {self.dropped}"
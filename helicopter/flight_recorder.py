@@ -0,0 +1,191 @@
+"""
+Flight data recorder - a record of what the pilot saw and did on every control loop iteration.
+
+Records are fixed-width rows of little-endian float64s, appended to a file that's preallocated and memory mapped up
+front, so writing one is a copy into the map rather than a file write. The layout of a file is:
+ - A fixed size header: magic, version, row width, capacity, row count, the clock/wall times at the start, and the
+   column names (as JSON)
+ - 'capacity' rows of 'width' float64s, of which the first 'count' are valid
+
+Read a file back with read_flight_record(), or summarise one with: python flight_recorder.py <file>
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import numpy as np
+from demand_slot import DEMAND_FIELDS
+from imu_sampler import SAMPLE_WIDTH
+
+MAGIC = b'HELIFDR\0'
+VERSION = 1
+HEADER_SIZE = 4096
+# magic, version, width, capacity, count, start clock, start wall time, length of the column names JSON
+_header = struct.Struct('<8sIIQQddI')
+_count = struct.Struct('<Q')
+_count_offset = struct.calcsize('<8sIIQ')
+
+IMU_COLUMNS = ['imu_time', 'ax', 'ay', 'az', 'gx', 'gy', 'gz']
+
+
+class FlightRecorderError(Exception):
+    pass
+
+
+def flight_record_columns(output_names):
+    """ Column names for a recording of the given actuator outputs """
+    return (['time'] + list(DEMAND_FIELDS) + IMU_COLUMNS + ['pitch_angle', 'roll_angle', 'next_output_frame'] +
+            [f'output_{name}' for name in output_names])
+
+
+class FlightRecorder:
+    """
+    Appends a row per control loop iteration to a memory mapped file:
+        time, the demands being flown, the latest IMU sample, the pitch/roll estimate, when the next output frame is
+        due and the last value written to each actuator output (NaN for anything not known yet)
+    The row is assembled in a preallocated buffer (with views onto each group of columns) and copied into the map, so
+    recording doesn't allocate anything per row. Once the file's full, further rows are counted but not kept.
+    """
+
+    def __init__(self, path:str, outputs, capacity:int=360000, clock=time.monotonic):
+        """ 'outputs' is the OutputStage to record the channels of, 'capacity' is the most rows the file will hold """
+        self.path = path
+        self.outputs = outputs
+        self.output_channels = list(outputs.channels)
+        self.columns = flight_record_columns(channel.name for channel in self.output_channels)
+        self.width = len(self.columns)
+        self.capacity = capacity
+        self.count = 0
+        self.dropped = 0
+        self.row_size = 8 * self.width
+        names = json.dumps(self.columns).encode()
+        if _header.size + len(names) > HEADER_SIZE:
+            raise FlightRecorderError(f"Too many columns to fit in the flight record header: {len(self.columns)}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Preallocate the whole file, so it never has to grow mid-flight
+        with open(path, 'wb') as f:
+            f.truncate(HEADER_SIZE + capacity * self.row_size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._map[:_header.size] = _header.pack(MAGIC, VERSION, self.width, capacity, 0, clock(), time.time(), len(names))
+        self._map[_header.size:_header.size + len(names)] = names
+        # The row buffer, and views onto its column groups
+        self._row = np.full(self.width, np.nan)
+        self._row_bytes = memoryview(self._row).cast('B')
+        demands_start = 1
+        imu_start = demands_start + len(DEMAND_FIELDS)
+        attitude_start = imu_start + SAMPLE_WIDTH
+        self._next_frame_column = attitude_start + 2
+        self._outputs_start = self._next_frame_column + 1
+        self._demands = self._row[demands_start:imu_start]
+        self._imu = self._row[imu_start:attitude_start]
+        self._attitude = self._row[attitude_start:self._next_frame_column]
+        self._offset = HEADER_SIZE
+
+    def record(self, now:float, demands, imu_sample, angles):
+        """ Append a row. 'imu_sample' and 'angles' can be None if there isn't one yet """
+        if self.count >= self.capacity:
+            self.dropped += 1
+            return False
+        row = self._row
+        row[0] = now
+        self._demands[:] = demands
+        if imu_sample is None:
+            self._imu.fill(np.nan)
+        else:
+            self._imu[:] = imu_sample
+        if angles is None:
+            self._attitude.fill(np.nan)
+        else:
+            self._attitude[:] = angles
+        row[self._next_frame_column] = self.outputs.next_frame
+        column = self._outputs_start
+        for channel in self.output_channels:
+            value = channel.last_written
+            row[column] = np.nan if value is None else value
+            column += 1
+        offset = self._offset
+        self._map[offset:offset + self.row_size] = self._row_bytes
+        self._offset = offset + self.row_size
+        # Only count the row once it's all there, so a reader of a live file never sees half a row
+        self.count += 1
+        _count.pack_into(self._map, _count_offset, self.count)
+        return True
+
+    def close(self):
+        """ Flush the map and trim the file down to the rows actually recorded """
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        self._file.truncate(HEADER_SIZE + self.count * self.row_size)
+        self._file.close()
+
+    def __str__(self):
+        return f"{self.path}: {self.count} rows of {self.width} columns, dropped (file full): {self.dropped}"
+
+
+class FlightRecord:
+    """
+    A recorded flight, as a read-only (rows x columns) float64 array that's a view straight onto the mapped file.
+    Individual columns (also views) are available by name, e.g. record['gz'], record['output_tail']
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER_SIZE:
+            raise FlightRecorderError(f"Too short to be a flight record: {path}")
+        (magic, version, self.width, self.capacity, count, self.start_clock, self.start_wall_time,
+         names_length) = _header.unpack_from(self._map)
+        if magic != MAGIC:
+            raise FlightRecorderError(f"Not a flight record: {path}")
+        if version != VERSION:
+            raise FlightRecorderError(f"Unsupported flight record version {version} in {path}")
+        self.columns = json.loads(bytes(self._map[_header.size:_header.size + names_length]))
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        # A trimmed file can't be read past its end, even if the header count says otherwise
+        self.count = min(count, (len(self._map) - HEADER_SIZE) // (8 * self.width))
+        self.data = np.frombuffer(self._map, dtype='<f8', count=self.count * self.width,
+                                  offset=HEADER_SIZE).reshape(self.count, self.width)
+
+    def __getitem__(self, column):
+        return self.data[:, self.column_index[column]]
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def output_names(self):
+        return [name[len('output_'):] for name in self.columns if name.startswith('output_')]
+
+    @property
+    def duration(self):
+        return float(self.data[-1, 0] - self.data[0, 0]) if self.count else 0.0
+
+
+def read_flight_record(path:str):
+    """ Load a flight record without copying it """
+    return FlightRecord(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python flight_recorder.py <flight record file>")
+        sys.exit(1)
+    record = read_flight_record(sys.argv[1])
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.start_wall_time))
+    print(f"{record.path}: {len(record)} rows, {record.duration:.2f}s, started {started}")
+    if len(record):
+        print(f"{'column':>28}{'min':>12}{'mean':>12}{'max':>12}")
+        for name in record.columns[1:]:
+            values = record[name]
+            if np.isnan(values).all():
+                print(f"{name:>28}{'-':>12}{'-':>12}{'-':>12}")
+            else:
+                print(f"{name:>28}{np.nanmin(values):>12.4f}{np.nanmean(values):>12.4f}{np.nanmax(values):>12.4f}")
@@ -0,0 +1,112 @@
+"""
+Replays a flight record through the pilot, against the simulated actuators and as fast as it'll go.
+The recorded demands and IMU samples are fed back in, in step with the recorded loop times, and the pilot's outputs
+are recorded again so they can be compared with the originals - e.g. to check a change to the control code, or to
+see what different gains would have done (by replaying with a different config file).
+Run with: python flight_replay.py <flight record> [config_file] [replay record]
+
+The record only holds the latest IMU sample from each loop iteration, rather than every sample the sampler took in
+between, so the replayed attitude estimate (and so the swash plate) won't exactly match a live flight's.
+"""
+import os
+import sys
+import time
+import numpy as np
+# Never drive the real actuators from a replay
+os.environ['HELI_HARDWARE'] = 'sim'
+from demand_slot import DEMAND_FIELDS
+from flight_recorder import FlightRecorder, read_flight_record, IMU_COLUMNS
+from helicopter import HelicopterConfig
+from pilot import HelicopterPilot
+
+
+class ReplayClock:
+    """ Time as far as the replayed pilot is concerned - only moves when the replay moves it """
+
+    def __init__(self, now:float=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ReplayImuSource:
+    """ IMU source that returns whatever the replay last set, in place of the burst reader """
+
+    def __init__(self):
+        self.values = [0, 0, 1, 0, 0, 0]
+
+    def read_motion(self):
+        return self.values
+
+
+def replay(record, config, output_path):
+    """ Run 'record' through a pilot built from 'config', recording what it does to 'output_path'. Returns the wall time taken """
+    clock = ReplayClock(float(record['time'][0]) if len(record) else 0.0)
+    # The replay makes its own recording
+    config.recorder = {}
+    pilot = HelicopterPilot(config, clock=clock, start=False)
+    pilot.recorder = FlightRecorder(output_path, pilot.heli.outputs, capacity=max(1, len(record)), clock=clock)
+    source = ReplayImuSource()
+    pilot.imu.source = source
+    times = record['time'].tolist()
+    demands = record.data[:, [record.column_index[field] for field in DEMAND_FIELDS]].tolist()
+    imu = record.data[:, [record.column_index[column] for column in IMU_COLUMNS]].tolist()
+    # When the next servo frame was due going into each iteration (i.e. as recorded at the end of the one before), so
+    # the outputs are written on the same iterations as they were in flight
+    next_frames = [float(times[0]) if len(record) else 0.0] + record['next_output_frame'][:-1].tolist()
+    last_demands = None
+    last_imu_time = None
+    start = time.perf_counter()
+    for now, row_demands, (imu_time, *motion), next_frame in zip(times, demands, imu, next_frames):
+        if imu_time == imu_time and imu_time != last_imu_time:
+            # A new IMU sample (not NaN) - take it at the time it was originally taken
+            clock.now = imu_time
+            source.values = motion
+            pilot.imu.sample_once()
+            last_imu_time = imu_time
+        clock.now = now
+        if row_demands != last_demands:
+            pilot.update_demands(dict(zip(DEMAND_FIELDS, row_demands)))
+            last_demands = row_demands
+        pilot.heli.outputs.next_frame = next_frame
+        pilot.fly_step()
+    elapsed = time.perf_counter() - start
+    pilot.close()
+    return elapsed
+
+
+def compare_outputs(original, replayed):
+    """ Returns {output name: (largest difference, rows that differ)} between the two records' actuator outputs """
+    rows = min(len(original), len(replayed))
+    differences = {}
+    for name in original.output_names:
+        column = f'output_{name}'
+        if column not in replayed.column_index:
+            continue
+        a = original[column][:rows]
+        b = replayed[column][:rows]
+        # Treat 'not written yet' on both sides as the same
+        delta = np.where(np.isnan(a) & np.isnan(b), 0, np.abs(a - b))
+        delta = np.nan_to_num(delta, nan=np.inf)
+        differences[name] = (float(delta.max()) if rows else 0.0, int(np.count_nonzero(delta > 1e-9)))
+    return differences
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python flight_replay.py <flight record> [config_file] [replay record]")
+        sys.exit(1)
+    record_path = sys.argv[1]
+    config = HelicopterConfig(sys.argv[2]) if len(sys.argv) > 2 else HelicopterConfig()
+    output_path = sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(record_path)[0] + '.replay.fdr'
+    record = read_flight_record(record_path)
+    elapsed = replay(record, config, output_path)
+    replayed = read_flight_record(output_path)
+    speed = record.duration / elapsed if elapsed else float('inf')
+    print(f"Replayed {len(record)} rows ({record.duration:.2f}s of flight) in {elapsed:.3f}s - {speed:.0f}x real time, "
+          f"{len(record) / elapsed:.0f} loop iterations/s")
+    print(f"Replay recorded to {output_path}")
+    print(f"{'output':>12}{'max difference':>16}{'rows differing':>16}")
+    for name, (largest, rows) in compare_outputs(record, replayed).items():
+        print(f"{name:>12}{largest:>16.4f}{rows:>16}")
@@ -0,0 +1,29 @@
+"""
+Picks which hardware drivers the helicopter code talks to.
+The real pithonwy drivers are used by default. Set the environment variable HELI_HARDWARE=sim to use the simulated
+ones in sim_hardware instead, e.g. to run the pilot on a machine that isn't the heli.
+The real hardware needs pithonwy (and pigpio, for the actuators), plus smbus2 for reading the IMU in one I2C
+transaction (see imu_sampler.Mpu6050BurstReader). None of them are needed for the simulated hardware.
+
+'clock' and 'sleep' are the time the hardware runs on - real time for the real hardware, and whatever the simulator's
+been set up with (see sim_hardware) for the simulated hardware. Loops that pace themselves against the hardware
+should use these, so they keep in step with a simulation that's running faster than real time.
+"""
+import os
+import time
+
+HARDWARE_PITHONWY = 'pithonwy'
+HARDWARE_SIM = 'sim'
+
+backend = os.environ.get('HELI_HARDWARE', HARDWARE_PITHONWY)
+
+if backend == HARDWARE_SIM:
+    from sim_hardware import Motor, Servo, Gyro, ImuBurstReader, clock, sleep
+elif backend == HARDWARE_PITHONWY:
+    from pithonwy.actuators import Motor, Servo
+    from pithonwy.sensors import Gyro
+    from imu_sampler import Mpu6050BurstReader as ImuBurstReader
+    clock = time.monotonic
+    sleep = time.sleep
+else:
+    raise ImportError(f"Unknown HELI_HARDWARE backend: {backend}. Expected '{HARDWARE_PITHONWY}' or '{HARDWARE_SIM}'")
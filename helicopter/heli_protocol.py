@@ -0,0 +1,253 @@
+""" Wire format shared by the heli server and the controller """
+import json
+import struct
+import time
+
+# Handshake bytes. The controller opens the connection with the request byte for the demand encoding it would like
+# to use, and the server echoes back the request byte of the encoding it has agreed to.
+CONNECTION_REQUEST_JSON = 1
+CONNECTION_REQUEST_BINARY = 0x11
+# Once the pilot's awake (and this controller has control), the server replies to PILOT_WAKEUP_REQUEST with the same
+# byte followed by a SESSION_TOKEN_SIZE byte session token, which the controller can use to resume control (see
+# RESUME_REQUEST) if its connection drops
+PILOT_WAKEUP_REQUEST = 2
+PILOT_WAKEUP_FAILED = 0
+SESSION_TOKEN_SIZE = 8
+# Sent before waking the pilot to move the demand stream onto UDP. The server replies with the same byte followed by
+# the UDP port to send demand frames to, or DATAGRAM_UNAVAILABLE if it can't (e.g. the demands aren't binary frames)
+DATAGRAM_REQUEST = 3
+DATAGRAM_UNAVAILABLE = 0
+DATAGRAM_PORT = struct.Struct('<H')
+# Sent before waking the pilot to ask for a telemetry stream back down the TCP connection, followed by the rate (Hz)
+# the controller would like it at. The server replies with the same byte followed by the rate it'll actually send at
+# (0 if it won't send any). Telemetry frames start once the pilot's awake, straight after the wakeup reply
+TELEMETRY_REQUEST = 4
+TELEMETRY_RATE = struct.Struct('<H')
+# Opens a read-only observer connection (e.g. a ground station display) in place of a connection request, followed by
+# the telemetry rate (Hz) it would like. The server replies with the same byte, the telemetry rate it'll send at and
+# the observer's session ID - or OBSERVER_REFUSED if it's got all the observers it can take. Telemetry frames follow
+# (whenever the pilot's awake) until the observer hangs up. Anything the observer sends is ignored
+OBSERVER_REQUEST = 5
+OBSERVER_REFUSED = 0
+# Only one controller has control of the pilot at a time. If another controller sends PILOT_WAKEUP_REQUEST, the server
+# replies with CONTROL_HELD followed by the session ID of that controller's connection
+CONTROL_HELD = 6
+# Sent by the controller in control, in its demand stream (or on the TCP connection if its demands go over UDP),
+# followed by the session ID of the connection to hand control to (0 for whichever asks first). That controller then
+# takes control by sending PILOT_WAKEUP_REQUEST. Until it does, control stays where it is
+HANDOVER_REQUEST = 7
+SESSION_ID = struct.Struct('<H')
+# Sent in place of PILOT_WAKEUP_REQUEST by a controller reconnecting after its connection dropped, followed by the
+# session token it was given. If the server's still holding the pilot for that session, the new connection takes
+# control of the pilot as it is (no re-initialising) and the server replies with the same byte. Otherwise it replies
+# with RESUME_REJECTED, and the controller has to wake the pilot again
+RESUME_REQUEST = 8
+RESUME_REJECTED = 0
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_UDP = 'udp'
+
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+_encoding_request_bytes = {
+    ENCODING_JSON: CONNECTION_REQUEST_JSON,
+    ENCODING_BINARY: CONNECTION_REQUEST_BINARY,
+}
+_request_byte_encodings = {request: encoding for encoding, request in _encoding_request_bytes.items()}
+
+# The demands sent by the controller. Order matters - it sets the bit/slot each demand occupies in the binary frame
+DEMAND_BUTTONS = (
+    'stop_demand',
+    'start_demand',
+    'calibration_demand',
+    'init_connection_demand',
+    'battery_connected',
+    'request_gyro_state_demand',
+)
+DEMAND_AXES = (
+    'throttle_demand',
+    'yaw_demand',
+    'pitch_demand',
+    'roll_demand',
+)
+
+def encoding_request_byte(encoding):
+    """ Returns the handshake byte used to request 'encoding' """
+    if encoding not in _encoding_request_bytes:
+        raise ValueError(f"Unknown demand encoding: {encoding}. Expected one of {list(_encoding_request_bytes)}")
+    return _encoding_request_bytes[encoding]
+
+def request_byte_encoding(request_byte):
+    """ Returns the encoding requested by a handshake byte, or None if it isn't a connection request """
+    return _request_byte_encodings.get(request_byte)
+
+
+class DemandFrameError(ValueError):
+    pass
+
+
+class DemandFrameCodec:
+    """
+    Packs the demands dict into a fixed size binary frame, and back again.
+
+    Frame layout (little-endian, 22 bytes):
+        version        uint8
+        button flags   uint8    one bit per entry in DEMAND_BUTTONS
+        sequence       uint32   incremented for every frame sent, wrapping at 2^32
+        sent time      float64  time.time() on the controller when the frame was encoded
+        axes           4x int16 DEMAND_AXES, scaled so that +/-1 maps to +/-32767
+    """
+
+    version = 1
+    _axis_scale = 32767
+    _frame = struct.Struct('<BBId4h')
+    frame_size = _frame.size
+
+    # (demand, bit mask) pairs, worked out once rather than on every frame
+    _button_masks = tuple((button, 1 << bit) for bit, button in enumerate(DEMAND_BUTTONS))
+
+    def __init__(self):
+        self.sequence = 0
+
+    def encode(self, demands) -> bytes:
+        """ Encode the demands dict into a frame, stamping it with the next sequence number and the current time """
+        flags = 0
+        for button, mask in self._button_masks:
+            if demands.get(button):
+                flags |= mask
+        scale = self._axis_scale
+        axes = [round(scale * max(-1, min(1, demands.get(axis, 0)))) for axis in DEMAND_AXES]
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return self._frame.pack(self.version, flags, self.sequence, time.time(), *axes)
+
+    def decode(self, frame):
+        """ Decode a frame into (sequence, sent_time, demands) """
+        if len(frame) != self.frame_size:
+            raise DemandFrameError(f"Demand frame should be {self.frame_size} bytes, got {len(frame)}")
+        version, flags, sequence, sent_time, *axes = self._frame.unpack(frame)
+        if version != self.version:
+            raise DemandFrameError(f"Unsupported demand frame version: {version}")
+        demands = {button: flags & mask != 0 for button, mask in self._button_masks}
+        scale = self._axis_scale
+        for axis, value in zip(DEMAND_AXES, axes):
+            demands[axis] = value / scale
+        return sequence, sent_time, demands
+
+
+class JsonDemandCodec:
+    """ The original newline-delimited JSON encoding, kept as a fallback for controllers that don't speak the binary frame """
+
+    def encode(self, demands) -> bytes:
+        return (json.dumps(demands) + '\n').encode('utf-8')
+
+    def decode(self, line):
+        """ Decode a line into (sequence, sent_time, demands). JSON demands carry no sequence/time so these are None """
+        try:
+            return None, None, json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            raise DemandFrameError(f"Error decoding JSON demands: {e}")
+
+
+class TelemetryFrameError(ValueError):
+    pass
+
+
+class TelemetryFrameCodec:
+    """
+    Packs the heli's state into a binary telemetry frame for the controller, and back again.
+
+    Frame layout (little-endian). Frames are length prefixed, as the number of servos can vary:
+        length             uint16   of the rest of the frame
+        version            uint8
+        flags              uint8    bit 0: flying, bit 1: this connection has control, bit 2: control's been
+                                    offered to this connection (see HANDOVER_REQUEST)
+        sequence           uint32   incremented for every frame sent, wrapping at 2^32
+        server time        float64  time.time() on the heli when the frame was encoded
+        gyro rates         3x float32  x, y, z, normalised as the pilot uses them
+        attitude           2x float32  estimated pitch & roll (deg)
+        motor speed        float32  last speed written to the ESC (NaN if none yet)
+        loop iterations    uint32   control loop iterations so far
+        loop overruns      uint32   iterations that ran past their deadline
+        loop work time     float32  mean time (us) spent in each iteration
+        loop max jitter    float32  latest (us) any iteration has started
+        demand sequence    uint32   sequence number of the newest demand frame the pilot has (0 if none)
+        demand sent time   float64  sent time of that demand frame, echoed back (NaN if none)
+        demand held for    float32  seconds between that demand frame arriving and this frame being sent
+        servo count        uint8
+        servo positions    float32 each, the last position written to each swash servo then the tail servo
+
+    The controller can work out the link round trip time from the echoed demand, without the two clocks having to
+    agree: rtt = (time received - demand sent time) - demand held for
+    """
+
+    version = 1
+    _length = struct.Struct('<H')
+    _body = struct.Struct('<BBId3f2ffIIffIdfB')
+    _servo = struct.Struct('<f')
+    _flying = 1
+    _in_control = 2
+    _control_offered = 4
+
+    def __init__(self):
+        self.sequence = 0
+
+    def encode(self, flying, rates, attitude, motor_speed, loop_stats, demand_echo, servo_positions,
+               in_control=False, control_offered=False) -> bytes:
+        """
+        Encode a frame. 'loop_stats' is (iterations, overruns, mean work time (us), max jitter (us)) and 'demand_echo'
+        is (sequence, sent time, held for)
+        """
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        servo_count = len(servo_positions)
+        flags = ((self._flying if flying else 0) | (self._in_control if in_control else 0) |
+                 (self._control_offered if control_offered else 0))
+        body = self._body.pack(self.version, flags, self.sequence, time.time(), *rates,
+                               *attitude, motor_speed, *loop_stats, *demand_echo, servo_count)
+        body += struct.pack(f'<{servo_count}f', *servo_positions)
+        return self._length.pack(len(body)) + body
+
+    def frame_length(self, buffer, offset=0):
+        """ Total length of the frame starting at 'offset' in 'buffer', or None if the length prefix isn't all there yet """
+        if len(buffer) - offset < self._length.size:
+            return None
+        return self._length.size + self._length.unpack_from(buffer, offset)[0]
+
+    def decode(self, frame):
+        """ Decode a whole frame (including its length prefix) into a dict """
+        length = self.frame_length(frame)
+        if length is None or len(frame) != length or length < self._length.size + self._body.size:
+            raise TelemetryFrameError(f"Telemetry frame is the wrong size: {len(frame)} bytes")
+        (version, flags, sequence, server_time, gx, gy, gz, pitch, roll, motor_speed, iterations, overruns, work_time,
+         max_jitter, demand_sequence, demand_sent_time, demand_held, servo_count) = self._body.unpack_from(frame, self._length.size)
+        if version != self.version:
+            raise TelemetryFrameError(f"Unsupported telemetry frame version: {version}")
+        servos_offset = self._length.size + self._body.size
+        if len(frame) != servos_offset + servo_count * self._servo.size:
+            raise TelemetryFrameError(f"Telemetry frame has the wrong number of servo positions for {servo_count} servos")
+        return {
+            'sequence': sequence,
+            'server_time': server_time,
+            'flying': bool(flags & self._flying),
+            'in_control': bool(flags & self._in_control),
+            'control_offered': bool(flags & self._control_offered),
+            'gyro_rates': (gx, gy, gz),
+            'attitude': (pitch, roll),
+            'motor_speed': motor_speed,
+            'loop_iterations': iterations,
+            'loop_overruns': overruns,
+            'loop_work_time_us': work_time,
+            'loop_max_jitter_us': max_jitter,
+            'demand_sequence': demand_sequence,
+            'demand_sent_time': demand_sent_time,
+            'demand_held': demand_held,
+            'servo_positions': struct.unpack_from(f'<{servo_count}f', frame, servos_offset),
+        }
+
+
+def demand_codec(encoding):
+    """ Returns a codec instance for 'encoding' """
+    if encoding == ENCODING_BINARY:
+        return DemandFrameCodec()
+    if encoding == ENCODING_JSON:
+        return JsonDemandCodec()
+    raise ValueError(f"Unknown demand encoding: {encoding}")
@@ -1,14 +1,31 @@
 """ Class to manage listening for the input to control the helicopter """
 
-import os
-import json
 import sys
+import asyncio
 import socket
 import socketserver
 import errno
+import selectors
+import time
+from threading import Event
 from time import sleep
-from pilot import HelicopterPilot
-from pithonwy.actuators import Motor 	# Keep this so we can force the motor shutdown if the server crashes/is killed
+from pilot_session import PilotSession
+from pilot_process import pilot_stats_settings
+from heli_protocol import (ENCODING_BINARY, PILOT_WAKEUP_REQUEST, PILOT_WAKEUP_FAILED, DATAGRAM_REQUEST,
+                           DATAGRAM_UNAVAILABLE, DATAGRAM_PORT, TELEMETRY_REQUEST, TELEMETRY_RATE, OBSERVER_REQUEST,
+                           OBSERVER_REFUSED, CONTROL_HELD, HANDOVER_REQUEST, SESSION_ID, SESSION_TOKEN_SIZE,
+                           RESUME_REQUEST, RESUME_REJECTED, DemandFrameError, demand_codec, request_byte_encoding)
+from datagram_link import DatagramDemandReceiver
+from telemetry import TelemetrySender
+from helicopter import HelicopterConfig
+from stage_timing import timings, StatsEndpoint
+from startup import StartupTimeline, ensure_pigpiod
+import hardware
+from hardware import Motor 	# Keep this so we can force the motor shutdown if the server crashes/is killed
+
+_read_timer = timings.stage('server_read', "Reading a demand frame off the socket, once it's started arriving")
+_decode_timer = timings.stage('server_decode', "Decoding a demand frame")
+_dispatch_timer = timings.stage('server_dispatch', "Handing a demand frame to the pilot")
 
 class HeliServerConnectionHandler(socketserver.StreamRequestHandler):
     """
@@ -16,36 +33,81 @@ class HeliServerConnectionHandler(socketserver.StreamRequestHandler):
     It is instantiated once per connection to the server, and must
     override the handle() method to implement communication to the
     client.
+    Each connection is either a controller (which can fly the heli once it has control) or a read-only observer.
+    The pilot itself belongs to the server's PilotSession, shared between them all.
     """
 
     connection_active = False
+    datagram_receiver = None
+    # Telemetry back to the controller - off unless it asks for it, and never faster than this
+    max_telemetry_rate_hz = 100
+    telemetry_rate_hz = 0
+    telemetry = None
+    # The newest demand frame applied: (sequence, sent time, arrival time), for the telemetry to echo back
+    demand_echo = None
+    # The server's PilotSession (see HelicopterServer)
+    session = None
+    pilot = None
+    # Demand frames that arrived while another connection had control
+    ignored_demands = 0
 
     def handle(self):
+        self.session_id = self.session.new_session_id()
         # self.rfile is a file-like object created by the handler;
         # we can now use e.g. readline() instead of raw recv() calls
         connection_test_request = self.rfile.read(1)
-        if connection_test_request == bytes([1]):
-            # Send a 'connection successful' message back
-            self.wfile.write(bytes([1]))
+        if connection_test_request == bytes([OBSERVER_REQUEST]):
+            self.observe()
+            return
+        # The request byte also tells us which demand encoding the controller wants to use
+        self.encoding = request_byte_encoding(connection_test_request[0]) if connection_test_request else None
+        if self.encoding:
+            self.codec = demand_codec(self.encoding)
+            # Send a 'connection successful' message back, echoing the encoding we've agreed to
+            self.wfile.write(connection_test_request)
             self.connection_active = True
-            print("Controller connection established")
+            print(f"Controller connection established ({self.encoding} demands), session {self.session_id}")
         else:
             raise ConnectionError()
         # Wait for word that the battery is connected
         pilot_started = False
         while not pilot_started:
             battery_connection_update = self.rfile.read(1)
-            if battery_connection_update == bytes([2]):
+            if not battery_connection_update:
+                print("Controller connection closed before the pilot was woken up")
+                return
+            if battery_connection_update == bytes([DATAGRAM_REQUEST]):
+                self.open_datagram_link()
+            if battery_connection_update == bytes([TELEMETRY_REQUEST]):
+                self.agree_telemetry_rate()
+            if battery_connection_update == bytes([RESUME_REQUEST]):
+                # Reconnecting after the connection dropped - take over the pilot as it is, if it's still being held
+                token = self.rfile.read(SESSION_TOKEN_SIZE)
+                if self.session.resume(self, token):
+                    self.pilot = self.session.pilot
+                    self.wfile.write(bytes([RESUME_REQUEST]))
+                    pilot_started = True
+                    self.start_telemetry()
+                else:
+                    print(f"Session {self.session_id} couldn't resume - the pilot's not being held for it")
+                    self.wfile.write(bytes([RESUME_REJECTED]))
+            if battery_connection_update == bytes([PILOT_WAKEUP_REQUEST]):
                 # Then user claims battery is connected, so let's fire up the HeliPilot instance
                 try:
                     # If battery connected, then start up the heli instance (need the connection else the power won't be there for the Gyro, etc.)
-                    self.pilot = HelicopterPilot()
-                    # Send a 'Pilot wakeup successful' message back
-                    self.wfile.write(bytes([2]))
+                    # - unless it's already flying for another controller
+                    if not self.session.request_control(self):
+                        print(f"Session {self.session_id} asked for control, but another controller has it")
+                        self.wfile.write(bytes([CONTROL_HELD]) + SESSION_ID.pack(self.session_id))
+                        continue
+                    self.pilot = self.session.pilot
+                    # Send a 'Pilot wakeup successful' message back, with the token to resume with
+                    self.wfile.write(bytes([PILOT_WAKEUP_REQUEST]) + self.session.token)
                     pilot_started = True
+                    self.start_telemetry()
                 except OSError as e:
                     # Let the controller know that there was an issue (otherwise it'll block!)
-                    self.wfile.write(bytes([0]))
+                    self.wfile.write(bytes([PILOT_WAKEUP_FAILED]))
                     # An issue reading one of the sensors?
                     if e.args[0] == errno.EREMOTEIO:
                         # This is seen when the gyro can't start (usually because it doesn't have any power)
@@ -55,68 +117,313 @@ class HeliServerConnectionHandler(socketserver.StreamRequestHandler):
                 except ValueError as e:
                     print("Error starting Gyro. Please ensure main power battery conencted")
                     print(f"Error details: {e.args}")
-                    self.wfile.write(bytes([0]))
+                    self.wfile.write(bytes([PILOT_WAKEUP_FAILED]))
+        if self.datagram_receiver:
+            self.receive_datagram_demands()
+        else:
+            self.receive_stream_demands()
+
+    def start_telemetry(self):
+        """ Start sending telemetry back, if the controller asked for it """
+        if self.telemetry_rate_hz:
+            self.telemetry = TelemetrySender(self.pilot, self.connection.sendall, self.telemetry_rate_hz,
+                                             lambda: self.demand_echo, lambda: self.session.control_state(self))
+            self.telemetry.start()
+
+    def receive_stream_demands(self):
+        """ Read demands from the TCP connection until it closes (or goes quiet while it has control) """
+        # Only time out while in control - a controller waiting for a handover needn't send anything (and once a read
+        # has timed out, the connection can't be read from again)
+        link_timeout = None
         while self.connection_active:
-            # Read the data (raw bytes)
-            raw_data = self.rfile.readline().strip()
-            # Decode the data
-            data = raw_data.decode('utf-8')
-            # print(f"{self.client_address[0]} sent: {data}")
+            if self.session.link_timeout and (self.session.controller is self) != (link_timeout is not None):
+                link_timeout = self.session.link_timeout if self.session.controller is self else None
+                self.connection.settimeout(link_timeout)
+            # Read the data (raw bytes) - binary frames are a fixed size, JSON demands are newline-delimited
+            try:
+                # Wait for the next frame to start arriving, so only reading it gets timed (not the wait for it)
+                next_byte = self.rfile.peek(1)[:1]
+                if next_byte == bytes([HANDOVER_REQUEST]):
+                    self.rfile.read(1)
+                    self.hand_over(self.rfile.read(SESSION_ID.size))
+                    continue
+                started = _read_timer.start()
+                if self.encoding == ENCODING_BINARY:
+                    raw_data = self.rfile.read(self.codec.frame_size)
+                else:
+                    raw_data = self.rfile.readline().strip()
+                _read_timer.stop(started)
+            except ConnectionError:
+                # e.g. reset by the controller closing with telemetry it hadn't read yet - it's still gone
+                raw_data = None
+            except TimeoutError:
+                print(f"Nothing from the controller for {link_timeout}s - treating its link as down")
+                raw_data = None
+            if not raw_data:
+                # Controller has gone away, so don't keep flying on its last demands
+                print(f"Controller connection closed (session {self.session_id})")
+                break
             try:
-                demands = json.loads(data)
-                self.pilot.update_demands(demands)
-            except json.JSONDecodeError as e:
-                print("Error decoding the demands. Stopping the helicopter now")
-                self.pilot.stop_flying()
+                started = _decode_timer.start()
+                decoded = self.codec.decode(raw_data)
+                _decode_timer.stop(started)
+                self.apply_demands(*decoded)
+            except DemandFrameError as e:
+                if self.session.stop_pilot(self):
+                    print("Error decoding the demands. Stopped the helicopter")
                 print(e)
-    
+
+    def apply_demands(self, sequence, sent_time, demands):
+        """ Hand a decoded demand frame to the pilot, noting its sequence/sent time (if it has them) for the telemetry """
+        if self.session.controller is not self:
+            # Control's been handed over to another controller
+            self.ignored_demands += 1
+            return
+        if sequence is not None:
+            self.demand_echo = (sequence, sent_time, time.monotonic())
+        started = _dispatch_timer.start()
+        self.pilot.update_demands(demands)
+        _dispatch_timer.stop(started)
+        self.session.demands_applied()
+
+    def hand_over(self, session_id_bytes):
+        """ Offer control to the session in 'session_id_bytes' (0 for anyone) """
+        if len(session_id_bytes) != SESSION_ID.size:
+            return
+        session_id, = SESSION_ID.unpack(session_id_bytes)
+        if not self.session.hand_over(self, session_id):
+            print(f"Session {self.session_id} tried to hand over control, but doesn't have it")
+
+    def observe(self):
+        """ Read-only connection - send it telemetry (via the session's broadcast) until it hangs up """
+        requested_rate, = TELEMETRY_RATE.unpack(self.rfile.read(TELEMETRY_RATE.size))
+        observer = self.session.add_observer(self.connection, self.session_id)
+        if observer is None:
+            print(f"Observer connection refused - already have {self.session.max_observers}")
+            self.wfile.write(bytes([OBSERVER_REFUSED]))
+            return
+        rate = min(requested_rate, self.session.observer_rate_hz)
+        self.wfile.write(bytes([OBSERVER_REQUEST]) + TELEMETRY_RATE.pack(rate) + SESSION_ID.pack(observer.session_id))
+        print(f"Observer connected, session {observer.session_id}")
+        try:
+            # Nothing an observer sends means anything, so just wait for it to go
+            while self._recv_or_none(1024):
+                pass
+        finally:
+            self.session.remove_observer(observer)
+            print(f"Observer left. {observer}")
+
+    def agree_telemetry_rate(self):
+        """ Read the telemetry rate the controller would like, and tell it what it'll get """
+        requested_rate, = TELEMETRY_RATE.unpack(self.rfile.read(TELEMETRY_RATE.size))
+        self.telemetry_rate_hz = min(requested_rate, self.max_telemetry_rate_hz)
+        self.wfile.write(bytes([TELEMETRY_REQUEST]) + TELEMETRY_RATE.pack(self.telemetry_rate_hz))
+        print(f"Sending telemetry at {self.telemetry_rate_hz}Hz once the pilot's awake")
+
+    def open_datagram_link(self):
+        """ Set up a UDP port for the controller to send its demands to, and tell it which port that is """
+        if self.encoding != ENCODING_BINARY:
+            # Need the sequence numbers in the binary frames to be able to sort out the latest demands
+            print("Datagram demands requested, but only supported with binary demand frames")
+            self.wfile.write(bytes([DATAGRAM_UNAVAILABLE]))
+            return
+        if not self.datagram_receiver:
+            self.datagram_receiver = DatagramDemandReceiver(self.client_address[0])
+        self.wfile.write(bytes([DATAGRAM_REQUEST]) + DATAGRAM_PORT.pack(self.datagram_receiver.port))
+        print(f"Receiving demands over UDP on port {self.datagram_receiver.port} (room for about "
+              f"{self.datagram_receiver.buffered_frames} frames queued, in {self.datagram_receiver.receive_buffer_size} bytes)")
+
+    def receive_datagram_demands(self):
+        """ Apply the latest demands from the UDP link, using the TCP connection for handovers and to spot the controller leaving """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.datagram_receiver, selectors.EVENT_READ)
+            selector.register(self.connection, selectors.EVENT_READ)
+            while self.connection_active:
+                events = selector.select(self.session.link_timeout or None)
+                if not events and self.session.controller is self:
+                    print(f"Nothing from the controller for {self.session.link_timeout}s - treating its link as down")
+                    return
+                for key, _ in events:
+                    if key.fileobj is self.datagram_receiver:
+                        # (Decoding's done as the datagrams are read, so it's timed along with the read here)
+                        started = _read_timer.start()
+                        demands = self.datagram_receiver.receive_latest()
+                        _read_timer.stop(started)
+                        if demands is not None:
+                            self.apply_demands(self.datagram_receiver.last_sequence, self.datagram_receiver.last_sent_time, demands)
+                        continue
+                    command = self._recv_or_none(1)
+                    if not command:
+                        # Controller has gone away, so don't keep flying on its last demands
+                        print(f"Controller connection closed (session {self.session_id})")
+                        return
+                    if command == bytes([HANDOVER_REQUEST]):
+                        self.hand_over(self._recv_exactly(SESSION_ID.size))
+
+    def _recv_or_none(self, size):
+        """ recv() from the TCP connection, or None if it's been reset """
+        try:
+            return self.connection.recv(size)
+        except ConnectionError:
+            return None
+
+    def _recv_exactly(self, size):
+        """ 'size' bytes from the TCP connection, or fewer if it closes first """
+        data = b''
+        while len(data) < size:
+            chunk = self._recv_or_none(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
     def finish(self):
         print("Finish called")
         self.connection_active = False
-        # Ensure the motor is not spinining if the connection is lost
-        # self.pilot.stop_flying()
+        # Don't keep flying on the demands of a controller that's gone (if it was the one in control)
+        self.session.release(self)
+        if self.telemetry:
+            self.telemetry.stop()
+            print(f"Telemetry stats: {self.telemetry}")
+        if self.datagram_receiver:
+            print(f"Datagram link stats: {self.datagram_receiver.stats}")
+            self.datagram_receiver.close()
+        if self.ignored_demands:
+            print(f"Ignored {self.ignored_demands} demand frames sent without control")
+        super().finish()
 
 class HelicopterServer:
+    """
+    Accepts any number of connections at once, each handled on its own thread: the controller flying the heli,
+    controllers waiting for it to hand over control, and read-only observers.
+    The connections are accepted from an asyncio event loop waiting on the listening socket, so the server sleeps
+    until someone connects (or it's shut down) rather than checking in every so often
+    """
 
-    def __init__(self, host="0.0.0.0", port=4371):
+    def __init__(self, host="0.0.0.0", port=4371, pilot_config=None, handler=HeliServerConnectionHandler):
+        """
+        'port' 0 picks a free port (see server_address). 'pilot_config' is a HelicopterConfig, or None for the default
+        file. 'handler' is the request handler class to use for each connection
+        """
         self.host = host
         self.port = port
+        self.pilot_config = pilot_config or HelicopterConfig()
+        self.handler = handler
+        self.session = None
         # Use this to determine when to close the server
         self.running = True
+        self.server = None
+        self.stats_endpoint = None
+        # The loop serve() is running (and what stops it), and whether serve() has returned
+        self._loop = None
+        self._stop = None
+        self._served = Event()
+        self._served.set()
 
     def __enter__(self):
-        """ Check pigpiod running and start it if not. Then start listening for connections """
+        """
+        Check pigpiod running and start it if not. Then create the server, ready for serve(), and get the heli's
+        actuators ready for the pilot
+        """
+        timeline = StartupTimeline()
         # Check for pigpiod
-        self.start_pigpiod()
+        timeline.run('pigpiod', self.start_pigpiod)
         # Create the server, binding to host/port set in the settings
         print(f"Starting server on host: {self.host}, listening on port: {self.port}...")
-        self.server = socketserver.TCPServer((self.host, self.port), HeliServerConnectionHandler)
+        # All the connections share the one pilot session
+        self.session = PilotSession.from_config(self.pilot_config)
+        handler = type('SessionConnectionHandler', (self.handler,), {'session': self.session})
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), handler)
+        # Don't let a connection that's still open hold up shutting the server down
+        self.server.daemon_threads = True
+        # Only asked to accept once the loop's seen a connection waiting - if it's gone by then, don't wait for another
+        self.server.timeout = 0
+        # (Once the port's ours - no point getting the actuators ready for a server that can't start)
+        timeline.run('prewarm', self.session.prewarm, timeline)
+        print(f"Server started in {1000 * timeline.elapsed:.1f}ms:\n{timeline}")
+        # Serve the stage timings locally, if configured to
+        stats_settings = self.pilot_config.stats
+        if stats_settings.get('enabled'):
+            try:
+                self.stats_endpoint = StatsEndpoint.from_config(stats_settings).start()
+            except OSError as e:
+                # They're only diagnostics - don't let them stop the server (e.g. another server has the port)
+                print(f"WARNING: Couldn't serve the stage timings, carrying on without them: {e}")
+            else:
+                host, port = self.stats_endpoint.address
+                print(f"Stage timings at http://{host}:{port}/metrics (timing {'on' if timings.enabled else 'off'})")
+            if self.session.separate_process:
+                # The pilot's stages are timed in its own process, which serves them itself
+                pilot_stats = pilot_stats_settings(stats_settings)
+                print(f"Pilot stage timings at http://{pilot_stats.get('host', '127.0.0.1')}:{pilot_stats['port']}/metrics "
+                      f"(served by the pilot's process - the server's endpoint only has the server's stages)")
+        return self
 
-        # Activate the server; this will keep running until you
-        # interrupt the program with Ctrl-C
-        self.server.serve_forever()
+    @property
+    def server_address(self):
+        """ (host, port) the server's actually listening on """
+        return self.server.server_address
+
+    def serve(self):
+        """ Handle connections until shutdown() (or Ctrl-C) """
+        self._served.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._served.set()
+
+    async def _serve(self):
+        self._stop = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if not self.running:
+            # Shut down before it got going
+            return
+        # Each connection's handed off to a thread of its own as soon as it's accepted
+        self._loop.add_reader(self.server.fileno(), self.server.handle_request)
+        try:
+            await self._stop.wait()
+        finally:
+            self._loop.remove_reader(self.server.fileno())
+
+    def shutdown(self):
+        """ Stop serve() (from another thread), and wait for it to finish """
+        self.running = False
+        if self._loop:
+            try:
+                self._loop.call_soon_threadsafe(self._stop.set)
+            except RuntimeError:
+                # It's already finished
+                pass
+        self._served.wait()
 
     def __exit__(self, exc_type, exc_value, traceback):
         """ Called when the 'with' statement ends, so clean up the connection """
         print("Shutting down server...")
         self.running = False
-        self.server.shutdown()
-        self.server.close()
+        self.server.server_close()
+        # Don't leave the heli flying (or being held for a controller to resume) with no server
+        self.session.close()
+        if self.stats_endpoint:
+            self.stats_endpoint.stop()
 
     def start_pigpiod(self):
-        """ Start the pigpio daemon """
-        # Start the daemon but pipe the error log to /dev/null so it doesn't clutter the screen output
-        os.system("sudo pigpiod 2>/dev/null")
+        """ Start the pigpio daemon if it's not already running (not needed, or there, on the simulated hardware) """
+        if hardware.backend == hardware.HARDWARE_SIM:
+            return
+        if not ensure_pigpiod():
+            print("WARNING: Can't reach pigpiod - the actuators won't work")
 
 if __name__ == "__main__":
     try:
         print("Starting helicopter server...")
+        config = HelicopterConfig()
         while True:
             try:
-                with HelicopterServer() as server:
+                with HelicopterServer(config.server.get('ip', '0.0.0.0'), config.server.get('port', 4371), config) as server:
                     print("Server successfully started :)")
-                    while True:
-                        pass
+                    # Activate the server; this will keep running until you
+                    # interrupt the program with Ctrl-C
+                    server.serve()
             except OSError:
                 print("Error binding to port, already in use. Trying again in 5 seconds")
                 sleep(5)
@@ -1,28 +1,68 @@
-from pithonwy.actuators import Motor
-from pithonwy.actuators import Servo
-# from pithonwy.sensors import Gyro
+import hardware
+from hardware import Motor
+from hardware import Servo
+# from hardware import Gyro
 from swash_plate import SwashPlate
 from tail_servo import TailServo
+from output_stage import OutputStage
+from stage_timing import timings
+from startup import StartupTimeline
 import json
 
+_flush_timer = timings.stage('output_flush', "Sending the latest actuator positions at the servo frame")
+
 class Helicopter:
-    def __init__(self, config=None):
+    def __init__(self, config=None, clock=hardware.clock, arm=True, timeline=None):
+        """
+        With 'arm' False the motor's left unarmed, e.g. to get the actuators ready before the battery's connected -
+        arm() it once it is. 'timeline' is the StartupTimeline to record bringing up the devices on
+        """
         if not config:
             config = HelicopterConfig()
-        # Get the sensors/actuators that we will need
+        if timeline is None:
+            timeline = StartupTimeline()
+        # Get the sensors/actuators that we will need. They don't depend on each other, so bring them up together
         # # Gyro
         # self.gyro = Gyro()
-        # Main motor - arm it so it's ready for connection
-        self.motor = Motor(**config.motor)
-        self.motor.arm()
+        devices = timeline.run_parallel(motor=lambda: Motor(**config.motor),
+                                        swash_plate=lambda: SwashPlate(timeline=timeline, **config.swash_servos),
+                                        tail_servo=lambda: TailServo(**config.tail_servo))
+        # Main motor
+        self.motor = devices['motor']
         # Swash plate control
-        self.swash_plate = SwashPlate(**config.swash_servos)
+        self.swash_plate = devices['swash_plate']
         # Tail
-        self.tail = TailServo(**config.tail_servo)
+        self.tail = devices['tail_servo']
+        # Actuator writes go via the output stage, which drops repeats and sends them once per servo frame
+        self.outputs = OutputStage(config.outputs.get('frame_rate_hz', 50), clock=clock)
+        # One motor speed step = 1us of ESC pulse width
+        motor_resolution = 1 / (config.motor['esc_max_pulse_length'] - config.motor['esc_min_pulse_length'])
+        # The writes themselves (pigpio) are timed as they go out
+        self.motor_output = self.outputs.add_channel('motor', timings.timed(self.motor.set_motor_speed, 'motor_write', "Writing the motor speed"), motor_resolution)
+        self.swash_plate.attach_outputs(self.outputs, config.outputs.get('servo_resolution', 0.1))
+        self.tail_output = self.outputs.add_channel('tail', timings.timed(self.tail.set_position, 'tail_servo_write', "Writing the tail servo position"),
+                                                    config.outputs.get('servo_resolution', 0.1))
+        if arm:
+            # Arm the motor so it's ready for connection
+            timeline.run('motor_arm', self.arm)
     def arm(self):
         self.motor.arm()
+        self.outputs.invalidate(self.motor_output)
+    def set_motor_speed(self, speed:float):
+        """ Set the motor speed (0 -> 1) at the next servo frame """
+        self.outputs.set(self.motor_output, speed)
+    def set_yaw(self, amount:float):
+        """ Set the tail position for a yaw demand of 'amount' (-1 -> +1, +ve = left) at the next servo frame """
+        self.outputs.set(self.tail_output, self.tail.position_for_yaw(amount))
+    def flush_outputs(self):
+        """ Send the latest actuator positions, if a new servo frame is due """
+        started = _flush_timer.start()
+        self.outputs.flush()
+        _flush_timer.stop(started)
     def stop(self, estop=False):
         """ Stop the motor (but not instantaneously (unless E-stopping!)) """
+        # The motor's about to be driven directly, so don't let any staged speed override that
+        self.outputs.invalidate(self.motor_output)
         if estop:
             self.motor.estop()
             print("Helicopter motor E-Stop!!!")
@@ -33,6 +73,7 @@ class Helicopter:
         """ Slowly spins up the motor to the requested speed """
         print("Helicopter motor spinning up!")
         self.motor.spin_up(limit=initial_speed, stop_after_initial_spin=False)
+        self.outputs.invalidate(self.motor_output)
         print("\tMotor running")
     def level_swash(self):
         self.swash_plate.level()
@@ -47,8 +88,10 @@ class Helicopter:
     def pitch_backwards(self):
         self.swash_plate.pitch_backwards()
     def turn_more_left(self):
+        self.outputs.invalidate(self.tail_output)
         self.tail.decrement()
     def turn_more_right(self):
+        self.outputs.invalidate(self.tail_output)
         self.tail.increment()
 
 class HelicopterConfig:
@@ -68,6 +111,15 @@ class HelicopterConfig:
         self.swash_servos = conf['swash_servos']
         self.tail_servo = conf['tail_servo']
         self.gyro = conf['gyro']
+        # Optional sections
+        self.pilot = conf.get('pilot', {})
+        self.outputs = conf.get('outputs', {})
+        self.attitude = conf.get('attitude', {})
+        self.logging = conf.get('logging', {})
+        self.recorder = conf.get('recorder', {})
+        self.stats = conf.get('stats', {})
+        self.server = conf.get('server', {})
+        self.failsafe = conf.get('failsafe', {})
 
 class HelicopterConfigParseError(Exception):
     pass
@@ -0,0 +1,180 @@
+""" Background sampling of the accelerometer/gyro into a ring buffer, so the pilot never waits on the I2C bus """
+import struct
+import time
+from threading import Thread
+import numpy as np
+from loop_scheduler import FixedRateScheduler
+from stage_timing import timings
+
+# Columns of the sample buffer
+SAMPLE_TIME = 0
+SAMPLE_ACCELERATION = slice(1, 4)
+SAMPLE_RATES = slice(4, 7)
+SAMPLE_WIDTH = 7
+
+
+class Mpu6050BurstReader:
+    """
+    Reads all six axes from an MPU-6050 in a single I2C transaction (accel, temperature & gyro are contiguous
+    registers), rather than one transaction for the accelerations and another for the rates.
+    The device should already have been woken up and configured, e.g. by constructing a pithonwy Gyro. The readings
+    are scaled for whatever full scale ranges it was configured with, read back from the device when this is made.
+    Needs smbus2.
+    """
+
+    _first_data_register = 0x3B
+    # accel x/y/z, temperature, gyro x/y/z - all big-endian int16
+    _registers = struct.Struct('>7h')
+    # Full scale range settings: the FS_SEL/AFS_SEL bits (4:3) of these registers
+    _gyro_config_register = 0x1B
+    _accel_config_register = 0x1C
+    # Sensitivities at the smallest full scale ranges (+/-2g and +/-250deg/s). Each step up the range halves them
+    _acceleration_lsb_per_g = 16384
+    _gyro_lsb_per_degree_per_second = 131
+
+    def __init__(self, gyro=None, bus:int=1, address:int=0x68, gyro_normalisation_values=(1, 1, 1),
+                 acceleration_normalisation_values=(1, 1, 1)):
+        # Only import this here, as it's only available on the Pi
+        from smbus2 import SMBus
+        self.gyro = gyro
+        self.bus = SMBus(bus)
+        self.address = address
+        self.acceleration_lsb_per_g = self._acceleration_lsb_per_g / 2 ** self._full_scale_setting(self._accel_config_register)
+        self.gyro_lsb_per_degree_per_second = self._gyro_lsb_per_degree_per_second / 2 ** self._full_scale_setting(self._gyro_config_register)
+        self.scales = ([1 / (self.acceleration_lsb_per_g * value) for value in acceleration_normalisation_values] +
+                       [1 / (self.gyro_lsb_per_degree_per_second * value) for value in gyro_normalisation_values])
+
+    def _full_scale_setting(self, register:int):
+        """ The full scale range (0-3) 'register' is set to """
+        return (self.bus.read_byte_data(self.address, register) >> 3) & 0x3
+
+    def read_motion(self):
+        """ Returns the (normalised) [ax, ay, az, gx, gy, gz] """
+        raw = self._registers.unpack(bytes(self.bus.read_i2c_block_data(self.address, self._first_data_register, self._registers.size)))
+        # Skip the temperature reading in the middle
+        return [value * scale for value, scale in zip(raw[:3] + raw[4:], self.scales)]
+
+
+_read_timer = timings.stage('imu_read', "Reading the IMU (one I2C transaction)")
+
+class ImuSampler:
+    """
+    Samples an IMU source at a fixed rate on its own thread, into a preallocated ring buffer of
+    [time, ax, ay, az, gx, gy, gz] rows (time from the sampler's clock, i.e. time.monotonic() by default).
+
+    The source just needs a read_motion() method returning the six values in one go. A single thread writes to the
+    buffer, and only publishes a sample (by bumping 'count') once it's fully written, so readers never need to wait.
+    'log' is the FlightLog to report to from the sampler thread (without one, it prints)
+    """
+
+    def __init__(self, source, rate_hz:float=500, buffer_size:int=1024, calibration_samples:int=500,
+                 clock=time.monotonic, sleep=time.sleep, log=None):
+        self.source = source
+        self.log = log
+        self.buffer = np.zeros((buffer_size, SAMPLE_WIDTH))
+        self.buffer_size = buffer_size
+        # Total number of samples written. The latest one is at row (count - 1) % buffer_size
+        self.count = 0
+        self.clock = clock
+        self.scheduler = FixedRateScheduler(rate_hz, clock=clock, sleep=sleep)
+        # Gyro bias, subtracted from the rates once calibrated
+        self.rate_offsets = np.zeros(3)
+        self.calibration_samples = calibration_samples
+        self._calibration_sum = None
+        self._calibration_count = 0
+        self.calibrating = False
+        # Counters
+        self.reads = 0
+        self.read_errors = 0
+        self.last_error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.scheduler.run, args=(self.sample_once, lambda: self.running), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def request_calibration(self):
+        """ Average the next lot of samples to find the gyro bias. The IMU needs to be kept still while this happens """
+        if not self.calibrating:
+            self._calibration_sum = np.zeros(3)
+            self._calibration_count = 0
+            self.calibrating = True
+
+    def sample_once(self):
+        """ Take a single sample. Called by the sampler thread - or directly, to drive the sampler from a simulation """
+        self.reads += 1
+        started = _read_timer.start()
+        try:
+            values = self.source.read_motion()
+        except IOError as e:
+            self.read_errors += 1
+            self.last_error = e
+            return
+        _read_timer.stop(started)
+        row = self.buffer[self.count % self.buffer_size]
+        row[SAMPLE_TIME] = self.clock()
+        row[1:] = values
+        if self.calibrating:
+            self._calibrate_with(row[SAMPLE_RATES])
+        row[SAMPLE_RATES] -= self.rate_offsets
+        # Publish the sample now it's complete
+        self.count += 1
+
+    def _calibrate_with(self, rates):
+        self._calibration_sum += rates
+        self._calibration_count += 1
+        if self._calibration_count >= self.calibration_samples:
+            self.rate_offsets = self._calibration_sum / self._calibration_count
+            self.calibrating = False
+            if self.log:
+                self.log.info('imu', "IMU calibrated. Gyro offsets: %s", self.rate_offsets)
+            else:
+                print(f"IMU calibrated. Gyro offsets: {self.rate_offsets}")
+
+    def latest(self):
+        """ Returns a copy of the latest [time, ax, ay, az, gx, gy, gz] sample, or None if there isn't one yet """
+        count = self.count
+        if not count:
+            return None
+        return self.buffer[(count - 1) % self.buffer_size].copy()
+
+    def window(self, samples:int):
+        """ Returns a copy of (up to) the last 'samples' samples, oldest first """
+        return self.samples_since(self.count - samples)[0]
+
+    def samples_since(self, previous_count:int):
+        """
+        Returns (samples, count): a copy of the samples taken since the sampler's count was 'previous_count' (oldest
+        first), and the count to pass in next time. Limited to the most recent half of the buffer, so the writer
+        can't lap the rows being copied
+        """
+        count = self.count
+        start = max(previous_count, count - self.buffer_size // 2, 0)
+        rows = np.arange(start, count) % self.buffer_size
+        return self.buffer[rows], count
+
+    @property
+    def sample_age(self):
+        """ Seconds since the latest sample was taken (infinite if there isn't one) """
+        latest = self.latest()
+        return float('inf') if latest is None else self.clock() - latest[SAMPLE_TIME]
+
+    @property
+    def dropped_reads(self):
+        """ Samples that were never taken because the sampler fell behind its schedule """
+        return self.scheduler.stats.skipped_ticks
+
+    @property
+    def error_rate(self):
+        return self.read_errors / self.reads if self.reads else 0.0
+
+    def __str__(self):
+        return (f"samples: {self.count}, read errors: {self.read_errors} ({100 * self.error_rate:.2f}%), "
+                f"dropped reads: {self.dropped_reads}, latest sample age: {1000 * self.sample_age:.1f}ms")
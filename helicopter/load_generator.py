@@ -0,0 +1,241 @@
+"""
+Headless stand-in for any number of controllers, to load a heli server up without flying it. Each session is a real
+ControllerConnection - the same handshake bytes and demand frames as the controller sends - streaming demands at a
+fixed rate (up to thousands a second) from a stick profile:
+ - synthetic: the sticks moving smoothly about (sweeping each axis at a few made up rates, different per session)
+ - recorded: the demands from a flight record (see flight_recorder), replayed in step with its clock, on a loop
+Only one controller flies the pilot at a time (see PilotSession), so the sessions join in turn: each asks for
+control, is told it's held, and the session in control hands it over. The session handing over streams on - the
+server still reads and decodes its frames, it just doesn't fly them - so every session's stream loads the server, and
+the last to join flies the pilot.
+Run against a server with: python load_generator.py <host> <port> [sessions] [rate_hz] [seconds] [flight record]
+"""
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from threading import Event, Thread
+import numpy as np
+from demand_slot import DEMAND_FIELDS
+from flight_recorder import read_flight_record
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+# A session that falls this far behind its schedule (s) drops the frames it's missed, rather than bursting them out
+MAX_BEHIND = 0.1
+
+
+class SyntheticSticks:
+    """ Sticks moving smoothly about: each axis a sum of a couple of sine sweeps, at rates picked by 'seed' """
+
+    # Axis: (centre, amplitude of each sweep)
+    _axes = {'throttle_demand': (0.5, 0.15), 'yaw_demand': (0.0, 0.3), 'pitch_demand': (0.0, 0.3),
+             'roll_demand': (0.0, 0.3)}
+
+    def __init__(self, seed:int=0):
+        rng = random.Random(seed)
+        # Axis: [(centre, amplitude, angular frequency, phase)...]
+        self.sweeps = {axis: [(centre / 2, amplitude, 2 * math.pi * rng.uniform(0.05, 2), rng.uniform(0, 2 * math.pi))
+                              for _ in range(2)]
+                       for axis, (centre, amplitude) in self._axes.items()}
+        self.demands = {'start_demand': True, 'stop_demand': False}
+
+    def __call__(self, t:float):
+        """ The demands 't' s in """
+        demands = self.demands
+        for axis, sweeps in self.sweeps.items():
+            demands[axis] = sum(centre + amplitude * math.sin(frequency * t + phase)
+                                for centre, amplitude, frequency, phase in sweeps)
+        return demands
+
+    def __str__(self):
+        return "synthetic sticks"
+
+
+class RecordedSticks:
+    """ The demands from a flight record, as they were 't' s into the flight (looping back to the start at its end) """
+
+    def __init__(self, path:str):
+        record = read_flight_record(path)
+        if len(record) < 2:
+            raise ValueError(f"Flight record {path} is too short to replay the sticks from")
+        self.path = path
+        self.times = np.array(record['time']) - record['time'][0]
+        self.duration = float(self.times[-1])
+        # (Copied out of the record's map, so it can go)
+        self.rows = [dict(zip(DEMAND_FIELDS, (float(value) for value in row)))
+                     for row in np.nan_to_num(np.column_stack([record[field] for field in DEMAND_FIELDS]))]
+
+    def __call__(self, t:float):
+        return self.rows[max(0, int(np.searchsorted(self.times, t % self.duration, 'right')) - 1)]
+
+    def __str__(self):
+        return f"{self.path} ({self.duration:.1f}s, looped)"
+
+
+class LoadSession:
+    """
+    One stand-in controller: a ControllerConnection streaming demands from 'sticks' at 'rate_hz', on a thread of its
+    own. It keeps to a fixed schedule, so the rate holds on average even if a send's held up - unless it gets more
+    than MAX_BEHIND behind, when the frames it's missed are dropped (and counted in 'missed')
+    """
+
+    def __init__(self, config_file:str, sticks, rate_hz:float):
+        self.connection = ControllerConnection(config_file)
+        self.sticks = sticks
+        self.rate_hz = rate_hz
+        self.frames_sent = 0
+        self.missed = 0
+        self.error = None
+        self._hand_over = Event()
+        self._handed_over = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def connect(self):
+        """ Connect and ask for control. Returns True if it has control, False if another session has """
+        self.connection._open_socket()
+        if not self.connection.init_connection():
+            raise ConnectionError("Heli server didn't agree to the connection")
+        return self.connection.set_battery_connected()
+
+    def take_control(self, timeout:float=5):
+        """ Ask for control until it's handed over, for up to 'timeout' s """
+        give_up = time.monotonic() + timeout
+        while not self.connection.set_battery_connected():
+            if time.monotonic() > give_up:
+                raise TimeoutError(f"Control wasn't handed over in {timeout}s")
+            time.sleep(0.01)
+
+    def start(self):
+        self._thread = Thread(target=self._stream, name='load_session', daemon=True)
+        self._thread.start()
+
+    def hand_over(self, timeout:float=5):
+        """ Offer control to whoever asks first, between frames (the connection's only sent on from its thread) """
+        self._hand_over.set()
+        if not self._handed_over.wait(timeout):
+            raise TimeoutError(f"Session didn't hand over in {timeout}s")
+
+    def _stream(self):
+        period = 1 / self.rate_hz
+        send = self.connection.send_input_demands
+        sticks = self.sticks
+        clock = time.monotonic
+        started = clock()
+        due = started
+        try:
+            while not self._stop.is_set():
+                now = clock()
+                if now < due:
+                    time.sleep(due - now)
+                elif now - due > MAX_BEHIND:
+                    missed = int((now - due) / period)
+                    self.missed += missed
+                    due += missed * period
+                if self._hand_over.is_set():
+                    self._hand_over.clear()
+                    self.connection.hand_over(0)
+                    self._handed_over.set()
+                send(sticks(due - started))
+                self.frames_sent += 1
+                due += period
+        except OSError as e:
+            self.error = e
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with redirect_stdout(None):
+            self.connection._close_socket()
+
+
+class LoadGenerator:
+    """
+    'sessions' LoadSessions against the heli server at host:port, each sending 'rate_hz' demand frames a second from
+    'sticks' (SyntheticSticks, a different set per session, if None). 'encoding'/'transport' are as the controller's
+    config. With 'quiet', the connections' chatter is kept off the screen
+    """
+
+    def __init__(self, host:str, port:int, sessions:int=1, rate_hz:float=100, sticks=None, encoding:str='binary',
+                 transport:str='tcp', quiet:bool=True):
+        self.host = host
+        self.port = port
+        self.session_count = sessions
+        self.rate_hz = rate_hz
+        self.sticks = sticks
+        self.encoding = encoding
+        self.transport = transport
+        self.quiet = quiet
+        self.sessions = []
+        self.started = None
+
+    def start(self):
+        """ Connect the sessions (in turn, each taking control from the last - see above) and start them streaming """
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': self.host, 'server_port': self.port, 'demand_encoding': self.encoding,
+                       'demand_transport': self.transport}, conf_file)
+        try:
+            with redirect_stdout(None if self.quiet else sys.stdout):
+                for i in range(self.session_count):
+                    session = LoadSession(conf_file.name, self.sticks or SyntheticSticks(i), self.rate_hz)
+                    if not session.connect():
+                        self.sessions[-1].hand_over()
+                        session.take_control()
+                    session.start()
+                    self.sessions.append(session)
+        finally:
+            os.unlink(conf_file.name)
+        self.started = time.monotonic()
+        return self
+
+    def stop(self):
+        for session in self.sessions:
+            session.stop()
+
+    @property
+    def frames_sent(self):
+        return sum(session.frames_sent for session in self.sessions)
+
+    @property
+    def missed(self):
+        """ Frames the sessions couldn't send on time (so weren't sent) - the load asked for wasn't offered """
+        return sum(session.missed for session in self.sessions)
+
+    @property
+    def errors(self):
+        """ Sessions whose connection failed """
+        return [session.error for session in self.sessions if session.error is not None]
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return (f"{len(self.sessions)} sessions at {self.rate_hz:g}Hz: frames sent: {self.frames_sent} "
+                f"({self.frames_sent / elapsed if elapsed else 0:.0f}/s), missed: {self.missed}, "
+                f"failed connections: {len(self.errors)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python load_generator.py <host> <port> [sessions] [rate_hz] [seconds] [flight record]")
+        sys.exit(1)
+    sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    rate_hz = float(sys.argv[4]) if len(sys.argv) > 4 else 100
+    seconds = float(sys.argv[5]) if len(sys.argv) > 5 else 10
+    sticks = RecordedSticks(sys.argv[6]) if len(sys.argv) > 6 else None
+    generator = LoadGenerator(sys.argv[1], int(sys.argv[2]), sessions, rate_hz, sticks).start()
+    print(f"Streaming {sticks or 'synthetic sticks'} to {sys.argv[1]}:{sys.argv[2]}")
+    try:
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            time.sleep(min(1, end - time.monotonic()))
+            print(generator)
+    finally:
+        generator.stop()
+    print(generator)
+    sys.exit(1 if generator.errors else 0)
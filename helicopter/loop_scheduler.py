@@ -0,0 +1,90 @@
+""" Fixed-rate scheduler for running the control loop against absolute deadlines """
+import math
+import time
+
+class LoopStats:
+    """ Timing statistics for a scheduled loop. All times are in seconds """
+
+    # Upper edges of the wakeup jitter histogram bins (microseconds). Anything later lands in the final overflow bin
+    jitter_bin_edges_us = (50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.iterations = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.total_work_time = 0.0
+        self.max_work_time = 0.0
+        self.last_work_time = 0.0
+        self.max_jitter = 0.0
+        self.jitter_histogram = [0] * (len(self.jitter_bin_edges_us) + 1)
+
+    def record(self, jitter, work_time):
+        self.iterations += 1
+        self.last_work_time = work_time
+        self.total_work_time += work_time
+        if work_time > self.max_work_time:
+            self.max_work_time = work_time
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+        jitter_us = jitter * 1e6
+        for i, edge in enumerate(self.jitter_bin_edges_us):
+            if jitter_us < edge:
+                self.jitter_histogram[i] += 1
+                break
+        else:
+            self.jitter_histogram[-1] += 1
+
+    @property
+    def mean_work_time(self):
+        return self.total_work_time / self.iterations if self.iterations else 0.0
+
+    def histogram_str(self):
+        labels = [f"<{edge}us" for edge in self.jitter_bin_edges_us] + [f">={self.jitter_bin_edges_us[-1]}us"]
+        return ", ".join(f"{label}: {count}" for label, count in zip(labels, self.jitter_histogram))
+
+    def __str__(self):
+        return (f"iterations: {self.iterations}, overruns: {self.overruns}, skipped ticks: {self.skipped_ticks}, "
+                f"work time mean/max: {1e6 * self.mean_work_time:.0f}/{1e6 * self.max_work_time:.0f}us, "
+                f"max jitter: {1e6 * self.max_jitter:.0f}us")
+
+
+class FixedRateScheduler:
+    """
+    Runs a step function at a fixed rate, against absolute deadlines on a monotonic clock so that timing errors
+    don't accumulate. If a step overruns its period, the ticks it overran are skipped rather than run back-to-back
+    to catch up - the loop just picks up again at the next tick on the original schedule.
+
+    'clock' and 'sleep' can be swapped out (e.g. for a simulated clock) so the loop can be run faster than real time.
+    """
+
+    def __init__(self, rate_hz:float, clock=time.monotonic, sleep=time.sleep):
+        if rate_hz <= 0:
+            raise ValueError(f"Loop rate must be > 0 Hz, got {rate_hz}")
+        self.rate_hz = rate_hz
+        self.period = 1 / rate_hz
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = LoopStats()
+
+    def run(self, step, keep_running):
+        """ Call step() once per period for as long as keep_running() returns True """
+        clock = self.clock
+        period = self.period
+        stats = self.stats
+        tick = clock()
+        while keep_running():
+            wakeup = clock()
+            step()
+            finished = clock()
+            stats.record(wakeup - tick, finished - wakeup)
+            tick += period
+            if finished > tick:
+                # Overran into the next tick (or further). Skip whatever we've missed rather than bursting to catch up
+                stats.overruns += 1
+                missed = math.floor((finished - tick) / period) + 1
+                stats.skipped_ticks += missed
+                tick += missed * period
+            self.sleep(max(0, tick - clock()))
@@ -0,0 +1,85 @@
+""" Output layer between the helicopter and its actuators, to cut out pointless pulse-width writes """
+import time
+
+class OutputChannel:
+    """ One actuator output. Created through OutputStage.add_channel() """
+    __slots__ = ['name', 'write', 'resolution', 'last_written', 'pending']
+
+    def __init__(self, name, write, resolution):
+        self.name = name
+        self.write = write
+        self.resolution = resolution
+        self.last_written = None
+        self.pending = None
+
+
+class OutputStage:
+    """
+    Caches the last value written to each actuator, and batches up writes to go out once per servo frame.
+
+    Servos (and ESCs) only pick up a new pulse width once per frame (~50Hz), so there's no point writing to them more
+    often than that. Values set between frames just replace each other, and when the frame comes round only the latest
+    value for each channel is written - and only if it's moved by at least the channel's resolution (roughly one
+    microsecond of pulse width) since the last write.
+    """
+
+    def __init__(self, frame_rate_hz:float=50, clock=time.monotonic):
+        self.frame_period = 1 / frame_rate_hz
+        self.clock = clock
+        self.channels = []
+        self.next_frame = clock()
+        # Counters
+        self.writes_requested = 0
+        self.writes_issued = 0
+        self.writes_suppressed = 0
+        self.writes_coalesced = 0
+
+    def add_channel(self, name, write, resolution:float):
+        """ Add an output which is written to by calling write(value) """
+        channel = OutputChannel(name, write, resolution)
+        self.channels.append(channel)
+        return channel
+
+    def set(self, channel, value):
+        """ Stage 'value' to be written to 'channel' at the next frame """
+        self.writes_requested += 1
+        if channel.pending is not None:
+            self.writes_coalesced += 1
+        channel.pending = value
+
+    def flush(self, force=False):
+        """ Write out any staged values if a new frame is due (or straight away if 'force'd) """
+        now = self.clock()
+        if not force and now < self.next_frame:
+            return False
+        for channel in self.channels:
+            value = channel.pending
+            if value is None:
+                continue
+            channel.pending = None
+            # Quantise to what the actuator can actually tell apart
+            value = round(value / channel.resolution) * channel.resolution
+            if value == channel.last_written:
+                self.writes_suppressed += 1
+                continue
+            channel.write(value)
+            channel.last_written = value
+            self.writes_issued += 1
+        # Stay on the frame grid, unless we've fallen more than a frame behind it
+        self.next_frame += self.frame_period
+        if self.next_frame <= now:
+            self.next_frame = now + self.frame_period
+        return True
+
+    def invalidate(self, *channels):
+        """
+        Forget what was last written to 'channels' (or all channels if none given), and drop anything staged for
+        them. For when the actuator's been moved by something other than this output stage
+        """
+        for channel in channels or self.channels:
+            channel.last_written = None
+            channel.pending = None
+
+    def __str__(self):
+        return (f"writes requested: {self.writes_requested}, issued: {self.writes_issued}, "
+                f"suppressed (unchanged): {self.writes_suppressed}, coalesced (within a frame): {self.writes_coalesced}")
@@ -0,0 +1,49 @@
+""" General purpose PID controller """
+
+class PIDController:
+    """
+    PID controller with:
+     - Output limits, with anti-windup: the integral stops accumulating while the output is saturated in the same
+       direction as the error (and is itself clamped to the output range)
+     - Derivative on the measurement rather than the error, so a step in the setpoint doesn't kick the output
+     - A first order low-pass filter on the derivative, to stop it amplifying sensor noise
+    """
+
+    def __init__(self, kp:float, ki:float=0, kd:float=0, output_limits=(-1, 1), derivative_time_constant:float=0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_min, self.output_max = output_limits
+        self.derivative_time_constant = derivative_time_constant
+        self.reset()
+
+    @classmethod
+    def from_config(cls, settings, **defaults):
+        """ Build a controller from a config dict (kp, ki, kd, output_limits, derivative_time_constant) """
+        return cls(**{**defaults, **settings})
+
+    def reset(self):
+        """ Forget the integral and derivative history, e.g. when the controller's been out of the loop for a while """
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.last_measurement = None
+        self.output = 0.0
+
+    def update(self, setpoint:float, measurement:float, dt:float):
+        """ Returns the controller output for this time step. 'dt' is the time (s) since the last update """
+        error = setpoint - measurement
+        if self.last_measurement is not None and dt > 0:
+            raw_derivative = (self.last_measurement - measurement) / dt
+            # Low-pass filter - a time constant of 0 means no filtering
+            self.derivative += dt / (self.derivative_time_constant + dt) * (raw_derivative - self.derivative)
+        self.last_measurement = measurement
+        proportional = self.kp * error
+        derivative = self.kd * self.derivative
+        output = proportional + self.integral + derivative
+        # Anti-windup - only integrate if it won't push the output further into saturation
+        if not ((output >= self.output_max and error > 0) or (output <= self.output_min and error < 0)):
+            self.integral += self.ki * error * dt
+            self.integral = max(self.output_min, min(self.output_max, self.integral))
+            output = proportional + self.integral + derivative
+        self.output = max(self.output_min, min(self.output_max, output))
+        return self.output
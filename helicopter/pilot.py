@@ -1,7 +1,25 @@
 """ Class to manage the demands and convert them into actual inputs for the Helicopter """
-from helicopter import Helicopter
-from threading import Thread
-from pithonwy.sensors import Gyro
+from helicopter import Helicopter, HelicopterConfig
+from threading import Thread, Lock
+import hardware
+from hardware import Gyro, ImuBurstReader
+from loop_scheduler import FixedRateScheduler
+from imu_sampler import ImuSampler, SAMPLE_ACCELERATION, SAMPLE_RATES
+from attitude import AttitudeEstimator, AttitudeController
+from pid import PIDController
+from flight_log import FlightLog
+from flight_recorder import FlightRecorder
+import math
+import time
+from demand_slot import DemandSlot, DEMAND_FIELDS, DEMAND_INDEX, demand_record
+from demand_dispatch import DemandDispatcher
+from stage_timing import timings
+from startup import StartupTimeline
+
+_step_timer = timings.stage('pilot_step', "One iteration of the pilot's control loop")
+_demands_timer = timings.stage('pilot_demands', "Picking up new demands, and acting on the stop/throttle")
+_attitude_timer = timings.stage('pilot_attitude', "Updating the attitude estimate and the swash plate")
+_yaw_timer = timings.stage('pilot_yaw', "Yaw rate control")
 
 class HelicopterPilot:
 
@@ -10,20 +28,102 @@ class HelicopterPilot:
 
     # Thresholds
     _min_throttle = 0.3
-    _yaw_threshold = 0.1
 
-    def __init__(self):
+    # Where each demand lives in the demand record
+    _throttle = DEMAND_INDEX['throttle_demand']
+    _yaw = DEMAND_INDEX['yaw_demand']
+    _pitch = DEMAND_INDEX['pitch_demand']
+    _roll = DEMAND_INDEX['roll_demand']
+    _request_gyro_state = DEMAND_INDEX['request_gyro_state_demand']
+
+    # Control loop & IMU sample rates, if not set in the config
+    _default_loop_rate_hz = 200
+    _default_imu_sample_rate_hz = 500
+
+    def __init__(self, config=None, clock=hardware.clock, sleep=hardware.sleep, start=True, heli=None, timeline=None):
+        """
+        'clock'/'sleep' are what the control loop, IMU sampler and output stage run on - by default, the hardware's
+        time. With 'start' False, the control loop and IMU sampler threads aren't started, so whatever's driving the
+        pilot (e.g. a replay) can call fly_step() and imu.sample_once() itself.
+        'heli' is a Helicopter to fly that's already been made (e.g. unarmed, ahead of the battery being connected),
+        rather than making a new one. 'timeline' is the StartupTimeline to record waking up on
+        """
+        if timeline is None:
+            timeline = StartupTimeline()
+        self.timeline = timeline
+        if not config:
+            config = timeline.run('config', HelicopterConfig)
+        self.clock = clock
+        # Log from the control loop without waiting on the terminal. Dumping the gyro state every tick would swamp it
+        self.log = FlightLog.from_config(config.logging, name='pilot', rate_limits_hz={'gyro_state': 5}).start()
+        # The helicopter's actuators and the IMU don't depend on each other, so bring them up together
+        def wake_actuators():
+            if heli is None:
+                return Helicopter(config, clock=clock, timeline=timeline)
+            timeline.run('motor_arm', heli.arm)
+            return heli
+        def wake_imu():
+            # Gyro - how we sense the difference between the demand and the reality
+            gyro = timeline.run('gyro', lambda: Gyro(normalise_rates=True,gyro_normalisation_values=self._gyro_normalisation_values,acceleration_normalisation_values=[1,1,1]))
+            imu_source = timeline.run('imu_reader', lambda: ImuBurstReader(gyro, bus=config.gyro.get('i2c_bus', 1), address=config.gyro.get('i2c_address', 0x68),
+                                                                           gyro_normalisation_values=self._gyro_normalisation_values, acceleration_normalisation_values=[1,1,1]))
+            return gyro, imu_source
+        woken = timeline.run_parallel(actuators=wake_actuators, imu=wake_imu)
         # Get the helicopter instance
-        self.heli = Helicopter()
-        # Gyro - how we sense the difference between the demand and the reality
-        self.gyro = Gyro(normalise_rates=True,gyro_normalisation_values=self._gyro_normalisation_values,acceleration_normalisation_values=[1,1,1])
-        # Init the demands variable
-        self.demands = None
+        self.heli = woken['actuators']
+        # The actuator outputs the telemetry reports - the motor, then the swash servos, then the tail
+        self._telemetry_outputs = [self.heli.motor_output] + self.heli.swash_plate.output_channels + [self.heli.tail_output]
+        self.gyro, imu_source = woken['imu']
+        # Sample it in the background, so the control loop never waits on the I2C bus
+        imu_sample_rate_hz = config.gyro.get('sample_rate_hz', self._default_imu_sample_rate_hz)
+        self.imu = ImuSampler(imu_source, rate_hz=imu_sample_rate_hz, clock=clock, sleep=sleep, log=self.log)
+        if start:
+            self.imu.start()
+        self._imu_count = 0
+        # Pitch & roll stabilisation - work out the attitude from the IMU, and steer it towards the stick demands
+        self.attitude = AttitudeEstimator(imu_sample_rate_hz, config.attitude.get('filter_time_constant', 0.5),
+                                          rate_scales=(self._gyro_normalisation_values[1], self._gyro_normalisation_values[0]))
+        self.attitude_controller = AttitudeController(**config.attitude.get('stabilisation', {}))
+        # Yaw rate - drive the tail to hold the demanded rate of turn
+        self.yaw_controller = PIDController.from_config(config.gyro.get('yaw_rate_pid', {}), kp=2.0)
+        self._last_step_time = None
+        # The server thread publishes the demands into the slot, and the pilot thread reads them out into its own record.
+        # The slot only takes one writer at a time - the lock's for when the failsafe steps in from its own thread
+        self.demand_slot = DemandSlot()
+        self._publish_lock = Lock()
+        self.demands = demand_record()
+        self.demands_generation = None
+        # What to do as each demand changes. The rest (the connection/battery buttons, and start & calibrate, which
+        # update_demands() deals with) never need looking at in the control loop
+        self.dispatcher = DemandDispatcher({
+            'stop_demand': self._stop_changed,
+            'request_gyro_state_demand': self._request_gyro_state_changed,
+            'throttle_demand': self._throttle_changed,
+            'yaw_demand': self._yaw_changed,
+            'pitch_demand': self._pitch_changed,
+            'roll_demand': self._roll_changed,
+        })
+        # The stick demands, as last handed over by the dispatcher
+        self.throttle_demand = 0.0
+        self.yaw_demand = 0.0
+        self.pitch_demand = 0.0
+        self.roll_demand = 0.0
+        self.show_gyro_state = False
+        self._was_flying = False
         self.flying = False
         self.thread_running = True
+        # Run the control loop at a fixed rate, rather than as fast as the gyro can be read
+        self.scheduler = FixedRateScheduler(config.pilot.get('loop_rate_hz', self._default_loop_rate_hz), clock=clock, sleep=sleep)
+        # Record what happens on every loop iteration, if there's somewhere to put it
+        self.recorder = None
+        if config.recorder.get('enabled', False):
+            self.recorder = timeline.run('flight_recorder', lambda: FlightRecorder(time.strftime(config.recorder.get('path', 'flight_records/flight_%Y%m%d_%H%M%S.fdr')),
+                                                                                   self.heli.outputs, config.recorder.get('capacity', 360000), clock=clock))
+        self.log.info('startup', "Woken up in %.1fms:\n%s", 1000 * timeline.elapsed, timeline)
         # Create a thread for this to run in
         self.pilot_thread = Thread(target=self.fly, daemon=True)
-        self.pilot_thread.start()
+        if start:
+            self.pilot_thread.start()
 
     def update_demands(self, demands):
         """ Update the helicopter's input demands"""
@@ -36,62 +136,157 @@ class HelicopterPilot:
                         self.heli.start_motor()
                         self.flying = True
                 if 'calibration_demand' in demands and demands['calibration_demand']:
-                    # Then we want to calibrate - the gyro class will prevent us from running this multiple times, so just call calibrate() while the button is down
-                    self.gyro.calibrate()
+                    # Then we want to calibrate - the sampler ignores requests while it's already calibrating, so just ask while the button is down
+                    self.imu.request_calibration()
+
+            with self._publish_lock:
+                self.demand_slot.publish(demands)
 
-            self.demands = demands
+    def hold(self, cut_collective=False):
+        """
+        Fly on without a controller (e.g. while its link's down): level off and stop turning, keeping the collective
+        where it was - or, with 'cut_collective', taking it off to come down
+        """
+        with self._publish_lock:
+            demands = demand_record()
+            self.demand_slot.read_into(demands)
+            for axis in (self._yaw, self._pitch, self._roll, self._request_gyro_state):
+                demands[axis] = 0
+            if cut_collective:
+                demands[self._throttle] = 0
+            self.demand_slot.publish(dict(zip(DEMAND_FIELDS, demands)))
+        if cut_collective:
+            self.log.warning('link', "No controller - levelling off and cutting the collective")
+        else:
+            self.log.warning('link', "No controller - levelling off and holding the collective at %.2f", demands[self._throttle])
 
-    def fly(self):
-        while self.thread_running:
+    def health(self):
+        """ (control loop iterations so far, age of the latest IMU sample (s)) - for a watchdog to see it's all still going """
+        return self.scheduler.stats.iterations, self.imu.sample_age
+
+    def fly(self, step=None):
+        """ Run the control loop until stop_flying() is called. 'step' is run each iteration instead of fly_step() (e.g. to wrap it) """
+        self.scheduler.run(step or self.fly_step, lambda: self.thread_running)
+        self.log.info('stats', "Pilot loop stopped. %s", self.scheduler.stats)
+        self.log.info('stats', "Loop jitter histogram: %s", self.scheduler.stats.histogram_str())
+        self.log.info('stats', "Actuator outputs: %s", self.heli.outputs)
+        self.log.info('stats', "IMU sampler: %s", self.imu)
+        if timings.enabled:
+            self.log.info('stats', "Stage timings: %s", timings)
+        self.close()
+
+    def close(self):
+        """ Finish off the flight record and the log, once the control loop has stopped """
+        if self.recorder:
+            self.recorder.close()
+            self.log.info('stats', "Flight record: %s", self.recorder)
+        self.log.info('stats', "Log: %s", self.log)
+        # Write out whatever's left
+        self.log.stop()
+
+    def fly_step(self):
+        """ One iteration of the control loop """
+        step_started = _step_timer.start()
+        if self.flying:
+            # Time since the last iteration we flew (none on the first one), for the controllers
+            now = self.clock()
+            dt = now - self._last_step_time if self._last_step_time is not None else 0
+            self._last_step_time = now
+            # Latest accelerations/rates from the sampler - doesn't wait for the sensor
+            sample = self.imu.latest()
+            if sample is None:
+                # Nothing from the IMU yet
+                accelerations = [0,0,0]
+                gyro_rates = [0,0,0]
+            else:
+                accelerations = sample[SAMPLE_ACCELERATION]
+                gyro_rates = sample[SAMPLE_RATES]
+            # Get a consistent copy of the latest demands, and act on whichever have changed - only if there's a new
+            # set (or we've only just started flying, so haven't acted on any of them yet)
+            started = _demands_timer.start()
+            generation = self.demand_slot.read_if_changed(self.demands, self.demands_generation)
+            demands_changed = generation is not None or not self._was_flying
+            if generation is not None:
+                self.demands_generation = generation
+            if not self._was_flying:
+                self.dispatcher.reset()
+            self._was_flying = True
+            demands = self.demands
+            if demands_changed:
+                self.dispatcher.dispatch(demands)
+            _demands_timer.stop(started)
+            # Fold all the IMU samples since last time into the attitude estimate
+            started = _attitude_timer.start()
+            samples, self._imu_count = self.imu.samples_since(self._imu_count)
+            angles = self.attitude.update(samples)
+            if self.flying:
+                # Update the swash plate position - height from the throttle, pitch & roll to hold the demanded attitude
+                if angles is None:
+                    pitch_cyclic, roll_cyclic = 0, 0
+                else:
+                    pitch_cyclic, roll_cyclic = self.attitude_controller.update(self.pitch_demand, self.roll_demand, angles, self.attitude.rates)
+                self.heli.swash_plate.set_attitude(self.throttle_demand, pitch_cyclic, roll_cyclic)
+            _attitude_timer.stop(started)
+            # Yaw has to chase the gyro, so needs looking at every time round
             if self.flying:
-                try:
-                    accelerations = self.gyro.get_acceleration()
-                    gyro_rates = self.gyro.get_gyro()
-                except IOError as e:
-                    print("Error getting gyro/accelerometer details!")
-                    print(e)
-                    accelerations = [0,0,0]
-                    gyro_rates = [0,0,0]
-                for demand in self.demands:
-                    demand_value = self.demands[demand]
-                    #print(f"Demand: {demand}, value = {demand_value}")
-                    if demand == 'stop_demand':
-                        if demand_value:
-                            self.heli.stop()
-                            self.flying = False
-                            # This call blocks, so we can't do any processing anyway
-                            # Don't stop processing in this thread just yet in case we still need to do something on the other controls
-                    if demand == 'start_demand':
-                        # self.heli.start_motor()
-                        # Motor started before we're 'flying', so do nothing now...
-                        pass
-                    if demand == 'throttle_demand':
-                        # Need to blend the throttle and blade pitch - increment throttle to match demand if above the threshold
-                        throttle_demand = max(self._min_throttle, abs(demand_value)) # Make sure that the throttle is always at least _min_throttle, and set it equal to the magnitude of the demand
-                        if self.flying:
-                            # Update the motor speed
-                            self.heli.motor.set_motor_speed(throttle_demand)
-                            # Update the swash plate position
-                            self.heli.swash_plate.set_height(demand_value)
-                    if demand == 'yaw_demand':
-                        current_yaw_rate = gyro_rates[2]
-                        demand_delta = demand_value - current_yaw_rate
-                        # Only take action if we're outside the threshold range
-                        if demand_delta > self._yaw_threshold:
-                            print("Turning more left")
-                            self.heli.turn_more_left()
-                        elif demand_delta < -self._yaw_threshold:
-                            print("Turning more right")
-                            self.heli.turn_more_right() 
-                    if demand == 'pitch_demand':
-                        pass
-                    if demand == 'roll_demand':
-                        pass
-                    if demand == 'request_gyro_state_demand':
-                        if demand_value:
-                            print(f"Gyro rates: {gyro_rates}, accelerations: {accelerations}")
+                started = _yaw_timer.start()
+                self.heli.set_yaw(self.yaw_controller.update(self.yaw_demand, gyro_rates[2], dt))
+                _yaw_timer.stop(started)
+            if self.show_gyro_state:
+                self.log.info('gyro_state', "Gyro rates: %s, accelerations: %s, pitch/roll: %s. IMU %s", gyro_rates, accelerations, angles, self.imu)
+            # Send anything that's changed to the actuators, once per servo frame
+            self.heli.flush_outputs()
+            if self.recorder:
+                self.recorder.record(now, demands, sample, angles)
+        _step_timer.stop(step_started)
+
+    def telemetry_state(self):
+        """
+        The state the telemetry reports: (flying, gyro rates [x, y, z], attitude [pitch, roll], motor speed, servo
+        positions [swash servos..., tail], loop stats (iterations, overruns, mean work time (us), max jitter (us))).
+        The attitude's NaN before the first estimate, as is any actuator not written yet. Only reads what the control
+        loop's already worked out, so it never holds it up
+        """
+        sample = self.imu.latest()
+        rates = [0, 0, 0] if sample is None else sample[SAMPLE_RATES].tolist()
+        angles = self.attitude.angles
+        attitude = [math.nan, math.nan] if angles is None else angles.tolist()
+        motor, *servos = [math.nan if channel.last_written is None else channel.last_written for channel in self._telemetry_outputs]
+        stats = self.scheduler.stats
+        loop_stats = (stats.iterations, stats.overruns, 1e6 * stats.mean_work_time, 1e6 * stats.max_jitter)
+        return self.flying, rates, attitude, motor, servos, loop_stats
+
+    def _stop_changed(self, stop):
+        if stop:
+            self.log.warning('motor', "Stop demand received, stopping the motor")
+            self.heli.stop()
+            self.flying = False
+            self._was_flying = False
+            self.yaw_controller.reset()
+            self._last_step_time = None
+            # This call blocks, so we can't do any processing anyway
+            # Don't stop processing in this thread just yet in case we still need to do something on the other controls
+
+    def _throttle_changed(self, throttle):
+        self.throttle_demand = throttle
+        if self.flying:
+            # Need to blend the throttle and blade pitch - make sure that the throttle is always at least _min_throttle, and set it equal to the magnitude of the demand
+            self.heli.set_motor_speed(max(self._min_throttle, abs(throttle)))
+
+    def _yaw_changed(self, yaw):
+        self.yaw_demand = yaw
+
+    def _pitch_changed(self, pitch):
+        self.pitch_demand = pitch
+
+    def _roll_changed(self, roll):
+        self.roll_demand = roll
+
+    def _request_gyro_state_changed(self, requested):
+        self.show_gyro_state = bool(requested)
 
     def stop_flying(self):
         """ Cleanly and safely shut down the helicopter """
         self.heli.stop()
         self.thread_running = False
+        self.imu.stop()
@@ -0,0 +1,387 @@
+"""
+Flying the pilot (and the hardware drivers) in a process of its own, so the control loop doesn't share a GIL with the
+server reading and decoding demands, sending telemetry or printing.
+The server's end is a PilotProcess, which stands in for the HelicopterPilot. The two exchange the demands and the
+pilot's state through a PilotStateBlock in shared memory (see shared_state), and each keeps an eye on the other
+through a heartbeat there. Turned on by the 'process' part of the config's 'pilot' section (see heli_config.json).
+The pilot's stages (the control loop, swash plate, IMU and output flush) are timed in its process, so the server's
+stats endpoint only has the server's own. The pilot process serves its own on the stats section's 'pilot_port'.
+"""
+import math
+import multiprocessing
+import os
+import time
+from threading import Event, Lock, Thread
+import numpy as np
+import hardware
+from helicopter import Helicopter
+from pilot import HelicopterPilot
+from demand_slot import DEMAND_FIELDS, demand_record
+from shared_state import PilotStateBlock, CONTROL_FIELDS, CONTROL_INDEX, STATE_FIELDS, STATE_INDEX, MAX_OUTPUTS
+from startup import StartupTimeline
+from stage_timing import StatsEndpoint
+
+# Where things live in the control and state slots
+_SERVER_HEARTBEAT = CONTROL_INDEX['server_heartbeat']
+_STOP = CONTROL_INDEX['stop']
+_PILOT_HEARTBEAT = STATE_INDEX['pilot_heartbeat']
+_FLYING = STATE_INDEX['flying']
+_RATES = slice(STATE_INDEX['rate_x'], STATE_INDEX['rate_z'] + 1)
+_ATTITUDE = slice(STATE_INDEX['pitch'], STATE_INDEX['roll'] + 1)
+_LOOP_STATS = slice(STATE_INDEX['loop_iterations'], STATE_INDEX['loop_max_jitter'] + 1)
+_LOOP_ITERATIONS = STATE_INDEX['loop_iterations']
+_IMU_SAMPLE_AGE = STATE_INDEX['imu_sample_age']
+_OUTPUT_COUNT = STATE_INDEX['output_count']
+_OUTPUTS = STATE_INDEX['output_0']
+
+# What the server reports before the pilot's written any state
+_NO_STATE = np.zeros(len(STATE_FIELDS))
+_NO_STATE[_ATTITUDE] = math.nan
+
+
+def state_values(pilot, heartbeat:float):
+    """ The pilot's telemetry_state() (and IMU sample age), as values for the state slot """
+    flying, rates, attitude, motor, servos, loop_stats = pilot.telemetry_state()
+    outputs = [motor] + servos
+    return ([heartbeat, flying] + rates + attitude + list(loop_stats) + [pilot.imu.sample_age, len(outputs)] +
+            outputs + [math.nan] * (MAX_OUTPUTS - len(outputs)))
+
+
+def telemetry_state(state):
+    """ The state slot's values back as a telemetry_state() tuple (see HelicopterPilot.telemetry_state) """
+    outputs = state[_OUTPUTS:_OUTPUTS + int(state[_OUTPUT_COUNT])].tolist() or [math.nan]
+    iterations, overruns, mean_work_time, max_jitter = state[_LOOP_STATS].tolist()
+    return (bool(state[_FLYING]), state[_RATES].tolist(), state[_ATTITUDE].tolist(), outputs[0], outputs[1:],
+            (int(iterations), int(overruns), mean_work_time, max_jitter))
+
+
+def pilot_stats_settings(stats:dict):
+    """ The config's 'stats' section, for the pilot process's endpoint: on 'pilot_port' (the server's port + 1 if not set) """
+    return {**stats, 'port': stats.get('pilot_port', stats.get('port', 9101) + 1)}
+
+
+def dedicate_cpu(cpu=None, realtime_priority=None):
+    """
+    Pin this process to 'cpu', and run it with the SCHED_FIFO real-time policy at 'realtime_priority' (1-99), as far
+    as the OS allows. Only threads started after this inherit it, so call it first
+    """
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            print(f"WARNING: Couldn't pin the pilot process to CPU {cpu}: {e}")
+    if realtime_priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(realtime_priority))
+        except (AttributeError, OSError) as e:
+            print(f"WARNING: Couldn't give the pilot process real-time priority {realtime_priority} (needs root, or CAP_SYS_NICE): {e}")
+
+
+class PilotProcess:
+    """
+    The server's end of a pilot flying in a process of its own. It has the HelicopterPilot's update_demands(),
+    hold(), stop_flying() and telemetry_state(), so the server can use it in place of one.
+
+    The process is started as soon as this is made, and gets the actuators ready (as PilotSession.prewarm does), but
+    the pilot's only woken by wake(). While it's flying, the server beats its heartbeat every 'heartbeat_interval' and
+    the pilot beats its own every tick. If the pilot hasn't heard the server's for 'heartbeat_timeout' (e.g. the server
+    has hung, or been killed) it stops the heli itself. If the server hasn't heard the pilot's (or the process has
+    died), it kills the process and stops the motor directly - pigpiod would otherwise carry on with the last pulses.
+    'cpu' pins the process to that CPU, and 'realtime_priority' (1-99) runs it with the SCHED_FIFO real-time policy
+    (which needs root, or CAP_SYS_NICE - it runs as normal without). If the pilot hasn't woken within 'wake_timeout'
+    (e.g. it's hung bringing up the gyro), the process is killed. 'initializer' is called first thing in the new
+    process (e.g. to set up the simulated hardware), so needs to be picklable
+    """
+
+    # Settings in the 'process' part of the config's 'pilot' section that belong here
+    _settings = ('cpu', 'realtime_priority', 'heartbeat_interval', 'heartbeat_timeout', 'wake_timeout')
+
+    # How long the pilot has to finish off (spin down, write out its log and flight record) once asked to stop (s)
+    _stop_timeout = 5
+
+    def __init__(self, config, cpu=None, realtime_priority=None, heartbeat_interval:float=0.05,
+                 heartbeat_timeout:float=0.5, wake_timeout:float=10, initializer=None):
+        self.config = config
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.wake_timeout = wake_timeout
+        self.block = PilotStateBlock()
+        # Guards the block (and the copies of it here) between the server's threads
+        self._lock = Lock()
+        self._control = np.zeros(len(CONTROL_FIELDS))
+        # The demands last written to the block, and the latest state read back from it
+        self._demands = demand_record()
+        self._scratch = demand_record()
+        self._state = _NO_STATE
+        # The pilot's startup timeline once it's woken, and its control loop's stats once it's stopped
+        self.timeline = None
+        self.loop_stats = None
+        self._awake = False
+        self._stopped = Event()
+        self._monitor = None
+        context = multiprocessing.get_context('spawn')
+        self._commands, pilot_commands = context.Pipe()
+        self.process = context.Process(target=run_pilot_process, name='pilot', daemon=True,
+                                       args=(config, self.block.name, pilot_commands, cpu, realtime_priority,
+                                             heartbeat_timeout, initializer))
+        self.process.start()
+        pilot_commands.close()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        From the 'process' part of the HelicopterConfig's 'pilot' section, using the defaults for anything not set.
+        Anything in 'kwargs' overrides the config
+        """
+        settings = {name: value for name, value in config.pilot.get('process', {}).items() if name in cls._settings}
+        settings.update(kwargs)
+        return cls(config, **settings)
+
+    def wake(self):
+        """
+        Wake the pilot up, and start it flying. Lets the pilot's OSError/ValueError through if it can't be woken, and
+        raises OSError if it hasn't woken within 'wake_timeout' (the process is killed - it can't be used again)
+        """
+        # Start the heartbeat first - the pilot's listening for it as soon as it starts flying
+        self._beat()
+        self._stopped.clear()
+        self._monitor = Thread(target=self._watch_pilot, name='pilot_heartbeat', daemon=True)
+        self._monitor.start()
+        try:
+            self._commands.send(('wake',))
+            if self._commands.poll(self.wake_timeout):
+                reply, result = self._commands.recv()
+            else:
+                reply, result = 'timeout', OSError(f"Pilot process didn't wake within {self.wake_timeout}s")
+        except (EOFError, OSError) as e:
+            reply, result = 'error', OSError(f"Pilot process has gone: {e!r}")
+        if reply in ('error', 'timeout'):
+            # (After an error the process carries on, ready to be asked again)
+            self._stopped.set()
+            self._monitor.join()
+            if reply == 'timeout':
+                # (It may have armed the motor before it hung)
+                self._pilot_lost(f"not woken after {self.wake_timeout}s", stop_motor=True)
+            raise result
+        self.timeline = result
+        self._awake = True
+        return self
+
+    def update_demands(self, demands):
+        """ Hand the demands to the pilot (they're only written to the block if they've changed) """
+        if not demands:
+            return
+        with self._lock:
+            record = self._scratch
+            for i, field in enumerate(DEMAND_FIELDS):
+                # Missing demands (e.g. from an older controller) read as 0/False
+                record[i] = demands.get(field, 0)
+            if record == self._demands or self.block is None:
+                return
+            self._demands[:] = record
+            self.block.demands.write(record)
+
+    def hold(self, cut_collective=False):
+        """
+        Fly on without a controller (e.g. while its link's down): level off and stop turning, keeping the collective
+        where it was - or, with 'cut_collective', taking it off to come down (as HelicopterPilot.hold)
+        """
+        with self._lock:
+            demands = dict(zip(DEMAND_FIELDS, self._demands))
+        for axis in ('yaw_demand', 'pitch_demand', 'roll_demand', 'request_gyro_state_demand'):
+            demands[axis] = 0
+        if cut_collective:
+            demands['throttle_demand'] = 0
+            print("No controller - levelling off and cutting the collective")
+        else:
+            print(f"No controller - levelling off and holding the collective at {demands['throttle_demand']:.2f}")
+        self.update_demands(demands)
+
+    def telemetry_state(self):
+        """ The pilot's state (see HelicopterPilot.telemetry_state), as it last wrote it to the block """
+        return telemetry_state(self._read_state())
+
+    def health(self):
+        """ (control loop iterations so far, age of the latest IMU sample (s)) - see HelicopterPilot.health """
+        state = self._read_state()
+        if not state[_PILOT_HEARTBEAT]:
+            # Not flying yet
+            return 0, math.inf
+        return int(state[_LOOP_ITERATIONS]), float(state[_IMU_SAMPLE_AGE] + time.monotonic() - state[_PILOT_HEARTBEAT])
+
+    def _read_state(self):
+        """ The latest state from the block (or the last one read, if it can't be read) """
+        with self._lock:
+            if self.block is not None:
+                state = np.empty(len(STATE_FIELDS))
+                if self.block.state.read_into(state) is not None:
+                    self._state = state
+            return self._state
+
+    @property
+    def flying(self):
+        return bool(self._state[_FLYING])
+
+    def stop_flying(self):
+        """ Stop the heli and the pilot's process, waiting for the pilot to finish off (or killing it if it doesn't) """
+        self._stopped.set()
+        if self._monitor:
+            self._monitor.join()
+        with self._lock:
+            if self.block is not None:
+                self._control[_STOP] = 1
+                self.block.control.write(self._control)
+        self.process.join(self._stop_timeout)
+        if self.process.is_alive():
+            self._pilot_lost(f"didn't stop within {self._stop_timeout}s")
+        self.close()
+
+    def close(self):
+        """ Shut the process down (if it's not been woken, or has already stopped) and free the shared memory """
+        self._stopped.set()
+        if self.process.is_alive():
+            try:
+                self._commands.send(('close',))
+            except OSError:
+                pass
+            self.process.join(self._stop_timeout)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        # The pilot's last word is its loop stats
+        try:
+            while self._commands.poll():
+                reply, result = self._commands.recv()
+                if reply == 'stopped':
+                    self.loop_stats = result
+        except (EOFError, OSError):
+            pass
+        self._commands.close()
+        with self._lock:
+            if self.block is not None:
+                self.block.close()
+                self.block.unlink()
+                self.block = None
+
+    def _beat(self):
+        with self._lock:
+            if self.block is not None:
+                self._control[_SERVER_HEARTBEAT] = time.monotonic()
+                self.block.control.write(self._control)
+
+    def _watch_pilot(self):
+        """ Beat the server's heartbeat, and listen for the pilot's, until it's stopped """
+        state = np.empty(len(STATE_FIELDS))
+        while not self._stopped.wait(self.heartbeat_interval):
+            self._beat()
+            if not self.process.is_alive():
+                self._pilot_lost(f"exited with code {self.process.exitcode}")
+                return
+            if not self._awake:
+                continue
+            with self._lock:
+                if self.block is None or self.block.state.read_into(state) is None:
+                    continue
+            heartbeat = state[_PILOT_HEARTBEAT]
+            # (Not until the pilot's first tick)
+            if heartbeat and time.monotonic() - heartbeat > self.heartbeat_timeout:
+                self._pilot_lost(f"heartbeat not heard for {time.monotonic() - heartbeat:.2f}s")
+                return
+
+    def _pilot_lost(self, reason:str, stop_motor:bool=None):
+        """
+        The pilot can't be relied on to stop the heli - kill it, and stop the motor from here (if it's awake, unless
+        'stop_motor' says otherwise)
+        """
+        print(f"ERROR: Lost the pilot process ({reason}) - killing it and stopping the motor")
+        self.process.kill()
+        self.process.join()
+        if self._awake if stop_motor is None else stop_motor:
+            hardware.Motor(**self.config.motor).estop()
+
+
+class _PilotLink:
+    """ The pilot process's end of the block - feeds the pilot the demands from it, and writes its state back, each tick """
+
+    def __init__(self, pilot, block, heartbeat_timeout:float):
+        self.pilot = pilot
+        self.block = block
+        self.heartbeat_timeout = heartbeat_timeout
+        self.control = np.zeros(len(CONTROL_FIELDS))
+        self.control_generation = None
+        self.demands = np.zeros(len(DEMAND_FIELDS))
+        self.demands_generation = None
+        self.stopping = False
+
+    def step(self):
+        """ One iteration of the control loop, with the block read before and written after """
+        now = time.monotonic()
+        generation = self.block.control.read_if_changed(self.control, self.control_generation)
+        if generation is not None:
+            self.control_generation = generation
+        if not self.stopping:
+            if self.control[_STOP]:
+                self.stop()
+            elif now - self.control[_SERVER_HEARTBEAT] > self.heartbeat_timeout:
+                self.pilot.log.error('link', "Server's heartbeat not heard for %.2fs - stopping the helicopter",
+                                     now - self.control[_SERVER_HEARTBEAT])
+                self.stop()
+        generation = self.block.demands.read_if_changed(self.demands, self.demands_generation)
+        if generation is not None:
+            self.demands_generation = generation
+            self.pilot.update_demands(dict(zip(DEMAND_FIELDS, self.demands.tolist())))
+        self.pilot.fly_step()
+        self.block.state.write(state_values(self.pilot, now))
+
+    def stop(self):
+        self.stopping = True
+        self.pilot.stop_flying()
+
+
+def run_pilot_process(config, block_name:str, commands, cpu, realtime_priority, heartbeat_timeout:float, initializer):
+    """ The pilot process: get the actuators ready, then wake the pilot and fly it when the server says """
+    if initializer:
+        initializer()
+    # The pilot's stages are timed here, so serve them from here. (Before dedicate_cpu, so the endpoint's thread isn't
+    # pinned to the pilot's CPU or run real-time)
+    stats_endpoint = None
+    if config.stats.get('enabled'):
+        try:
+            stats_endpoint = StatsEndpoint.from_config(pilot_stats_settings(config.stats)).start()
+        except OSError as e:
+            print(f"WARNING: Couldn't serve the pilot's stage timings, carrying on without them: {e}")
+    dedicate_cpu(cpu, realtime_priority)
+    block = PilotStateBlock(block_name)
+    # Get the actuators ready ahead of waking, as PilotSession.prewarm does
+    heli = None
+    try:
+        heli = Helicopter(config, arm=False)
+    except (OSError, ValueError) as e:
+        print(f"Couldn't get the actuators ready ahead of time, will try again when the pilot wakes: {e}")
+    try:
+        while True:
+            try:
+                command, = commands.recv()
+            except EOFError:
+                # The server's gone
+                return
+            if command != 'wake':
+                return
+            try:
+                pilot = HelicopterPilot(config, start=False, heli=heli, timeline=StartupTimeline())
+                outputs = len(pilot.telemetry_state()[4]) + 1
+                if outputs > MAX_OUTPUTS:
+                    raise ValueError(f"The shared state only has room for {MAX_OUTPUTS} actuator outputs, the heli has {outputs}")
+            except (OSError, ValueError) as e:
+                commands.send(('error', e))
+                continue
+            commands.send(('awake', str(pilot.timeline)))
+            link = _PilotLink(pilot, block, heartbeat_timeout)
+            pilot.imu.start()
+            pilot.fly(link.step)
+            commands.send(('stopped', pilot.scheduler.stats))
+            return
+    finally:
+        block.close()
+        if stats_endpoint:
+            stats_endpoint.stop()
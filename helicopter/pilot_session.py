@@ -0,0 +1,345 @@
+""" The one pilot the heli server flies, shared between all the connections to the server """
+import hmac
+import secrets
+import socket
+import time
+from threading import Lock, Timer
+from pilot import HelicopterPilot
+from pilot_process import PilotProcess
+from failsafe import FailsafeSupervisor
+from helicopter import Helicopter
+from startup import StartupTimeline
+from telemetry import TelemetrySender
+from heli_protocol import SESSION_TOKEN_SIZE
+
+
+class Observer:
+    """
+    A read-only connection getting telemetry.
+    Frames are sent without blocking, so an observer that can't keep up (or has stopped reading) just misses frames -
+    it can never hold up anything else
+    """
+    __slots__ = ['socket', 'session_id', 'pending', 'frames_sent', 'frames_dropped', 'closed']
+
+    def __init__(self, sock, session_id):
+        self.socket = sock
+        self.session_id = session_id
+        # The rest of a frame that only partly fitted in the socket's buffer. It has to go before anything else, or the
+        # observer would lose track of where the frames start
+        self.pending = b''
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.closed = False
+
+    def send(self, frame):
+        try:
+            if self.pending:
+                self.pending = self.pending[self.socket.send(self.pending, socket.MSG_DONTWAIT):]
+                if self.pending:
+                    self.frames_dropped += 1
+                    return
+            sent = self.socket.send(frame, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            self.frames_dropped += 1
+            return
+        except OSError:
+            self.closed = True
+            return
+        self.pending = frame[sent:]
+        self.frames_sent += 1
+
+    def __str__(self):
+        return f"observer {self.session_id}: frames sent: {self.frames_sent}, dropped: {self.frames_dropped}"
+
+
+class ObserverBroadcast(TelemetrySender):
+    """ Telemetry for all the observers at once - each frame's encoded once, then sent to every observer """
+
+    def __init__(self, pilot, observers, rate_hz:float):
+        super().__init__(pilot, self.broadcast, rate_hz, lambda: None)
+        self.observers = observers
+
+    def broadcast(self, frame):
+        # Copy the list, as observers come and go from other threads
+        for observer in tuple(self.observers):
+            observer.send(frame)
+
+
+class PilotSession:
+    """
+    The pilot the server flies, which connection has control of it, and who's watching.
+
+    Only the controller in control has its demands flown. The first controller to wake the pilot gets control. Any
+    other controller asking for it is told it's held (and its demands are ignored) until the controller in control
+    hands over, by offering control to it (or to anyone) - it then takes control by asking again. An offer that
+    isn't taken up within 'handover_timeout' lapses, leaving control where it was.
+    The controller in control is given a session token. If its connection drops (it closes, or nothing's arrived on
+    it for 'link_timeout'), the pilot holds (see HelicopterPilot.hold) and stays reserved for that controller for
+    'resume_timeout', so it can reconnect and resume with the token - taking the pilot over as it is, with no
+    re-initialising. If it hasn't resumed by then the heli stops, and the next controller to ask wakes a new pilot.
+    Observers get telemetry (at up to 'observer_rate_hz', all from one broadcast thread) but can't send demands, so
+    however many there are they never touch the demand path.
+    If the config's 'pilot' section has 'process' enabled, each pilot flies in a process of its own (see
+    pilot_process), started ahead of time like the prewarmed actuators - and, once one's stopped, the next is started.
+    If the config's 'failsafe' section is enabled, each pilot's watched by a FailsafeSupervisor while it flies - holding,
+    then bringing the heli down and stopping it if the demands stop reaching it (whatever the connections are doing),
+    and stopping it if its control loop stalls or its IMU samples go stale.
+    """
+
+    def __init__(self, pilot_config=None, handover_timeout:float=10, max_observers:int=32, observer_rate_hz:float=20,
+                 link_timeout:float=0.5, resume_timeout:float=5):
+        self.pilot_config = pilot_config
+        self.handover_timeout = handover_timeout
+        # Needs to be longer than the controller's heartbeat interval. 0 to only go on the connection closing
+        self.link_timeout = link_timeout
+        # 0 to stop the heli as soon as the controller's connection drops
+        self.resume_timeout = resume_timeout
+        self.max_observers = max_observers
+        self.observer_rate_hz = observer_rate_hz
+        self.lock = Lock()
+        # The heli's actuators, got ready ahead of the pilot waking (see prewarm)
+        self.heli = None
+        # Or, flying the pilot in a process of its own, the process that's ready to wake
+        self.separate_process = bool(pilot_config and pilot_config.pilot.get('process', {}).get('enabled'))
+        self.pilot_process = None
+        self.pilot = None
+        # Watching the pilot, while it flies (if the config enables it)
+        self.failsafe_settings = pilot_config.failsafe if pilot_config else {}
+        self.failsafe = None
+        # Connection (request handler) in control
+        self.controller = None
+        # Session ID control's been offered to (0 for anyone), and when the offer lapses
+        self.handover = None
+        # Token for the controller in control to resume with, and when its link dropped (None while it's up)
+        self.token = None
+        self.link_lost_at = None
+        self._resume_timer = None
+        # Resumes, and how long the link was down for each (s)
+        self.resumes = 0
+        self.last_outage = None
+        self.max_outage = 0.0
+        self.observers = []
+        self.broadcast = None
+        self._last_session_id = 0
+
+    # Settings in the config's 'server' section that belong to the session
+    _settings = ('handover_timeout', 'max_observers', 'observer_rate_hz', 'link_timeout', 'resume_timeout')
+
+    @classmethod
+    def from_config(cls, pilot_config):
+        """ From the 'server' section of a HelicopterConfig, using the defaults for anything not set """
+        return cls(pilot_config, **{name: value for name, value in pilot_config.server.items() if name in cls._settings})
+
+    def prewarm(self, timeline=None):
+        """
+        Get the heli's actuators ready (but the motor unarmed) before anyone asks for the pilot, as they don't need the
+        battery connecting - so waking the pilot only has to arm the motor and bring up the gyro. Every pilot the
+        session wakes flies this same heli. If they can't be got ready now, each pilot makes its own as it wakes.
+        Flying the pilot in its own process, start that process - it gets the actuators ready itself
+        """
+        if self.separate_process:
+            self.pilot_process = PilotProcess.from_config(self.pilot_config)
+            return
+        try:
+            self.heli = Helicopter(self.pilot_config, arm=False, timeline=timeline)
+        except (OSError, ValueError) as e:
+            print(f"Couldn't get the actuators ready ahead of time, will try again when the pilot wakes: {e}")
+
+    def new_session_id(self):
+        with self.lock:
+            # IDs go in a uint16, and 0 means 'anyone'
+            self._last_session_id = self._last_session_id % 0xFFFF + 1
+            return self._last_session_id
+
+    def request_control(self, connection):
+        """
+        Give 'connection' control if it's free (or offered to it), waking the pilot if need be. Returns True if it
+        has control. Lets the pilot's OSError/ValueError through if it can't be woken
+        """
+        with self.lock:
+            if self.controller is None and self.link_lost_at is None:
+                if self.pilot is None:
+                    self.pilot = self._wake_pilot()
+                    if self.failsafe_settings.get('enabled'):
+                        pilot = self.pilot
+                        self.failsafe = FailsafeSupervisor.from_config(
+                            self.failsafe_settings, pilot, lambda reason: self._failsafe_stop(pilot)).start()
+                    if self.observer_rate_hz:
+                        self.broadcast = ObserverBroadcast(self.pilot, self.observers, self.observer_rate_hz)
+                        self.broadcast.start()
+                self._give_control(connection)
+                return True
+            if self.controller is connection:
+                return True
+            if self.controller is not None and self._offered_to(connection):
+                print(f"Control handed over from session {self.controller.session_id} to session {connection.session_id}")
+                self._give_control(connection)
+                return True
+            return False
+
+    def _wake_pilot(self):
+        if not self.separate_process:
+            return HelicopterPilot(self.pilot_config, heli=self.heli, timeline=StartupTimeline())
+        if self.pilot_process is None:
+            self.prewarm()
+        try:
+            pilot = self.pilot_process.wake()
+        except OSError:
+            if not self.pilot_process.process.is_alive():
+                # (Killed for not waking in time, or died) - the next try needs a new one
+                self.pilot_process.close()
+                self.pilot_process = None
+            raise
+        self.pilot_process = None
+        return pilot
+
+    def demands_applied(self):
+        """ The controller in control's demands have just been handed to the pilot """
+        failsafe = self.failsafe
+        if failsafe is not None:
+            failsafe.demands_arrived()
+
+    def stop_pilot(self, connection):
+        """
+        Stop the heli for 'connection' (e.g. it's sent demands that can't be made sense of), if it has control.
+        The pilot's finished with, so control's free for the next controller to wake a new one. Returns True if it stopped it
+        """
+        with self.lock:
+            if self.controller is not connection:
+                return False
+            self.controller = None
+            self.handover = None
+            self.token = None
+            self._stop_pilot()
+            return True
+
+    def _failsafe_stop(self, pilot):
+        """ The failsafe's given up on 'pilot' - stop it (unless it's already been stopped) """
+        with self.lock:
+            if self.pilot is not pilot:
+                return
+            print("Failsafe stopping the helicopter now")
+            self.controller = None
+            self.handover = None
+            self._stop_pilot()
+
+    def _give_control(self, connection):
+        self.controller = connection
+        self.handover = None
+        # A new token each time control changes hands, so only the controller that has it now can resume
+        self.token = secrets.token_bytes(SESSION_TOKEN_SIZE)
+
+    def resume(self, connection, token:bytes):
+        """
+        Give 'connection' control of the pilot as it is, if 'token' is the session's and the pilot's being held for
+        it. Returns True if it has control
+        """
+        with self.lock:
+            if self.link_lost_at is None or not hmac.compare_digest(token, self.token):
+                return False
+            self._resume_timer.cancel()
+            self._resume_timer = None
+            outage = time.monotonic() - self.link_lost_at
+            self.link_lost_at = None
+            self.controller = connection
+            self.resumes += 1
+            self.last_outage = outage
+            self.max_outage = max(self.max_outage, outage)
+            print(f"Session {connection.session_id} resumed control after {1000 * outage:.1f}ms without a controller")
+            return True
+
+    def hand_over(self, connection, session_id:int):
+        """ Offer control to 'session_id' (0 for anyone). Only the controller in control can. Returns True if offered """
+        with self.lock:
+            if self.controller is not connection:
+                return False
+            self.handover = (session_id, time.monotonic() + self.handover_timeout)
+            print(f"Session {connection.session_id} offering control to {f'session {session_id}' if session_id else 'anyone'}")
+            return True
+
+    def _offered_to(self, connection):
+        if self.handover is None:
+            return False
+        session_id, lapses = self.handover
+        if time.monotonic() > lapses:
+            self.handover = None
+            return False
+        return session_id in (0, connection.session_id)
+
+    def control_state(self, connection):
+        """ (in control, control offered) for 'connection' """
+        return self.controller is connection, self.controller is not connection and self._offered_to(connection)
+
+    def release(self, connection):
+        """
+        'connection' has gone. If it had control, hold the heli for it to resume - or stop the heli, if it can't
+        """
+        with self.lock:
+            if self.controller is not connection:
+                return
+            self.controller = None
+            self.handover = None
+            if not self.resume_timeout:
+                print("Controller in control has gone. Stopping the helicopter now")
+                self._stop_pilot()
+                return
+            print(f"Controller in control has gone. Holding the helicopter for {self.resume_timeout}s for it to resume")
+            self.link_lost_at = time.monotonic()
+            self.pilot.hold()
+            self._resume_timer = Timer(self.resume_timeout, self._resume_lapsed, (self.link_lost_at,))
+            self._resume_timer.daemon = True
+            self._resume_timer.start()
+
+    def _resume_lapsed(self, link_lost_at):
+        with self.lock:
+            # Unless it was resumed (or the server closed) just as the timer went off
+            if self.link_lost_at != link_lost_at:
+                return
+            print("Controller didn't resume in time. Stopping the helicopter now")
+            self._stop_pilot()
+
+    def close(self):
+        """ Stop the heli, whoever has control - the server's shutting down """
+        with self.lock:
+            if self.pilot is not None:
+                print("Server closing. Stopping the helicopter now")
+                self.controller = None
+                self._stop_pilot(replace=False)
+            if self.pilot_process is not None:
+                self.pilot_process.close()
+                self.pilot_process = None
+
+    def _stop_pilot(self, replace=True):
+        """ Stop the heli. 'replace' starts the next pilot's process, if they fly in their own """
+        if self._resume_timer:
+            self._resume_timer.cancel()
+            self._resume_timer = None
+        self.link_lost_at = None
+        self.token = None
+        if self.failsafe:
+            self.failsafe.stop()
+            print(f"Failsafe: {self.failsafe}")
+            self.failsafe = None
+        self.pilot.stop_flying()
+        if self.separate_process:
+            print(f"Pilot process stopped. Loop stats: {self.pilot.loop_stats}")
+            if replace:
+                self.prewarm()
+        self.pilot = None
+        if self.broadcast:
+            self.broadcast.stop()
+            print(f"Observer telemetry stats: {self.broadcast}")
+            self.broadcast = None
+
+    def add_observer(self, sock, session_id:int):
+        """ Returns a new Observer, or None if there are already max_observers """
+        with self.lock:
+            if len(self.observers) >= self.max_observers:
+                return None
+            observer = Observer(sock, session_id)
+            self.observers.append(observer)
+            return observer
+
+    def remove_observer(self, observer):
+        with self.lock:
+            self.observers.remove(observer)
@@ -0,0 +1,135 @@
+"""
+Block of shared memory, with a fixed layout, for passing the demands and the pilot's state between the server's
+process and the pilot's own process (see pilot_process) - without either side ever waiting on the other.
+
+    header    float64 x 1                    layout version, written once by the server as it makes the block
+    control   SharedSlot of CONTROL_FIELDS   server -> pilot: its heartbeat, and asking the pilot to stop
+    demands   SharedSlot of DEMAND_FIELDS    server -> pilot: the latest demand record (see demand_slot)
+    state     SharedSlot of STATE_FIELDS     pilot -> server: what the telemetry reports, and the pilot's heartbeat
+"""
+import time
+import zlib
+from multiprocessing import shared_memory
+import numpy as np
+from demand_slot import DEMAND_FIELDS
+
+# Bumped whenever the layout changes, so a pilot process can't misread a block made by a different version
+LAYOUT_VERSION = 2
+
+CONTROL_FIELDS = ('server_heartbeat', 'stop')
+# Most actuator outputs the state has room for (the motor, the swash servos and the tail)
+MAX_OUTPUTS = 8
+# The pilot's state, as HelicopterPilot.telemetry_state() has it (plus the IMU sample age from its health()), then
+# the outputs (motor first, then the servos)
+STATE_FIELDS = (('pilot_heartbeat', 'flying', 'rate_x', 'rate_y', 'rate_z', 'pitch', 'roll',
+                 'loop_iterations', 'loop_overruns', 'loop_mean_work_time', 'loop_max_jitter', 'imu_sample_age',
+                 'output_count') +
+                tuple(f'output_{i}' for i in range(MAX_OUTPUTS)))
+CONTROL_INDEX = {field: i for i, field in enumerate(CONTROL_FIELDS)}
+STATE_INDEX = {field: i for i, field in enumerate(STATE_FIELDS)}
+
+
+class SharedSlot:
+    """
+    Single-writer/single-reader slot of float64 values in shared memory, versioned like DemandSlot: the writer bumps
+    the sequence number to odd before touching the values and back to even once it's done, and the generation
+    (sequence number / 2) moves on with each write.
+    Unlike the threads sharing a DemandSlot, the two processes can be on different cores with nothing ordering one's
+    stores as the other sees them (and on the Pi's ARM cores they can be seen out of order), so each write also stores
+    a checksum of the values - a copy that doesn't match it is torn, and is read again. Nor can the reader be sure the
+    writer's still there: if it died part way through a write the slot's left odd, so the reader gives up after
+    'max_attempts' rather than waiting for ever.
+    """
+    __slots__ = ['_slot', 'size']
+
+    def __init__(self, buffer, offset:int, size:int):
+        # [sequence, checksum, values...]
+        self._slot = np.ndarray(size + 2, dtype=np.float64, buffer=buffer, offset=offset)
+        self.size = size
+
+    @staticmethod
+    def nbytes(size:int):
+        """ Bytes a slot of 'size' values takes up """
+        return 8 * (size + 2)
+
+    @property
+    def generation(self):
+        return int(self._slot[0]) >> 1
+
+    def write(self, values):
+        """ Writer side - copy 'values' (a sequence of 'size' floats) into the slot """
+        slot = self._slot
+        slot[0] += 1
+        slot[2:] = values
+        slot[1] = zlib.crc32(slot[2:])
+        slot[0] += 1
+
+    def read_into(self, values, max_attempts:int=100):
+        """
+        Reader side - copy the latest values into 'values' (a float64 numpy array of 'size') and return their
+        generation. Returns None if a consistent copy couldn't be had in 'max_attempts' ('values' is then garbage)
+        """
+        slot = self._slot
+        for _ in range(max_attempts):
+            sequence = slot[0]
+            if not sequence % 2:
+                values[:] = slot[2:]
+                checksum = slot[1]
+                if slot[0] == sequence and zlib.crc32(values) == checksum:
+                    return int(sequence) >> 1
+            # Writer is part way through an update - let it finish
+            time.sleep(0)
+        return None
+
+    def read_if_changed(self, values, last_generation):
+        """ Like read_into(), but returns None without copying anything if nothing's changed since 'last_generation' """
+        if int(self._slot[0]) >> 1 == last_generation:
+            return None
+        return self.read_into(values)
+
+    def release(self):
+        """ Let go of the shared memory (the slot can't be used after) """
+        self._slot = None
+
+
+class PilotStateBlock:
+    """
+    The shared memory between the server and the pilot process (see the layout above). The server makes the block
+    (with no 'name'), and the pilot process attaches to it by its name.
+    Each slot has one writer - the server writes the control and demand slots, the pilot the state slot
+    """
+
+    def __init__(self, name=None):
+        self.size = (8 + SharedSlot.nbytes(len(CONTROL_FIELDS)) + SharedSlot.nbytes(len(DEMAND_FIELDS)) +
+                     SharedSlot.nbytes(len(STATE_FIELDS)))
+        self.memory = shared_memory.SharedMemory(name, create=name is None, size=self.size if name is None else 0)
+        buffer = self.memory.buf
+        header = np.ndarray(1, dtype=np.float64, buffer=buffer)
+        if name is None:
+            header[0] = LAYOUT_VERSION
+        elif header[0] != LAYOUT_VERSION:
+            version = header[0]
+            del header
+            self.memory.close()
+            raise ValueError(f"Shared state block {name} has layout version {version:g}, expected {LAYOUT_VERSION}")
+        del header
+        offset = 8
+        self.control = SharedSlot(buffer, offset, len(CONTROL_FIELDS))
+        offset += SharedSlot.nbytes(len(CONTROL_FIELDS))
+        self.demands = SharedSlot(buffer, offset, len(DEMAND_FIELDS))
+        offset += SharedSlot.nbytes(len(DEMAND_FIELDS))
+        self.state = SharedSlot(buffer, offset, len(STATE_FIELDS))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        """ Detach from the block (the slots can't be used after). Each process that's using it needs to """
+        for slot in (self.control, self.demands, self.state):
+            slot.release()
+        self.memory.close()
+
+    def unlink(self):
+        """ Free the block, once it's finished with (by the server, which made it) """
+        self.memory.unlink()
@@ -0,0 +1,89 @@
+"""
+Flies a scripted flight through the whole stack - ControllerConnection -> HelicopterServer -> HelicopterPilot ->
+Helicopter - with the simulated hardware standing in for the heli, running on simulated time so it takes a fraction
+of the flight time. Needs nothing but a plain Linux box (no pigpiod, no Pi).
+Run from this directory with: python sim_flight.py [real]
+('real' flies it in real time instead, e.g. to check the sim time run does the same thing)
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from threading import Thread
+os.environ['HELI_HARDWARE'] = 'sim'
+if len(sys.argv) < 2 or sys.argv[1] != 'real':
+    os.environ['HELI_SIM_TIME'] = 'fast'
+import sim_hardware
+from helicopter import HelicopterConfig
+from heli_protocol import TRANSPORT_TCP
+from heli_server import HelicopterServer
+# The controller's side of the link lives alongside this package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicoptercontroller'))
+from connection_manager import ControllerConnection
+
+# How often the 'controller' sends its demands (Hz)
+DEMAND_RATE_HZ = 50
+
+# (duration (s), demands) for each part of the flight
+FLIGHT = [
+    (0.5, {'start_demand': True, 'throttle_demand': 0.0}),
+    (3.0, {'throttle_demand': 0.7}),
+    (1.0, {'throttle_demand': 0.7, 'yaw_demand': 0.5}),
+    (1.0, {'throttle_demand': 0.7, 'yaw_demand': -0.5}),
+    (1.0, {'throttle_demand': 0.7, 'pitch_demand': 0.3}),
+    (1.0, {'throttle_demand': 0.7, 'roll_demand': -0.3}),
+    (2.0, {'throttle_demand': 0.7}),
+    (2.0, {'throttle_demand': 0.3}),
+    (0.5, {'stop_demand': True}),
+]
+
+
+def fly(connection, log):
+    """ Send the flight's demands at DEMAND_RATE_HZ, pacing them on the hardware's time """
+    period = 1 / DEMAND_RATE_HZ
+    for duration, demands in FLIGHT:
+        for _ in range(round(duration * DEMAND_RATE_HZ)):
+            connection.send_input_demands(demands)
+            sim_hardware.sleep(period)
+        telemetry = connection.telemetry.latest if connection.telemetry else None
+        log.append((sim_hardware.clock(), demands, str(sim_hardware.heli), telemetry))
+
+
+if __name__ == "__main__":
+    config = HelicopterConfig()
+    config.recorder = {}
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config) as server:
+        server_thread = Thread(target=server.serve, daemon=True)
+        server_thread.start()
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as conf_file:
+            json.dump({'server_ip': '127.0.0.1', 'server_port': server.server_address[1], 'demand_encoding': 'binary',
+                       'demand_transport': TRANSPORT_TCP, 'telemetry_rate_hz': 50}, conf_file)
+        log = []
+        try:
+            with ControllerConnection(conf_file.name) as connection:
+                connection.init_connection()
+                if sim_hardware.sim_clock:
+                    # Keep the pilot's threads from running ahead while we're still setting up
+                    sim_hardware.sim_clock.join()
+                start_wall_time = time.monotonic()
+                start_sim_time = sim_hardware.clock()
+                connection.set_battery_connected()
+                fly(connection, log)
+                wall_time = time.monotonic() - start_wall_time
+                sim_time = sim_hardware.clock() - start_sim_time
+                if sim_hardware.sim_clock:
+                    # Let time run on so the pilot's threads can see they've been stopped
+                    sim_hardware.sim_clock.leave()
+                print(f"\nTelemetry: {connection.telemetry}")
+        finally:
+            os.unlink(conf_file.name)
+        server.shutdown()
+
+    print(f"\n{'sim time (s)':>12}  {'demands':<45}heli")
+    for at, demands, heli_state, telemetry in log:
+        print(f"{at - start_sim_time:>12.2f}  {json.dumps(demands):<45}{heli_state}")
+        if telemetry:
+            print(f"{'':>14}telemetry: motor {telemetry['motor_speed']:.2f}, gyro rates "
+                  f"{', '.join(f'{rate:.2f}' for rate in telemetry['gyro_rates'])}")
+    print(f"\nFlew {sim_time:.1f}s of flight in {wall_time:.2f}s ({sim_time / wall_time:.1f}x real time)")
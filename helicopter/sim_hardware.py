@@ -0,0 +1,421 @@
+"""
+Simulated stand-ins for the pithonwy Motor, Servo and Gyro classes, so the helicopter code can be run (and timed)
+without the aircraft attached. They mirror the pithonwy interface, record what they've been told to do, and
+charge a configurable amount of time for each hardware transaction.
+
+The devices are all attached to a SimHelicopter - a simple rigid-body model of the airframe - so what's written to
+the motor and servos shows up in what the gyro reads: the rotor spins up/down with a lag, the servos slew at a
+limited rate, cyclic and tail rotor pitch turn the airframe, and the IMU readings are synthesised from the result
+(plus sensor noise and rotor vibration).
+
+Time comes from 'clock' and 'sleep'. By default that's real time. Set the environment variable HELI_SIM_TIME=fast
+to use a SimClock instead, so everything on the simulated hardware runs as fast as the CPU allows.
+"""
+import heapq
+import math
+import os
+import random
+import time
+from threading import Condition, Lock, current_thread
+
+SIM_TIME_REAL = 'real'
+SIM_TIME_FAST = 'fast'
+
+
+class SimClock:
+    """
+    Simulated monotonic clock, for running the whole stack faster than real time.
+
+    Each thread that sleeps on this clock takes part in the simulation. Time only moves on when every one of those
+    threads is asleep, and then jumps straight to the earliest wakeup - so a loop that's waiting on its next tick
+    costs no real time at all, but the order everything happens in (and the sim time it happens at) is the same as
+    it would have been in real time.
+    Threads that don't sleep on the clock (e.g. a server thread blocked on its socket) don't hold time up.
+    """
+
+    def __init__(self, start:float=0.0):
+        self.now = start
+        self._condition = Condition()
+        # Wakeup times of the threads in sleep() (including any that are due but haven't woken up yet), and the
+        # threads that have ever slept on this clock
+        self._wakeups = []
+        self._participants = set()
+
+    def __call__(self):
+        return self.now
+
+    def join(self):
+        """
+        Take part in the simulation from now on, without sleeping first - time won't move on while this thread's
+        running. Useful for a thread that's about to start others and wants to keep in step with them from the start
+        """
+        with self._condition:
+            self._participants.add(current_thread())
+
+    def leave(self):
+        """ Stop taking part, so time can move on while this thread waits on something else (e.g. other threads finishing) """
+        with self._condition:
+            self._participants.discard(current_thread())
+            self._condition.notify_all()
+
+    def sleep(self, duration:float):
+        if duration <= 0:
+            # Just let the other threads have a go
+            time.sleep(0)
+            return
+        with self._condition:
+            self._participants.add(current_thread())
+            wakeup = self.now + duration
+            heapq.heappush(self._wakeups, wakeup)
+            while self.now < wakeup:
+                if not self._advance():
+                    # Someone's still running. Check back now and again in case they've exited without sleeping
+                    self._condition.wait(0.01)
+            self._wakeups.remove(wakeup)
+            heapq.heapify(self._wakeups)
+
+    def _advance(self):
+        """ Jump to the next wakeup if every participating thread is asleep. Returns True if time moved on """
+        now = self.now
+        if self._wakeups[0] <= now:
+            # Someone's due to wake up already, and hasn't run yet
+            return False
+        self._participants = {thread for thread in self._participants if thread.is_alive()}
+        if len(self._wakeups) < len(self._participants):
+            return False
+        self.now = self._wakeups[0]
+        self._condition.notify_all()
+        return True
+
+
+sim_time = os.environ.get('HELI_SIM_TIME', SIM_TIME_REAL)
+if sim_time == SIM_TIME_FAST:
+    sim_clock = SimClock()
+    clock = sim_clock
+    sleep = sim_clock.sleep
+elif sim_time == SIM_TIME_REAL:
+    sim_clock = None
+    clock = time.monotonic
+    sleep = time.sleep
+else:
+    raise ImportError(f"Unknown HELI_SIM_TIME: {sim_time}. Expected '{SIM_TIME_REAL}' or '{SIM_TIME_FAST}'")
+
+
+class SimHelicopter:
+    """
+    Rigid-body model of the heli that the simulated devices are attached to.
+
+    Deliberately simple - it's for exercising the control code, not for predicting how the real thing will fly:
+     - The rotor speed follows the motor speed with a first order lag
+     - Each servo slews towards its commanded position at a fixed rate
+     - Swash plate cyclic (worked out from the swash servo positions, using where each servo sits) gives a pitch/roll
+       acceleration in proportion to the square of the rotor speed, against some aerodynamic damping
+     - The yaw rate settles (with a lag) to wherever the tail rotor and the main rotor's torque balance
+     - Once the rotor's making more than the heli's weight in thrust it lifts off, and climbs or descends against air
+       drag. On the ground it can't turn
+    The state is integrated in small fixed steps up to the current time whenever a device is used.
+    """
+
+    # Time constant (s) of the rotor following the motor speed
+    rotor_time_constant = 0.8
+    # Servo slew rate (servo position units, i.e. degrees, per second)
+    servo_slew_rate = 300
+    # Pitch/roll acceleration (deg/s^2) per degree of cyclic on the swash plate, at full rotor speed
+    cyclic_authority = 60
+    # Pitch/roll rate damping (1/s)
+    rate_damping = 4
+    # Yaw rate (deg/s) at full tail deflection / from the main rotor's torque, at full rotor speed, and the lag (s)
+    tail_authority = 150
+    rotor_torque_yaw_rate = 60
+    yaw_time_constant = 0.15
+    # Rotor speed that holds the heli in a hover with the swash plate level, and the extra thrust (in g) per degree of collective
+    hover_rotor_speed = 0.6
+    lift_per_collective_degree = 0.04
+    # Air drag on climbing/descending (1/s), so it settles to a steady climb rate rather than accelerating away
+    vertical_drag = 1.0
+    # Extra IMU noise (normalised) at full rotor speed
+    vibration = 0.02
+    # Longest step (s) to integrate the model in
+    max_step = 0.001
+
+    def __init__(self, clock=None, seed=0):
+        """ 'clock' defaults to the module's clock (real or simulated time) """
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.motor = None
+        self.servos = {}
+        self._servo_positions = {}
+        self.reset()
+
+    def reset(self):
+        """ Back on the ground, level and stopped """
+        self.time = None
+        self.rotor_speed = 0.0
+        # Pitch, roll (deg) and pitch, roll, yaw rates (deg/s)
+        self.pitch = 0.0
+        self.roll = 0.0
+        self.rates = [0.0, 0.0, 0.0]
+        self.height = 0.0
+        self.vertical_speed = 0.0
+        self.thrust = 0.0
+        self.airborne = False
+        self._servo_positions = {pin: 0.0 for pin in self._servo_positions}
+
+    def attach_motor(self, motor):
+        self.motor = motor
+
+    def attach_servo(self, servo):
+        """ Servos are kept by GPIO pin, so a new servo on the same pin replaces the old one """
+        self.servos[servo.gpio_pin] = servo
+        self._servo_positions[servo.gpio_pin] = 0.0
+
+    def advance(self):
+        """ Bring the model up to the current time """
+        with self.lock:
+            now = (self.clock or clock)()
+            if self.time is None:
+                self.time = now
+            while self.time < now:
+                dt = min(self.max_step, now - self.time)
+                self._step(dt)
+                self.time += dt
+
+    def _step(self, dt):
+        # Rotor
+        target_speed = self.motor.speed if self.motor and self.motor.armed else 0.0
+        self.rotor_speed += dt / (self.rotor_time_constant + dt) * (target_speed - self.rotor_speed)
+        rotor_effect = self.rotor_speed ** 2
+        # Servos slew towards their commanded positions
+        max_move = self.servo_slew_rate * dt
+        collective = cyclic_pitch = cyclic_roll = 0.0
+        forward_sum = lateral_sum = swash_count = 0
+        tail_yaw = 0.0
+        for pin, servo in self.servos.items():
+            position = self._servo_positions[pin]
+            position += max(-max_move, min(max_move, servo.current_position - position))
+            self._servo_positions[pin] = position
+            forward = getattr(servo, 'forward_position', None)
+            if forward is not None:
+                # Swash plate servo - undo the mixing to get the collective & cyclic
+                lateral = servo.lateral_position
+                collective += position
+                cyclic_pitch += position * forward
+                cyclic_roll += position * lateral
+                forward_sum += forward * forward
+                lateral_sum += lateral * lateral
+                swash_count += 1
+            elif hasattr(servo, 'max_deflection'):
+                # Tail servo - -ve position turns the heli left (+ve yaw)
+                tail_yaw = -position / servo.max_deflection
+        if swash_count:
+            collective /= swash_count
+        cyclic_pitch = cyclic_pitch / forward_sum if forward_sum else 0.0
+        cyclic_roll = cyclic_roll / lateral_sum if lateral_sum else 0.0
+        # Thrust (g) and height
+        self.thrust = rotor_effect / self.hover_rotor_speed ** 2 * max(0.0, 1 + self.lift_per_collective_degree * collective)
+        if self.airborne or self.thrust > 1:
+            self.airborne = True
+            self.vertical_speed += ((self.thrust - 1) * 9.81 - self.vertical_drag * self.vertical_speed) * dt
+            self.height += self.vertical_speed * dt
+            if self.height <= 0:
+                # Back on the ground
+                self.height = 0.0
+                self.vertical_speed = 0.0
+                self.airborne = False
+        if not self.airborne:
+            # Sat on its skids
+            self.pitch = self.roll = 0.0
+            self.rates = [0.0, 0.0, 0.0]
+            return
+        pitch_rate, roll_rate, yaw_rate = self.rates
+        pitch_rate += (self.cyclic_authority * rotor_effect * cyclic_pitch - self.rate_damping * pitch_rate) * dt
+        roll_rate += (self.cyclic_authority * rotor_effect * cyclic_roll - self.rate_damping * roll_rate) * dt
+        settled_yaw_rate = rotor_effect * (self.tail_authority * tail_yaw - self.rotor_torque_yaw_rate)
+        yaw_rate += dt / (self.yaw_time_constant + dt) * (settled_yaw_rate - yaw_rate)
+        self.pitch += pitch_rate * dt
+        self.roll += roll_rate * dt
+        self.rates = [pitch_rate, roll_rate, yaw_rate]
+
+    def read_motion(self):
+        """
+        Returns the true [ax, ay, az] (g) and [gx, gy, gz] (deg/s) in the body axes (x forwards, y left, z up).
+        The accelerations are the specific force the accelerometer would feel: gravity (tipped by the attitude) on the
+        ground, plus the rotor's extra thrust once it's airborne
+        """
+        self.advance()
+        pitch = math.radians(self.pitch)
+        roll = math.radians(self.roll)
+        lift = self.thrust if self.airborne else 1.0
+        # +ve pitch is nose down, +ve roll is right side down
+        acceleration = [-math.sin(pitch), math.sin(roll) * math.cos(pitch), lift * math.cos(roll) * math.cos(pitch)]
+        pitch_rate, roll_rate, yaw_rate = self.rates
+        # Gyro x measures roll rate, y pitch rate and z yaw rate
+        return acceleration, [roll_rate, pitch_rate, yaw_rate]
+
+    @property
+    def servo_positions(self):
+        """ Where each servo actually is (after slewing), by GPIO pin """
+        return dict(self._servo_positions)
+
+    def __str__(self):
+        return (f"rotor speed: {self.rotor_speed:.2f}, {'airborne' if self.airborne else 'on the ground'}, "
+                f"height: {self.height:.2f}m, pitch/roll: {self.pitch:.1f}/{self.roll:.1f}deg, "
+                f"rates: {', '.join(f'{rate:.1f}' for rate in self.rates)}deg/s")
+
+
+# The simulated heli the devices attach themselves to
+heli = SimHelicopter()
+
+
+class Motor:
+    """ Simulated ESC/motor """
+
+    # Time taken by each pulse-width write, setting up the GPIO and arming the ESC
+    write_latency = 0.0
+    init_latency = 0.0
+    arm_latency = 0.0
+    # If set, called with (motor, speed) after each write - e.g. to time when the writes happen
+    on_write = None
+
+    def __init__(self, gpio_pin:int=4, esc_max_pulse_length:int=2000, esc_min_pulse_length:int=700):
+        self.gpio_pin = gpio_pin
+        self.esc_max_pulse_length = esc_max_pulse_length
+        self.esc_min_pulse_length = esc_min_pulse_length
+        self.armed = False
+        self.speed = 0
+        self.writes = 0
+        _hardware_delay(self.init_latency)
+        heli.attach_motor(self)
+
+    def arm(self):
+        _hardware_delay(self.arm_latency)
+        heli.advance()
+        self.armed = True
+        self.speed = 0
+
+    def estop(self):
+        heli.advance()
+        self.speed = 0
+
+    def spin_down(self):
+        heli.advance()
+        self.speed = 0
+
+    def spin_up(self, limit=0.3, stop_after_initial_spin=True):
+        # The rotor model takes care of how long it actually takes to get up to speed
+        heli.advance()
+        self.speed = 0 if stop_after_initial_spin else limit
+
+    def set_motor_speed(self, speed):
+        self.writes += 1
+        _hardware_delay(self.write_latency)
+        heli.advance()
+        self.speed = speed
+        if Motor.on_write:
+            Motor.on_write(self, speed)
+
+
+class Servo:
+    """ Simulated servo """
+
+    # Time taken by each pulse-width write, and setting up the GPIO
+    write_latency = 0.0
+    init_latency = 0.0
+    # If set, called with (servo, position) after each write
+    on_write = None
+    _increment_size = 1
+
+    def __init__(self, gpio_pin:int, centre_offset:int=0, invert_up_down:bool = False):
+        self.gpio_pin = gpio_pin
+        self.centre_offset = centre_offset
+        self.invert_up_down = invert_up_down
+        self.current_position = 0
+        self.writes = 0
+        _hardware_delay(self.init_latency)
+        heli.attach_servo(self)
+
+    def set_position(self, position):
+        self.writes += 1
+        _hardware_delay(self.write_latency)
+        heli.advance()
+        self.current_position = position
+        if Servo.on_write:
+            Servo.on_write(self, position)
+
+    def centre(self):
+        self.set_position(0)
+
+    def increment(self):
+        self.set_position(self.current_position + self._increment_size)
+
+    def decrement(self):
+        self.set_position(self.current_position - self._increment_size)
+
+
+class Gyro:
+    """
+    Simulated accelerometer/gyro, reading the motion of the simulated heli plus a little sensor noise (and more from
+    rotor vibration). With 'world' set to None it reads 'true_acceleration'/'true_rates' instead, which can be set to
+    whatever's wanted (normalised, like the readings)
+    """
+
+    # Time taken by each I2C transaction, and waking up/configuring the sensor
+    read_latency = 0.0
+    init_latency = 0.0
+    noise = 0.01
+
+    def __init__(self, normalise_rates=True, gyro_normalisation_values=(1, 1, 1),
+                 acceleration_normalisation_values=(1, 1, 1), world=heli):
+        self.gyro_normalisation_values = list(gyro_normalisation_values)
+        self.acceleration_normalisation_values = list(acceleration_normalisation_values)
+        self.normalise_rates = normalise_rates
+        self.world = world
+        self.random = random.Random(0)
+        # True values the noise is added to when there's no world - can be set to simulate movement
+        self.true_acceleration = [0, 0, 1]
+        self.true_rates = [0, 0, 0]
+        self.reads = 0
+        self.calibrated = False
+        _hardware_delay(self.init_latency)
+
+    def calibrate(self):
+        self.calibrated = True
+
+    def get_acceleration(self):
+        return self.read_motion()[:3]
+
+    def get_gyro(self):
+        return self.read_motion()[3:]
+
+    def read_motion(self):
+        """ Accelerations and rates together, in one 'transaction' """
+        self.reads += 1
+        _hardware_delay(self.read_latency)
+        if self.world is None:
+            true_values = self.true_acceleration + self.true_rates
+            noise = self.noise
+        else:
+            acceleration, rates = self.world.read_motion()
+            if self.normalise_rates:
+                rates = [rate / scale for rate, scale in zip(rates, self.gyro_normalisation_values)]
+            acceleration = [value / scale for value, scale in zip(acceleration, self.acceleration_normalisation_values)]
+            true_values = acceleration + rates
+            noise = self.noise + self.world.vibration * self.world.rotor_speed
+        return [value + self.random.gauss(0, noise) for value in true_values]
+
+
+class ImuBurstReader:
+    """ Reads all six axes of the simulated Gyro at once - the simulated version of imu_sampler.Mpu6050BurstReader """
+
+    def __init__(self, gyro, **settings):
+        self.gyro = gyro
+
+    def read_motion(self):
+        return self.gyro.read_motion()
+
+
+def _hardware_delay(duration):
+    """ Block for the length of the transaction. Like the real drivers waiting on the bus/pigpiod, this releases the GIL """
+    if duration:
+        sleep(duration)
@@ -0,0 +1,296 @@
+"""
+Soak test for the heli server: runs it (on the simulated hardware, in real time) in a process of its own, loads it
+with a LoadGenerator from this one for as long as asked, and every 'interval' reports what the server's doing under
+that load:
+ - decode throughput: demand frames read, decoded and handed over a second, against the frames sent (and the mean
+   time decoding one takes, from the server's own stage timings)
+ - queueing delay: from a frame being sent to it being handed to the pilot - mostly time spent sat in the socket
+   buffers waiting for its connection's thread to get round to it (p50/p99 from the bucket it falls in, and the max)
+ - memory: the server process's resident set, and how fast it's growing (a straight line fitted through it, once
+   it's warmed up)
+ - CPU: the server process's (100% = one core), split from the load generator's by being in its own process
+plus the pilot's control loop overruns. Each report's also appended as a JSON line to the report file, if given.
+At the end the run's checked against LIMITS (or a JSON file overriding some of them), and it exits non-zero if any
+are broken - so a run before and after a change makes a regression gate. A run that couldn't offer the load asked for
+(the generator fell behind, or a session's connection failed) fails too.
+Linux only (reads the server process's figures from /proc).
+Run from this directory with: python soak_test.py [seconds] [sessions] [rate_hz] [report file] [limits file]
+(A multi-hour soak is e.g. python soak_test.py 14400 8 1000 soak.jsonl)
+"""
+import json
+import multiprocessing
+import os
+import sys
+import time
+from threading import Lock, Thread
+import numpy as np
+os.environ['HELI_HARDWARE'] = 'sim'
+os.environ['HELI_SIM_TIME'] = 'real'
+from load_generator import LoadGenerator
+from stage_timing import BUCKET_EDGES
+
+# Seconds between reports
+INTERVAL = 10
+# What a run has to stay within. Memory growth's only checked once there's a long enough run after the warm up to fit
+# a line to
+LIMITS = {
+    # Frames the server handed over, as a fraction of those sent (the rest were still queued up at the end)
+    'min_decoded_fraction': 0.99,
+    'max_queueing_p99_ms': 25,
+    'max_rss_growth_mb_per_hour': 20,
+    'max_server_cpu_percent': 90,
+    'max_loop_overruns_per_minute': 60,
+}
+# Memory's left to settle for this long before its growth's measured (s) - or a quarter of the run, if that's shorter -
+# and needs at least this long after that to measure it over
+WARM_UP = 60
+MIN_GROWTH_SPAN = 60
+
+
+def quietly():
+    """ Keep a child process's chatter off the screen """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+
+def run_server(control):
+    """
+    The server process: a heli server on the simulated hardware, with its stage timings on. Replies to 'sample' on
+    the 'control' pipe with its counters (see server_counters), and shuts down on 'stop'
+    """
+    quietly()
+    from helicopter import HelicopterConfig
+    from heli_server import HelicopterServer, HeliServerConnectionHandler
+    from stage_timing import StageTimer, timings
+
+    class SoakHandler(HeliServerConnectionHandler):
+        """ Counts the demand frames handed over, and times how long each was queued for """
+
+        # Every connection's, for the counts to be totalled from
+        handlers = []
+        handlers_lock = Lock()
+
+        def setup(self):
+            super().setup()
+            self.frames = 0
+            # (One per connection, so each is only recorded from its own thread)
+            self.queueing = StageTimer('queueing', "Demand frame sent -> handed to the pilot", timings)
+            self.max_queueing = 0.0
+            with self.handlers_lock:
+                self.handlers.append(self)
+
+        def apply_demands(self, sequence, sent_time, demands):
+            if sent_time is not None:
+                # (The controller's on the same box, so its clock's the same)
+                queued = time.time() - sent_time
+                self.queueing.record(queued)
+                self.max_queueing = max(self.max_queueing, queued)
+            self.frames += 1
+            super().apply_demands(sequence, sent_time, demands)
+
+    def server_counters(session):
+        with SoakHandler.handlers_lock:
+            handlers = list(SoakHandler.handlers)
+        queueing = np.sum([handler.queueing.counts for handler in handlers], axis=0).tolist() if handlers else []
+        decode = timings.stage('server_decode')
+        pilot = session.pilot
+        loop_stats = pilot.telemetry_state()[5] if pilot is not None else (0, 0, 0, 0)
+        return {'frames': sum(handler.frames for handler in handlers),
+                'ignored': sum(handler.ignored_demands for handler in handlers),
+                'queueing_counts': queueing,
+                'queueing_max': max((handler.max_queueing for handler in handlers), default=0.0),
+                'decode_count': decode.count, 'decode_total': decode.total,
+                'loop_iterations': int(loop_stats[0]), 'loop_overruns': int(loop_stats[1]),
+                'connections': len(handlers)}
+
+    timings.enabled = True
+    config = HelicopterConfig()
+    config.recorder = {}
+    config.stats = {}
+    config.logging = {'level': 'warning'}
+    with HelicopterServer('127.0.0.1', 0, pilot_config=config, handler=SoakHandler) as server:
+        Thread(target=server.serve, daemon=True).start()
+        control.send(server.server_address[1])
+        while control.recv() == 'sample':
+            control.send(server_counters(server.session))
+        server.shutdown()
+
+
+def process_usage(pid):
+    """ (CPU time (s), resident set (MB)) of the process so far """
+    with open(f'/proc/{pid}/stat') as file:
+        # (Everything after the command name, which might have spaces in)
+        fields = file.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f'/proc/{pid}/status') as file:
+        rss = next(int(line.split()[1]) for line in file if line.startswith('VmRSS')) / 1024
+    return cpu, rss
+
+
+def bucket_percentile(counts, percent:float):
+    """ The upper edge (s) of the StageTimer bucket the 'percent'th percentile falls in (inf if it's the overflow) """
+    wanted = percent / 100 * sum(counts)
+    total = 0
+    for edge, count in zip(BUCKET_EDGES + (float('inf'),), counts):
+        total += count
+        if total >= wanted:
+            return edge
+    return float('inf')
+
+
+class SoakSample:
+    """
+    One report: the server's counters and the load generator's, taken together, and what's changed since the
+    'previous' report (or, without one, it's the baseline the first report's taken against)
+    """
+
+    def __init__(self, elapsed:float, counters:dict, usage, frames_sent:int, previous=None):
+        self.elapsed = elapsed
+        self.counters = counters
+        self.cpu, self.rss = usage
+        self.frames_sent = frames_sent
+        if previous is None:
+            return
+        span = elapsed - previous.elapsed
+        frames = counters['frames'] - previous.counters['frames']
+        decoded = counters['decode_count'] - previous.counters['decode_count']
+        self.decode_rate = frames / span
+        self.send_rate = (frames_sent - previous.frames_sent) / span
+        self.decode_time = (counters['decode_total'] - previous.counters['decode_total']) / decoded if decoded else 0.0
+        self.cpu_percent = 100 * (self.cpu - previous.cpu) / span
+        self.loop_overruns = counters['loop_overruns'] - previous.counters['loop_overruns']
+        queueing = np.array(counters['queueing_counts'], dtype=np.int64)
+        if len(previous.counters['queueing_counts']):
+            queueing = queueing - np.array(previous.counters['queueing_counts'], dtype=np.int64)
+        self.queueing_p50 = bucket_percentile(queueing, 50)
+        self.queueing_p99 = bucket_percentile(queueing, 99)
+
+    def as_dict(self):
+        return {'elapsed': round(self.elapsed, 3), 'frames_sent': self.frames_sent,
+                'frames_decoded': self.counters['frames'], 'frames_ignored': self.counters['ignored'],
+                'send_rate': round(self.send_rate, 1), 'decode_rate': round(self.decode_rate, 1),
+                'decode_time_us': round(1e6 * self.decode_time, 2),
+                'queueing_p50_ms': 1000 * self.queueing_p50, 'queueing_p99_ms': 1000 * self.queueing_p99,
+                'queueing_max_ms': round(1000 * self.counters['queueing_max'], 3),
+                'server_rss_mb': round(self.rss, 2), 'server_cpu_percent': round(self.cpu_percent, 1),
+                'loop_iterations': self.counters['loop_iterations'], 'loop_overruns': self.loop_overruns,
+                'connections': self.counters['connections']}
+
+    header = (f"{'elapsed (s)':>12}{'sent/s':>9}{'decoded/s':>11}{'decode (us)':>13}{'queue p50/p99 (ms)':>20}"
+              f"{'max (ms)':>10}{'RSS (MB)':>10}{'CPU %':>7}{'overruns':>10}")
+
+    def __str__(self):
+        percentiles = f"<{1000 * self.queueing_p50:g}/<{1000 * self.queueing_p99:g}"
+        return (f"{self.elapsed:>12.0f}{self.send_rate:>9.0f}{self.decode_rate:>11.0f}{1e6 * self.decode_time:>13.1f}"
+                f"{percentiles:>20}{1000 * self.counters['queueing_max']:>10.1f}{self.rss:>10.1f}"
+                f"{self.cpu_percent:>7.1f}{self.loop_overruns:>10}")
+
+
+def rss_growth(samples, warm_up:float):
+    """ Growth of the server's resident set (MB/hour) after 'warm_up' s - None if there's not long enough to tell """
+    settled = [(sample.elapsed, sample.rss) for sample in samples if sample.elapsed >= warm_up]
+    if len(settled) < 3 or settled[-1][0] - settled[0][0] < MIN_GROWTH_SPAN:
+        return None
+    times, rss = np.array(settled).T
+    return float(np.polyfit(times, rss, 1)[0] * 3600)
+
+
+def check(baseline, samples, generator, limits):
+    """ The summary of the run (since the 'baseline' sample), and a list of the limits it broke """
+    last = samples[-1]
+    elapsed = last.elapsed
+    frames_sent = last.frames_sent - baseline.frames_sent
+    frames = last.counters['frames'] - baseline.counters['frames']
+    queueing = np.array(last.counters['queueing_counts']) - np.array(baseline.counters['queueing_counts'])
+    summary = {
+        'seconds': round(elapsed, 1),
+        'sessions': len(generator.sessions),
+        'rate_hz': generator.rate_hz,
+        'frames_sent': frames_sent,
+        'frames_decoded': frames,
+        'decoded_fraction': frames / frames_sent if frames_sent else 0.0,
+        'decode_rate': frames / elapsed,
+        'decode_time_us': 1e6 * last.counters['decode_total'] / max(1, last.counters['decode_count']),
+        'queueing_p99_ms': 1000 * bucket_percentile(queueing, 99),
+        'queueing_max_ms': 1000 * last.counters['queueing_max'],
+        'rss_start_mb': baseline.rss,
+        'rss_end_mb': last.rss,
+        'rss_growth_mb_per_hour': rss_growth(samples, min(WARM_UP, elapsed / 4)),
+        'server_cpu_percent': 100 * (last.cpu - baseline.cpu) / elapsed,
+        'loop_overruns_per_minute': 60 * (last.counters['loop_overruns'] - baseline.counters['loop_overruns']) / elapsed,
+        'frames_missed_by_generator': generator.missed,
+        'failed_sessions': len(generator.errors),
+    }
+    broken = []
+    if generator.missed or generator.errors:
+        broken.append(f"the load asked for wasn't offered: {generator.missed} frames missed by the generator, "
+                      f"{len(generator.errors)} sessions failed ({', '.join(str(error) for error in generator.errors)})")
+    for limit, value in limits.items():
+        measured = summary[limit[len('min_') if limit.startswith('min_') else len('max_'):]]
+        if value is None or measured is None:
+            continue
+        if (measured < value) if limit.startswith('min_') else (measured > value):
+            broken.append(f"{limit}: {measured:.3f} (limit {value})")
+    return summary, broken
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    rate_hz = float(sys.argv[3]) if len(sys.argv) > 3 else 500
+    report_path = sys.argv[4] if len(sys.argv) > 4 else None
+    limits = dict(LIMITS)
+    if len(sys.argv) > 5:
+        with open(sys.argv[5]) as limits_file:
+            limits.update(json.load(limits_file))
+        unknown = set(limits) - set(LIMITS)
+        if unknown:
+            raise ValueError(f"Unknown limits: {sorted(unknown)}. Expected some of {list(LIMITS)}")
+    context = multiprocessing.get_context('fork')
+    control, server_end = context.Pipe()
+    server = context.Process(target=run_server, args=(server_end,), daemon=True)
+    server.start()
+    port = control.recv()
+    interval = min(INTERVAL, seconds / 4)
+    generator = LoadGenerator('127.0.0.1', port, sessions, rate_hz).start()
+    print(f"Soaking the server (pid {server.pid}) with {sessions} sessions at {rate_hz:g}Hz for {seconds:g}s, "
+          f"on {os.cpu_count()} CPUs (100% CPU = one core)")
+    print(SoakSample.header)
+    samples = []
+    report = open(report_path, 'a') if report_path else None
+    try:
+        # Everything's measured from here - once all the sessions are streaming
+        started = time.monotonic()
+        control.send('sample')
+        baseline = SoakSample(0.0, control.recv(), process_usage(server.pid), generator.frames_sent)
+        end = started + seconds
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            time.sleep(min(interval, end - now))
+            control.send('sample')
+            sample = SoakSample(time.monotonic() - started, control.recv(), process_usage(server.pid),
+                                generator.frames_sent, samples[-1] if samples else baseline)
+            samples.append(sample)
+            print(sample)
+            if report:
+                report.write(json.dumps(sample.as_dict()) + "\n")
+                report.flush()
+    finally:
+        generator.stop()
+        control.send('stop')
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    summary, broken = check(baseline, samples, generator, limits)
+    if report:
+        report.write(json.dumps({'summary': summary, 'limits': limits, 'broken': broken}) + "\n")
+        report.close()
+    print(f"\n{generator}")
+    print("\n".join(f"{name:>28}: {value:.2f}" if isinstance(value, float) else f"{name:>28}: {value}"
+                    for name, value in summary.items()))
+    if broken:
+        print("FAILED:\n  " + "\n  ".join(broken))
+        sys.exit(1)
+    print("Within all the limits")
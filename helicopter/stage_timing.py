@@ -0,0 +1,189 @@
+"""
+Timing histograms for each stage of the demand -> actuator path (socket reads, decoding, the pilot's loop, IMU reads,
+servo writes...), and a loopback HTTP endpoint serving them in Prometheus text format.
+
+Each stage gets a StageTimer from the module's 'timings'. Code being timed calls start() as it enters the stage and
+stop() as it leaves:
+
+    _decode_timer = timings.stage('server_decode', "Decoding a demand frame")
+    ...
+    started = _decode_timer.start()
+    demands = codec.decode(data)
+    _decode_timer.stop(started)
+
+While timing's turned off start() returns None and stop() ignores it, so it costs next to nothing. It can be turned
+on and off at runtime (timings.enabled, or POST /enable and /disable to the endpoint).
+"""
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# Upper edges of the histogram buckets (s). Anything slower lands in the final overflow bucket
+BUCKET_EDGES = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+                5e-2, 0.1)
+
+
+class StageTimer:
+    """
+    Histogram of how long one stage takes.
+    No locks: each stage is only timed from one thread at a time, so the counts are just incremented. A reader can
+    catch a sample half recorded (counted but not yet in the total), which only skews a scrape by one sample
+    """
+    __slots__ = ['name', 'description', 'timings', 'counts', 'total']
+
+    def __init__(self, name, description, timings):
+        self.name = name
+        self.description = description
+        self.timings = timings
+        self.counts = [0] * (len(BUCKET_EDGES) + 1)
+        self.total = 0.0
+
+    def start(self):
+        """ The time the stage started, or None if timing's turned off """
+        return time.perf_counter() if self.timings.enabled else None
+
+    def stop(self, started):
+        """ Record the stage as finished now, if it was timed from start() """
+        if started is not None:
+            self.record(time.perf_counter() - started)
+
+    def record(self, duration:float):
+        self.counts[bisect_left(BUCKET_EDGES, duration)] += 1
+        self.total += duration
+
+    def reset(self):
+        self.counts = [0] * (len(BUCKET_EDGES) + 1)
+        self.total = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def __str__(self):
+        count = self.count
+        mean = self.total / count if count else 0.0
+        return f"{self.name}: {count} timed, mean {1e6 * mean:.1f}us"
+
+
+class StageTimings:
+    """ All the stage timers, and whether they're timing """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+
+    def stage(self, name, description=""):
+        """ The timer for stage 'name', created the first time it's asked for """
+        timer = self.stages.get(name)
+        if timer is None:
+            timer = self.stages[name] = StageTimer(name, description, self)
+        return timer
+
+    def timed(self, function, stage, description=""):
+        """ Wrap 'function' so each call to it is timed as 'stage' """
+        timer = self.stage(stage, description)
+        def timed_function(*args):
+            started = timer.start()
+            result = function(*args)
+            timer.stop(started)
+            return result
+        return timed_function
+
+    def reset(self):
+        for timer in self.stages.values():
+            timer.reset()
+
+    def prometheus_text(self):
+        """ The histograms (and whether timing's on) in Prometheus text exposition format """
+        lines = ["# HELP heli_stage_seconds Time taken by each stage of the demand to actuator path",
+                 "# TYPE heli_stage_seconds histogram"]
+        for name, timer in sorted(self.stages.items()):
+            # Take a copy first, so the buckets agree with each other even if the stage is recorded mid-scrape
+            counts = list(timer.counts)
+            total = timer.total
+            cumulative = 0
+            for edge, count in zip(BUCKET_EDGES, counts):
+                cumulative += count
+                lines.append(f'heli_stage_seconds_bucket{{stage="{name}",le="{edge:g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'heli_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {cumulative}')
+            lines.append(f'heli_stage_seconds_sum{{stage="{name}"}} {total:.9f}')
+            lines.append(f'heli_stage_seconds_count{{stage="{name}"}} {cumulative}')
+        lines += ["# HELP heli_stage_timing_enabled Whether the stages are being timed",
+                  "# TYPE heli_stage_timing_enabled gauge",
+                  f"heli_stage_timing_enabled {int(self.enabled)}"]
+        return "\n".join(lines) + "\n"
+
+    def __str__(self):
+        return ", ".join(str(timer) for timer in self.stages.values())
+
+
+# The timers everything's timed with
+timings = StageTimings()
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics for the histograms. POST /enable or /disable to turn timing on or off, and /reset to clear the
+    histograms
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self._reply(self.server.timings.prometheus_text())
+
+    def do_POST(self):
+        timings = self.server.timings
+        if self.path == '/enable':
+            timings.enabled = True
+        elif self.path == '/disable':
+            timings.enabled = False
+        elif self.path == '/reset':
+            timings.reset()
+        else:
+            self.send_error(404)
+            return
+        self._reply(f"stage timing {'enabled' if timings.enabled else 'disabled'}\n")
+
+    def _reply(self, text):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't clutter the server's output with every scrape
+        pass
+
+
+class StatsEndpoint:
+    """ Serves 'timings' over HTTP on its own thread. Binds to loopback unless told otherwise - it's not for the world """
+
+    def __init__(self, timings=timings, host='127.0.0.1', port:int=9101):
+        self.server = ThreadingHTTPServer((host, port), StatsRequestHandler)
+        self.server.timings = timings
+        self.thread = None
+
+    @classmethod
+    def from_config(cls, settings, timings=timings):
+        """ From the 'stats' section of the heli config. Also turns the timing on if 'stage_timing' is set """
+        timings.enabled = settings.get('stage_timing', timings.enabled)
+        return cls(timings, settings.get('host', '127.0.0.1'), settings.get('port', 9101))
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,115 @@
+"""
+Bringing the hardware up: checking pigpiod's there, initialising devices that don't depend on each other at the same
+time, and a timeline of how long each step took.
+
+    timeline = StartupTimeline()
+    timeline.run('pigpiod', ensure_pigpiod)
+    motor, gyro = timeline.run_parallel(motor=lambda: Motor(**settings), gyro=Gyro).values()
+    print(timeline)
+"""
+import os
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, current_thread, local
+
+# Where the pigpio library looks for the daemon, unless told otherwise (by the same environment variables it uses)
+PIGPIO_HOST = os.environ.get('PIGPIO_ADDR', 'localhost')
+PIGPIO_PORT = int(os.environ.get('PIGPIO_PORT', 8888))
+
+
+def pigpio_available(host=PIGPIO_HOST, port:int=PIGPIO_PORT, timeout:float=0.1):
+    """ Whether pigpiod is accepting connections """
+    try:
+        with socket.create_connection((host, port), timeout):
+            return True
+    except OSError:
+        return False
+
+
+def ensure_pigpiod(start_timeout:float=5, poll_interval:float=0.05):
+    """
+    Start pigpiod if it's not already running, and wait for it to accept connections. Returns True once it's up,
+    False if it hasn't come up within 'start_timeout'
+    """
+    if pigpio_available():
+        return True
+    print("pigpiod isn't running, starting it")
+    # (No shell needed. Keep its error log off the screen)
+    subprocess.run(['sudo', 'pigpiod'], stderr=subprocess.DEVNULL)
+    give_up = time.monotonic() + start_timeout
+    while not pigpio_available():
+        if time.monotonic() > give_up:
+            print(f"pigpiod didn't start within {start_timeout}s")
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+class StartupTimeline:
+    """
+    Records how long each startup step takes (and which thread it ran on), and runs steps that don't depend on each
+    other in parallel. With 'parallel' False, run_parallel() runs them one after the other instead - e.g. to see
+    what it's saving
+    """
+
+    # Width of the bars in the report
+    _bar_width = 40
+
+    def __init__(self, parallel=True, clock=time.perf_counter):
+        self.parallel = parallel
+        self.clock = clock
+        self.started = clock()
+        # (name, the step it ran within (or None), thread, start, end) - times (s) since the timeline started
+        self.steps = []
+        self._lock = Lock()
+        # The step each thread's in the middle of
+        self._current = local()
+
+    def run(self, name, function, *args, within=None):
+        """ Run one step, returning what it returns. It's part of whichever step it's run from, unless 'within' says """
+        parent = within or getattr(self._current, 'step', None)
+        self._current.step = name
+        start = self.clock()
+        try:
+            return function(*args)
+        finally:
+            end = self.clock()
+            self._current.step = parent if within is None else None
+            with self._lock:
+                self.steps.append((name, parent, current_thread().name, start - self.started, end - self.started))
+
+    def run_parallel(self, **functions):
+        """
+        Run each of the (named) functions as a step, all at once. Returns {name: result} once they've all finished.
+        If any raised, the first one's exception is raised (once the rest have finished, so nothing's left half done)
+        """
+        if not self.parallel or len(functions) < 2:
+            return {name: self.run(name, function) for name, function in functions.items()}
+        parent = getattr(self._current, 'step', None)
+        with ThreadPoolExecutor(max_workers=len(functions), thread_name_prefix='startup') as pool:
+            futures = {name: pool.submit(self.run, name, function, within=parent) for name, function in functions.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    @property
+    def elapsed(self):
+        """ From the timeline starting to the last step finishing (s) """
+        return max((end for *_, end in self.steps), default=0.0)
+
+    def __str__(self):
+        elapsed = self.elapsed
+        scale = self._bar_width / elapsed if elapsed else 0
+        parents = {name: parent for name, parent, *_ in self.steps}
+        lines = [f"{'step':<28}{'start (ms)':>11}{'took (ms)':>11}  {'thread':<12}"]
+        # Each step followed by the ones it ran within it (indented), in the order they started
+        def add_steps(parent, depth):
+            for name, _, thread, start, end in sorted((step for step in self.steps if step[1] == parent), key=lambda step: step[3]):
+                bar = ' ' * round(start * scale) + '#' * max(1, round((end - start) * scale))
+                lines.append(f"{'  ' * depth + name:<28}{1000 * start:>11.1f}{1000 * (end - start):>11.1f}  {thread:<12}|{bar}")
+                add_steps(name, depth + 1)
+        add_steps(None, 0)
+        # What it'd all take one step after another - just the steps that didn't have others run within them
+        serial = sum(end - start for name, _, _, start, end in self.steps if name not in parents.values())
+        lines.append(f"{len(self.steps)} steps in {1000 * elapsed:.1f}ms ({1000 * serial:.1f}ms one after the other)")
+        return "\n".join(lines)
@@ -1,39 +1,83 @@
 """ Code for all swash plate admin """
 import math
-from pithonwy.actuators.servo import Servo
+from hardware import Servo
+from stage_timing import timings
+
+_mix_timer = timings.stage('swash_mix', "Mixing collective/pitch/roll into swash plate servo positions")
 
 class SwashPlate:
-    def __init__(self, right, left, rear):
-        right_servo = SwashPlateServo(**right)
-        left_servo = SwashPlateServo(**left)
-        rear_servo = SwashPlateServo(**rear)
-        self.servos = [right_servo, left_servo, rear_servo]
+    def __init__(self, max_servo_delta:float=15, timeline=None, **servos):
+        """
+        'servos' are the settings for each of the swash plate servos, keyed by name (e.g. right/left/rear for the
+        standard 120 degree CCPM layout). Any number of servos, at any angles, can be used.
+        'max_servo_delta' is the servo movement that corresponds to a demand of 1.
+        With a StartupTimeline, the servos are brought up together (and timed) on it
+        """
+        if not servos:
+            raise ValueError("At least one swash plate servo is required")
+        if timeline is None:
+            self.servos = [SwashPlateServo(**settings) for settings in servos.values()]
+        else:
+            self.servos = list(timeline.run_parallel(**{f'swash_servo_{name}': lambda settings=settings: SwashPlateServo(**settings)
+                                                        for name, settings in servos.items()}).values())
+        # Work out how much each servo needs to move for collective/pitch/roll once, rather than on every update
+        self.mixer = SwashPlateMixer([(servo.forward_position, servo.lateral_position) for servo in self.servos], max_servo_delta)
         # Store the target values separately, so we can update them individually without affecting the other one(s)
         self._collective = 0
         self._pitch = 0
         self._roll = 0
+        # Whether the servos might not be where the targets put them (e.g. they've been moved directly)
+        self._moved = True
+        # Output stage channels for the servos, if the writes are going via one
+        self.outputs = None
+        self.output_channels = None
+    def attach_outputs(self, outputs, resolution:float):
+        """ Send servo positions via 'outputs' (an OutputStage) rather than writing them straight to the servos """
+        self.outputs = outputs
+        self.output_channels = [outputs.add_channel(f'swash_{i}', timings.timed(servo.set_position, 'swash_servo_write', "Writing a swash plate servo position"), resolution)
+                                for i, servo in enumerate(self.servos)]
+    def _servos_moved_directly(self):
+        """ The servos have been moved without going via the output stage, so it can't trust its cache anymore """
+        self._moved = True
+        if self.outputs:
+            self.outputs.invalidate(*self.output_channels)
     def level(self):
         """ Set the swash-plate to its 'level' position """
+        self._servos_moved_directly()
         [s.centre() for s in self.servos]
     def rise(self):
         """ Raise the swashplate uniformly """
+        self._servos_moved_directly()
         [servo.increment() for servo in self.servos]
     def lower(self):
         """ Lower the swashplate uniformly """
+        self._servos_moved_directly()
         [servo.decrement() for servo in self.servos]
     def update_position(self):
         """ Updates the position of the swashplate to match the current collective/pitch/roll targets """
-        # The servo movement that would correspond to a value of '1' (if the position of the servo is also '1')
-        # TODO: Get this value from somewhere more appropriate than hard coding it here
-        max_servo_delta=15
         # print(f'Current swashplate targets; Collective: {self._collective}, Pitch: {self._pitch}, Roll: {self._roll}')
-        for servo in self.servos:
-            # Get the amount we need to move this servo
-            servo_target_raw = self._collective + self._roll * servo.lateral_position + self._pitch * servo.forward_position
-            # Limit the demand to -1 <= demand <= +1
-            servo_target = max_servo_delta * max(-1,min(1,servo_target_raw))
-            servo.set_position(servo_target)
-            # print(f'Servo "{servo.forward_position},{servo.lateral_position}" target value: {servo_target}')
+        started = _mix_timer.start()
+        servo_targets = self.mixer.mix(self._collective, self._pitch, self._roll)
+        _mix_timer.stop(started)
+        self._moved = False
+        if self.outputs:
+            for channel, servo_target in zip(self.output_channels, servo_targets):
+                self.outputs.set(channel, servo_target)
+        else:
+            for servo, servo_target in zip(self.servos, servo_targets):
+                servo.set_position(servo_target)
+    def set_attitude(self, collective:float, pitch:float, roll:float):
+        """
+            Set the height, pitch and roll of the swashplate (each -1 -> +1) in one go, so each servo is only moved once.
+            Signs are as for set_height(), set_pitch() and set_roll()
+        """
+        if not self._moved and collective == self._collective and pitch == self._pitch and roll == self._roll:
+            # Nothing to move - e.g. the pilot holding the same attitude on the ground
+            return
+        self._collective = collective
+        self._pitch = pitch
+        self._roll = roll
+        self.update_position()
     def set_height(self,height:float):
         """ 
             Set the height of the swashplate to 'height' (-1 -> +1) without altering its orientation. 
@@ -82,6 +126,22 @@ class SwashPlate:
         # print(f'The current offsets are: "right": {self.right_servo.current_position}, "left":{self.left_servo.current_position}, "rear":{self.rear_servo.current_position}')
         
 
+class SwashPlateMixer:
+    """
+    Mixing matrix to convert the swash plate collective/pitch/roll targets into servo positions.
+    Each row holds the (collective, pitch, roll) coefficients for one servo, worked out from where the servo sits
+    around the swash plate.
+    """
+    def __init__(self, servo_positions, max_servo_delta:float=15):
+        """ 'servo_positions' is a list of (forward_position, lateral_position) for each servo - see SwashPlateServo """
+        self.max_servo_delta = max_servo_delta
+        self.matrix = tuple((1, forward_position, lateral_position) for forward_position, lateral_position in servo_positions)
+    def mix(self, collective:float, pitch:float, roll:float):
+        """ Returns the target position for each servo """
+        limit = self.max_servo_delta
+        # Limit each servo's demand to -1 <= demand <= +1 before scaling it to a servo movement
+        return [limit * max(-1, min(1, c * collective + p * pitch + r * roll)) for c, p, r in self.matrix]
+
 class SwashPlateServo(Servo):
     __slots__ = ['forward_position','lateral_position']
     def __init__(self, position_angle:int, gpio_pin:int, centre_offset:int=0, invert_up_down:bool = False):
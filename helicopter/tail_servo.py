@@ -1,8 +1,18 @@
-from pithonwy.actuators.servo import Servo
+from hardware import Servo
 
 class TailServo(Servo):
     """ Class to hold tail servo specific admin here if required """
 
-    def __init__(self, gpio_pin:int, centre_offset:int=0, invert_up_down:bool = False):
+    def __init__(self, gpio_pin:int, centre_offset:int=0, invert_up_down:bool = False, max_deflection:float=15):
         # Create the servo instance to drive the physical servo
         super().__init__(gpio_pin=gpio_pin, centre_offset=centre_offset, invert_up_down=invert_up_down)
+        # The servo movement that corresponds to a yaw demand of 1
+        self.max_deflection = max_deflection
+
+    def position_for_yaw(self, amount:float):
+        """ Servo position for a yaw demand of 'amount' (-1 -> +1). +ve turns the heli left (as for decrement()) """
+        return -self.max_deflection * max(-1, min(1, amount))
+
+    def set_yaw(self, amount:float):
+        """ Move the tail to the position for a yaw demand of 'amount' (-1 -> +1). +ve turns the heli left """
+        self.set_position(self.position_for_yaw(amount))
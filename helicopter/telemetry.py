@@ -0,0 +1,69 @@
+""" Sends the heli's state back to the controller at a fixed rate """
+import math
+import time
+from threading import Thread
+import hardware
+from heli_protocol import TelemetryFrameCodec
+from loop_scheduler import FixedRateScheduler
+
+
+class TelemetrySender:
+    """
+    Samples the pilot's state and writes it out as telemetry frames, on its own thread at 'rate_hz'.
+    Only reads what the pilot's already worked out (see HelicopterPilot.telemetry_state), so it never holds up the
+    control loop. If a write fails (e.g. the controller's gone), it just stops.
+    """
+
+    def __init__(self, pilot, write, rate_hz:float, demand_echo, control_state=None):
+        """
+        'write' sends a frame's bytes, and 'demand_echo' returns (sequence, sent time, arrival time (time.monotonic()))
+        of the newest demand frame, or None if there hasn't been one. 'control_state' returns (in control, control
+        offered) for the connection the frames are going to
+        """
+        self.pilot = pilot
+        self.write = write
+        self.demand_echo = demand_echo
+        self.control_state = control_state
+        self.codec = TelemetryFrameCodec()
+        # Paced by the hardware's clock, so it keeps step with a simulation running faster than real time
+        self.scheduler = FixedRateScheduler(rate_hz, clock=hardware.clock, sleep=hardware.sleep)
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.last_error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.scheduler.run, args=(self.send_frame, lambda: self.running), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def send_frame(self):
+        frame = self.encode_frame()
+        try:
+            self.write(frame)
+        except OSError as e:
+            self.last_error = e
+            self.running = False
+            return
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+
+    def encode_frame(self):
+        flying, rates, attitude, motor, servos, loop_stats = self.pilot.telemetry_state()
+        echo = self.demand_echo()
+        if echo is None:
+            demand_echo = (0, math.nan, 0.0)
+        else:
+            sequence, sent_time, arrival_time = echo
+            demand_echo = (sequence, sent_time, time.monotonic() - arrival_time)
+        in_control, control_offered = self.control_state() if self.control_state else (False, False)
+        return self.codec.encode(flying, rates, attitude, motor, loop_stats, demand_echo, servos, in_control, control_offered)
+
+    def __str__(self):
+        return f"frames sent: {self.frames_sent}, bytes sent: {self.bytes_sent}, send loop: {self.scheduler.stats}"
@@ -0,0 +1,105 @@
+"""
+Offline step response of the yaw rate PID, against the simulated IMU and a simple model of the heli's yaw.
+Runs in simulated time (so much faster than real time), with the gains from the heli config.
+Run with: python yaw_step_response.py [step_demand] [config_file]
+
+The yaw model is first order: the tail rotor thrust (from the tail servo position) and the main rotor torque
+(which grows with the motor speed) set the rate the heli settles to, with a lag from the airframe inertia.
+"""
+import os
+import sys
+# Always use the simulated hardware - this never goes near the heli
+os.environ['HELI_HARDWARE'] = 'sim'
+from helicopter import HelicopterConfig
+from hardware import Gyro
+from imu_sampler import ImuSampler, SAMPLE_RATES
+from pid import PIDController
+from tail_servo import TailServo
+
+# As used by the pilot
+PILOT_GYRO_NORMALISATION = [50, 50, 80]
+
+
+class YawModel:
+    """ Yaw rate (normalised, as read from the gyro) response to the tail servo position and the main rotor torque """
+
+    def __init__(self, max_deflection:float, time_constant:float=0.15, tail_authority:float=1.5,
+                 torque_per_speed:float=0.4):
+        self.max_deflection = max_deflection
+        # Yaw rate the tail alone would settle to at full deflection, and the main rotor's equivalent at full speed
+        self.tail_authority = tail_authority
+        self.torque_per_speed = torque_per_speed
+        self.time_constant = time_constant
+        self.rate = 0.0
+
+    def step(self, tail_position:float, motor_speed:float, dt:float):
+        # A -ve servo position turns the heli left (+ve yaw), and the main rotor torque pushes it right
+        settled_rate = -self.tail_authority * tail_position / self.max_deflection - self.torque_per_speed * motor_speed
+        self.rate += dt / (self.time_constant + dt) * (settled_rate - self.rate)
+        return self.rate
+
+
+def step_response(controller, tail, demand:float, motor_speed:float=0.5, duration:float=2.0, step_time:float=0.5,
+                  loop_rate_hz:float=200, imu_rate_hz:float=500, physics_rate_hz:float=2000):
+    """ Returns [(time, demand, measured rate, true rate, controller output)] for each control loop tick """
+    sim_time = 0.0
+    # Not attached to the simulated heli - the rates come from the model here
+    gyro = Gyro(normalise_rates=True, gyro_normalisation_values=PILOT_GYRO_NORMALISATION, world=None)
+    imu = ImuSampler(gyro, imu_rate_hz, clock=lambda: sim_time)
+    model = YawModel(tail.max_deflection)
+    physics_dt = 1 / physics_rate_hz
+    imu_every = round(physics_rate_hz / imu_rate_hz)
+    loop_every = round(physics_rate_hz / loop_rate_hz)
+    loop_dt = loop_every * physics_dt
+    tail_position = 0.0
+    trace = []
+    for tick in range(int(duration * physics_rate_hz)):
+        sim_time = tick * physics_dt
+        gyro.true_rates = [0, 0, model.step(tail_position, motor_speed, physics_dt)]
+        if tick % imu_every == 0:
+            # Take an IMU sample, as the sampler thread would at this time
+            imu.sample_once()
+        if tick % loop_every == 0:
+            # The pilot's control loop
+            yaw_demand = demand if sim_time >= step_time else 0.0
+            measured = imu.latest()[SAMPLE_RATES][2]
+            output = controller.update(yaw_demand, measured, loop_dt)
+            tail_position = tail.position_for_yaw(output)
+            trace.append((sim_time, yaw_demand, measured, model.rate, output))
+    return trace
+
+
+def step_metrics(trace, demand:float, step_time:float):
+    """ Rise time (10-90%), overshoot, 2% settling time and steady state error of the true rate after the step """
+    after = [(t - step_time, rate) for t, _, _, rate, _ in trace if t >= step_time]
+    start_rate = after[0][1]
+    span = demand - start_rate
+    fraction = [(t, (rate - start_rate) / span) for t, rate in after]
+    ten = next((t for t, f in fraction if f >= 0.1), float('nan'))
+    ninety = next((t for t, f in fraction if f >= 0.9), float('nan'))
+    overshoot = max(0.0, max(f for _, f in fraction) - 1)
+    settling = next((t for i, (t, _) in enumerate(fraction) if all(abs(f - 1) <= 0.02 for _, f in fraction[i:])), float('nan'))
+    # Average over the last 10% of the run, to smooth out the noise
+    tail_end = [rate for _, rate in after[-max(1, len(after) // 10):]]
+    steady_state_error = demand - sum(tail_end) / len(tail_end)
+    return {'rise_time': ninety - ten, 'overshoot': overshoot, 'settling_time': settling,
+            'steady_state_error': steady_state_error}
+
+def ms(seconds):
+    """ Milliseconds, or 'never' for a threshold the response didn't reach """
+    return 'never' if seconds != seconds else f"{1000 * seconds:.0f}ms"
+
+if __name__ == "__main__":
+    demand = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    config = HelicopterConfig(sys.argv[2]) if len(sys.argv) > 2 else HelicopterConfig()
+    step_time = 0.5
+    settings = config.gyro.get('yaw_rate_pid', {})
+    tail = TailServo(**config.tail_servo)
+    print(f"Yaw rate PID: {settings}. Step demand of {demand} at t={step_time}s, loop at 200Hz")
+    for label, controller in (("PID", PIDController.from_config(settings, kp=2.0)),
+                              ("P only", PIDController(settings.get('kp', 2.0)))):
+        trace = step_response(controller, tail, demand, step_time=step_time)
+        metrics = step_metrics(trace, demand, step_time)
+        print(f"{label:>8}: rise time {ms(metrics['rise_time'])}, overshoot {100 * metrics['overshoot']:.1f}%, "
+              f"settling time (2%) {ms(metrics['settling_time'])}, "
+              f"steady state error {metrics['steady_state_error']:+.3f}")
@@ -1,10 +1,23 @@
 """ Class to manage the connection to the helicopter server """
+import errno
 import json
 import socket
+import time
+import shared_modules
+from heli_protocol import (ENCODING_BINARY, ENCODING_JSON, PILOT_WAKEUP_REQUEST, DATAGRAM_REQUEST, DATAGRAM_PORT,
+                           TELEMETRY_REQUEST, TELEMETRY_RATE, TRANSPORT_TCP, TRANSPORT_UDP, CONTROL_HELD,
+                           HANDOVER_REQUEST, SESSION_ID, SESSION_TOKEN_SIZE, RESUME_REQUEST, demand_codec,
+                           encoding_request_byte, request_byte_encoding)
+from datagram_link import LossyDatagramSocket
+from telemetry_reader import TelemetryReader
 
 class ControllerConnection:
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, telemetry_thread:bool=True):
+        """
+        'telemetry_thread' False leaves reading the telemetry to the caller (see TelemetryReader.read_available), e.g.
+        from an event loop waiting on the connection
+        """
         # Read the config file
         with open(config_file,'r') as file:
             self.conf = json.load(file)
@@ -12,46 +25,224 @@ class ControllerConnection:
         if 'server_ip' not in self.conf or 'server_port' not in self.conf:
             raise ValueError("Error: 'server_ip' & 'server_port required in the config file")
 
+        # Binary demand frames unless told otherwise. JSON is still understood by the server as a fallback
+        self.requested_encoding = self.conf.get('demand_encoding', ENCODING_BINARY)
+        # Check it's an encoding we know about before we try to connect with it
+        encoding_request_byte(self.requested_encoding)
+        self.encoding = None
+        self.codec = None
+        # Demands go over the TCP connection unless told otherwise. With UDP, the TCP connection is kept for the handshake
+        self.transport = self.conf.get('demand_transport', TRANSPORT_TCP)
+        if self.transport not in (TRANSPORT_TCP, TRANSPORT_UDP):
+            raise ValueError(f"Error: 'demand_transport' must be '{TRANSPORT_TCP}' or '{TRANSPORT_UDP}'")
+        self.datagram_socket = None
+        # Telemetry back from the heli, once the pilot's awake. 0 to not ask for any
+        self.requested_telemetry_rate = self.conf.get('telemetry_rate_hz', 0)
+        self.telemetry_rate = 0
+        self.telemetry = None
+        self.telemetry_thread = telemetry_thread
+        # If the connection drops, reconnect straight away, then keep retrying - backing off from the initial delay,
+        # doubling each time up to the max - until the timeout (which wants to be no longer than the server will
+        # hold the pilot for)
+        self.reconnect_initial_delay = self.conf.get('reconnect_initial_delay', 0.02)
+        self.reconnect_max_delay = self.conf.get('reconnect_max_delay', 0.5)
+        self.reconnect_timeout = self.conf.get('reconnect_timeout', 5)
+        # Given by the server when the pilot wakes, to resume control with after reconnecting
+        self.session_token = None
+        self.reconnecting = False
+        # Reconnections that resumed control, and how long the last one took (s)
+        self.resumes = 0
+        self.last_reconnect_time = None
+
         print(self.conf)
         self.is_connected = False
         self.pilot_awake = False
 
     def __enter__(self):
+        self._open_socket()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        print("Closing controller connection")
+        self._close_socket()
+
+    def _open_socket(self):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # self.s.connect((self.conf['server_ip'], self.conf['server_port']))
         # Force NODELAY to stop the client waiting for a minmum amount of data before sending it
         self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        print("Closing controller connection")
+    def _close_socket(self):
+        if self.telemetry:
+            self.telemetry.stop()
+            print(f"Telemetry stats: {self.telemetry}")
+            self.telemetry = None
+        if self.datagram_socket:
+            self.datagram_socket.close()
+            self.datagram_socket = None
         if self.s:
             self.s.close()
 
     def init_connection(self):
         self.s.connect((self.conf['server_ip'], self.conf['server_port']))
-        self.test_connection()
-        connection_confirmation = self.s.recv(1)
-        if connection_confirmation == bytes([1]):
-            print("Helicopter Server connection established.")
+        self.encoding = self._request_encoding(self.requested_encoding)
+        if self.encoding is None and self.requested_encoding != ENCODING_JSON:
+            # An older server only knows JSON demands, and hangs up on a request for anything else - so ask again for
+            # JSON, on a new connection
+            print(f"Helicopter Server didn't agree to {self.requested_encoding} demands, trying again with JSON.")
+            self._reopen_socket()
+            self.s.connect((self.conf['server_ip'], self.conf['server_port']))
+            self.encoding = self._request_encoding(ENCODING_JSON)
+        if self.encoding:
+            self.codec = demand_codec(self.encoding)
+            print(f"Helicopter Server connection established ({self.encoding} demands).")
             self.is_connected = True
+            if self.transport == TRANSPORT_UDP:
+                self.open_datagram_link()
+            if self.requested_telemetry_rate:
+                self.request_telemetry()
+        else:
+            print("Helicopter Server didn't agree to the connection. Press START to try again.")
+            # Ready to connect again
+            self._reopen_socket()
         return self.is_connected
 
-    def test_connection(self):
-        self._send_data(bytes([1]))
+    def _request_encoding(self, encoding):
+        """ Ask for 'encoding' on the newly connected socket. Returns the encoding the server's agreed to, or None """
+        self.test_connection(encoding)
+        connection_confirmation = self.s.recv(1)
+        # The server confirms the connection by echoing the request byte of the encoding it's agreed to
+        return request_byte_encoding(connection_confirmation[0]) if connection_confirmation else None
+
+    def _reopen_socket(self):
+        """ A new socket in place of the current one, with the same timeout """
+        timeout = self.s.gettimeout()
+        self._close_socket()
+        self._open_socket()
+        self.s.settimeout(timeout)
+
+    def request_telemetry(self):
+        """ Ask the server to send telemetry back once the pilot's awake, and find out what rate it'll send it at """
+        self._send_data(bytes([TELEMETRY_REQUEST]) + TELEMETRY_RATE.pack(self.requested_telemetry_rate))
+        if self.s.recv(1) != bytes([TELEMETRY_REQUEST]):
+            print("Helicopter Server didn't understand the telemetry request, carrying on without it.")
+            return
+        self.telemetry_rate, = TELEMETRY_RATE.unpack(self._recv_exactly(TELEMETRY_RATE.size))
+        print(f"Helicopter Server will send telemetry at {self.telemetry_rate}Hz.")
+
+    def open_datagram_link(self):
+        """ Ask the server for a UDP port to send the demands to. Stick with TCP if it can't give us one """
+        self._send_data(bytes([DATAGRAM_REQUEST]))
+        if self.s.recv(1) != bytes([DATAGRAM_REQUEST]):
+            print("Helicopter Server can't receive demands over UDP, sending them over TCP instead.")
+            return
+        port, = DATAGRAM_PORT.unpack(self._recv_exactly(DATAGRAM_PORT.size))
+        datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagram_socket.connect((self.conf['server_ip'], port))
+        # Only for testing the link - randomly drop/reorder demands on their way out
+        drop_rate = self.conf.get('datagram_drop_rate', 0)
+        reorder_rate = self.conf.get('datagram_reorder_rate', 0)
+        if drop_rate or reorder_rate:
+            print(f"WARNING: Dropping {100 * drop_rate}% & reordering {100 * reorder_rate}% of demand datagrams!")
+            datagram_socket = LossyDatagramSocket(datagram_socket, drop_rate=drop_rate, reorder_rate=reorder_rate)
+        self.datagram_socket = datagram_socket
+        print(f"Sending demands over UDP to port {port}.")
+
+    def test_connection(self, encoding=None):
+        self._send_data(bytes([encoding_request_byte(encoding or self.requested_encoding)]))
 
     def set_battery_connected(self):
-        self._send_data(bytes([2]))
+        self._send_data(bytes([PILOT_WAKEUP_REQUEST]))
         pilot_started_confirmation = self.s.recv(1)
-        if pilot_started_confirmation == bytes([2]):
+        if pilot_started_confirmation == bytes([PILOT_WAKEUP_REQUEST]):
+            self.session_token = self._recv_exactly(SESSION_TOKEN_SIZE)
             print("Helicopter Pilot woken up and ready to fly :)")
-            self.pilot_awake = True
+            self._start_flying()
+        elif pilot_started_confirmation == bytes([CONTROL_HELD]):
+            session_id, = SESSION_ID.unpack(self._recv_exactly(SESSION_ID.size))
+            print(f"Another controller has control of the heli. Ask them to hand over (to session {session_id}, or "
+                  f"anyone), then try again.")
         return self.pilot_awake
 
+    def _start_flying(self):
+        # No timeout on the connection from here on (reconnect() sets one for the handshake)
+        self.s.settimeout(None)
+        self.pilot_awake = True
+        if self.telemetry_rate:
+            # Nothing else reads from the connection from here on, so hand it over to the telemetry reader
+            self.telemetry = TelemetryReader(self.s, thread=self.telemetry_thread)
+
+    def resume(self):
+        """ Take back control of the pilot with the session token, after reconnecting. Returns True if it's resumed """
+        self._send_data(bytes([RESUME_REQUEST]) + self.session_token)
+        if self.s.recv(1) != bytes([RESUME_REQUEST]):
+            print("Helicopter Server couldn't resume the session - the heli will have stopped. Press A to wake the pilot again.")
+            self.session_token = None
+            return False
+        self._start_flying()
+        return True
+
+    def reconnect(self):
+        """
+        After the connection's dropped, reconnect (backing off between attempts) and resume control. Returns True
+        if it's resumed, False if it couldn't before the reconnect timeout (or the server couldn't resume it)
+        """
+        self.reconnecting = True
+        self.pilot_awake = False
+        self.is_connected = False
+        started = time.monotonic()
+        delay = self.reconnect_initial_delay
+        attempts = 0
+        try:
+            while True:
+                attempts += 1
+                self._close_socket()
+                self._open_socket()
+                # Don't let an attempt (e.g. connecting while the heli's out of range) run on past the timeout
+                self.s.settimeout(max(0.001, self.reconnect_timeout - (time.monotonic() - started)))
+                try:
+                    if self.init_connection():
+                        resumed = self.session_token is not None and self.resume()
+                        self.s.settimeout(None)
+                        self.last_reconnect_time = time.monotonic() - started
+                        if resumed:
+                            self.resumes += 1
+                            print(f"Reconnected and resumed control in {1000 * self.last_reconnect_time:.1f}ms ({attempts} attempts)")
+                        return resumed
+                except OSError as e:
+                    print(f"Reconnect attempt {attempts} failed: {e}")
+                if time.monotonic() - started + delay > self.reconnect_timeout:
+                    print(f"Couldn't reconnect to the Helicopter Server in {self.reconnect_timeout}s. Press START to try again.")
+                    self._close_socket()
+                    self._open_socket()
+                    self.session_token = None
+                    return False
+                time.sleep(delay)
+                delay = min(2 * delay, self.reconnect_max_delay)
+        finally:
+            self.reconnecting = False
+
+    def hand_over(self, session_id:int=0):
+        """ Offer control to another controller's connection ('session_id'), or whichever asks first (0) """
+        print(f"Offering control to {f'session {session_id}' if session_id else 'the next controller to ask'}.")
+        self._send_data(bytes([HANDOVER_REQUEST]) + SESSION_ID.pack(session_id))
+
     def send_input_demands(self,demands):
-        # Convert to json so it can be encoded as a string
-        demands_data = json.dumps(demands)
-        self._send_data(demands_data)
+        # Encode using whichever format was agreed during the handshake
+        data = self.codec.encode(demands)
+        if self.datagram_socket:
+            self.datagram_socket.send(data)
+        else:
+            self._send_data(data)
+
+    def _recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.s.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError(errno.ECONNRESET, "Connection closed by the Helicopter Server")
+            data += chunk
+        return data
 
     def _send_data(self, data, response_expected=False):
         if type(data) == str:
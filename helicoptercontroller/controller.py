@@ -1,24 +1,34 @@
 """ Class for the 'controller' that will connect to the Heli server and issue commands """
+import asyncio
 from threading import Thread
 from inputs import get_key, devices
-from time import sleep
 from gamepad import GamePad
 from connection_manager import ControllerConnection
+from send_policy import DemandSendPolicy
 import errno
 
 class HelicopterController:
+    """
+    Runs on a single asyncio event loop, waiting on the gamepad's device, the connection to the heli (for the
+    telemetry coming back) and the send policy's timer all at once - nothing's polled, so the controller sleeps until
+    there's something to do.
+    The handshakes with the server (connecting, waking the pilot, reconnecting) block, so they're run on a worker
+    thread while the loop waits for them. Gamepad reports that arrive in the meantime are dealt with in order once
+    they're done - apart from while reconnecting, when they're just offered to the send policy as they arrive, so the
+    sticks can be put back where they are as soon as control's resumed.
+    """
 
     def __init__(self, config_file = './heli_server_config.json'):
         # Get the gamepad instance. Will return None if not found. (Will currently raise an exception if not possible as this is the only supported control mechanism)
         self.gp = self._get_gamepad()
+        self.run_thread = True
+        self.loop = None
         # Connect to the server
-        with ControllerConnection(config_file) as self.heli_connection:
-            # Create a background thread to run the controller listener on
-            self.run_thread = True
-            self.input_thread = Thread(target=self.get_input_demands, daemon=True)
-            self.input_thread.start()
-            while self.run_thread:
-                pass
+        with ControllerConnection(config_file, telemetry_thread=False) as self.heli_connection:
+            # Only send the demand updates that matter
+            self.send_policy = DemandSendPolicy.from_config(self.heli_connection.conf)
+            asyncio.run(self.run())
+            print(f"Demand send stats: {self.send_policy}")
 
     def _get_gamepad(self):
         """ Returns a GamePad instance if possible, otherwise will return None """
@@ -30,79 +40,232 @@ class HelicopterController:
             print('Gamepad currently the only supported input mechanism')
             raise e
 
-    def get_input_demands(self):
-        print("Helicopter controller thread started. Press 'start' on the controller to initialise the connection to the Helicopter server.")
+    async def run(self):
+        """ Handle the gamepad's reports until exit_thread() is called (or something goes wrong) """
+        # Each report from the gamepad (the demands after it), in order. None to stop
+        self._reports = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
+        # The timer for the send policy's next held back update/heartbeat, the reconnect in progress, and the
+        # connection telemetry's being read from
+        self._poll_timer = None
+        self._reconnect_task = None
+        self._telemetry_socket = None
+        if not self.gp:
+            # # Check the keyboard regardless (so we can listen for reset / quit requests)
+            # events = get_key()
+            # if events:
+            #     for event in events:
+            #         print(event.code)
+            print("Error: Gamepad required.")
+            return
+        gamepad_fd = self.gp.fileno()
+        if gamepad_fd is not None:
+            self.loop.add_reader(gamepad_fd, self.read_gamepad)
+        else:
+            # Nothing to wait on, so read the gamepad on a thread of its own, which hands each report over to the loop
+            Thread(target=self.read_gamepad_blocking, daemon=True).start()
+        print("Helicopter controller started. Press 'start' on the controller to initialise the connection to the Helicopter server.")
+        try:
+            await self.handle_reports()
+        finally:
+            if gamepad_fd is not None:
+                self.loop.remove_reader(gamepad_fd)
+            self._stop_reading_telemetry()
+            if self._poll_timer:
+                self._poll_timer.cancel()
+
+    def read_gamepad(self):
+        """ Queue up the reports waiting on the gamepad's device """
+        try:
+            reports = self.gp.read_demands()
+        except OSError as e:
+            # e.g. unplugged - stop waiting on it, or it'd be 'ready' (with the same error) forever
+            self.loop.remove_reader(self.gp.fileno())
+            reports = [e]
+        for demands in reports:
+            self._reports.put_nowait(demands)
+
+    def read_gamepad_blocking(self):
+        """ For a gamepad without a device to wait on - read it, and hand each report to the loop """
         while self.run_thread:
-            # Check if a gamepad is present
-            if self.gp:
-                try:
-                    demands = self.gp.get_demands()
-                    # print(demands)
-                    if demands:
-                        if self.heli_connection.is_connected:
-                            if self.heli_connection.pilot_awake:
-                                self.heli_connection.send_input_demands(demands)
-                            else:
-                                if self.heli_connection.set_battery_connected():
-                                    print("")
-                                    print("\tPress SELECT to calibrate the gyro")
-                                    print("")
-                                    print("\tPress LEFT & RIGHT UPPER TRIGGERS together to spin up the motor")
-                                    print("")
-                                    print("\tPress XBOX button at any time to stop the motor!")
-                                    print("")
-                                else:
-                                    print("")
-                                    print("Some error occured during the waking up of the pilot :( Please ensure battery connected and press A again to retry")
-                                    self.gp.battery_connected = False
-                        elif demands['init_connection_demand']:
-                            print("\tHelicopterServer connection requested")
-                            # Connect to the server
-                            connection_successful = self.heli_connection.init_connection()
-                            if connection_successful:
-                                print("")
-                                print("\tConnection successful. Please connect the helicopter battery pack then press A.")
-                                print("")
-                        else:
-                            print("Press start to initialise the connection to the Helicopter server.")
-                except OSError as e:
-                    # Handle connection errors gracefully
-                    if isinstance(e.args, tuple):
-                        error_no = e.args[0]
-                        if error_no == errno.EHOSTUNREACH:
-                            # No route to host
-                            print("Unable to connect to the helicopter server - is it on? Please press START again to retry connecting when the heli server is available.")
-                        elif error_no == errno.EPIPE:
-                            # Broken pipe
-                            print("Connection to heli lost.")
-                            # Try to reconnect?
-                            print("Trying to reconnect! (TODO: Implement this!)")
-                        elif error_no == errno.ECONNRESET:
-                            # Connection reset by peer
-                            print("Connection reset by peer - heli server has shutdown!")
-                        elif error_no == errno.ECONNREFUSED:
-                            # Connection refused
-                            print("Connection refused - is the server running on the heli?")
-                        else:
-                            print(f"OSError received: {e.args}")
-                            # Abort as I'm not sure what's going on
-                            raise e
+            try:
+                demands = self.gp.get_demands()
+            except Exception as e:
+                self._hand_to_loop(e)
+                return
+            if demands:
+                self._hand_to_loop(demands)
+
+    def _hand_to_loop(self, report):
+        """ Queue up a report from another thread """
+        try:
+            self.loop.call_soon_threadsafe(self._reports.put_nowait, report)
+        except RuntimeError:
+            # The loop's already finished
+            pass
+
+    async def handle_reports(self):
+        while self.run_thread:
+            demands = await self._reports.get()
+            if demands is None:
+                break
+            try:
+                if isinstance(demands, Exception):
+                    # Reading the gamepad failed
+                    raise demands
+                await self.handle_demands(demands)
+            except OSError as e:
+                # Handle connection errors gracefully
+                if isinstance(e.args, tuple):
+                    error_no = e.args[0]
+                    if error_no == errno.EHOSTUNREACH:
+                        # No route to host
+                        print("Unable to connect to the helicopter server - is it on? Please press START again to retry connecting when the heli server is available.")
+                    elif error_no in (errno.EPIPE, errno.ECONNRESET) and self.heli_connection.session_token:
+                        # Broken pipe/connection reset by peer while flying - get back to the heli without waiting for START
+                        self.start_reconnecting()
+                    elif error_no == errno.EPIPE:
+                        # Broken pipe
+                        print("Connection to heli lost. Please press START again to reconnect.")
+                    elif error_no == errno.ECONNRESET:
+                        # Connection reset by peer
+                        print("Connection reset by peer - heli server has shutdown!")
+                    elif error_no == errno.ECONNREFUSED:
+                        # Connection refused
+                        print("Connection refused - is the server running on the heli?")
                     else:
-                        print(f"socket error {e.args}")
-                except Exception as e:
-                    print("Had some exception. Aborting the controller")
-                    print(e)
-                    # TODO: Handle the loss of the gamepad?
-                    self.run_thread = False
-                    break
-            else:
-                # # Check the keyboard regardless (so we can listen for reset / quit requests)
-                # events = get_key()
-                # if events:
-                #     for event in events:
-                #         print(event.code)
-                print("Error: Gamepad required.")
+                        print(f"OSError received: {e.args}")
+                        # Abort as I'm not sure what's going on
+                        raise e
+                else:
+                    print(f"socket error {e.args}")
+            except Exception as e:
+                print("Had some exception. Aborting the controller")
+                print(e)
+                # TODO: Handle the loss of the gamepad?
                 self.run_thread = False
+                break
+
+    async def handle_demands(self, demands):
+        """ Act on the demands after a gamepad report """
+        if self.heli_connection.reconnecting:
+            # Keep track of the sticks, so they can be sent as soon as control's resumed
+            self.send_policy.offer(demands)
+        elif self.heli_connection.is_connected:
+            if self.heli_connection.pilot_awake:
+                if demands['handover_demand']:
+                    self.heli_connection.hand_over()
+                    # Only once per press of the button
+                    self.gp.handover_demand = False
+                self.send_demands(demands)
+                if self.heli_connection.telemetry:
+                    # Show the heli's state while the 'request gyro state' button's held down
+                    self.heli_connection.telemetry.display = demands['request_gyro_state_demand']
+            else:
+                if await self.handshake(self.heli_connection.set_battery_connected):
+                    self._start_reading_telemetry()
+                    # Start the heartbeats now, rather than once the sticks move - the server's link timeout starts
+                    # as soon as we have control
+                    self.send_demands(demands)
+                    print("")
+                    print("\tPress SELECT to calibrate the gyro")
+                    print("")
+                    print("\tPress LEFT & RIGHT UPPER TRIGGERS together to spin up the motor")
+                    print("")
+                    print("\tPress XBOX button at any time to stop the motor!")
+                    print("")
+                else:
+                    print("")
+                    print("Some error occured during the waking up of the pilot :( Please ensure battery connected and press A again to retry")
+                    self.gp.battery_connected = False
+        elif demands['init_connection_demand']:
+            print("\tHelicopterServer connection requested")
+            # Connect to the server
+            connection_successful = await self.handshake(self.heli_connection.init_connection)
+            if connection_successful:
+                print("")
+                print("\tConnection successful. Please connect the helicopter battery pack then press A.")
+                print("")
+        else:
+            print("Press start to initialise the connection to the Helicopter server.")
+
+    async def handshake(self, function):
+        """ Run one of the connection's (blocking) handshakes on a worker thread, returning what it returns """
+        return await self.loop.run_in_executor(None, function)
+
+    def send_demands(self, demands):
+        """ Send the demands to the heli if the send policy thinks they're worth sending """
+        demands = self.send_policy.offer(demands)
+        if demands:
+            self.heli_connection.send_input_demands(demands)
+        self._schedule_poll()
+
+    def send_pending_demands(self):
+        """ Send any update held back by the send policy's rate cap, or a heartbeat if the sticks have been still """
+        self._poll_timer = None
+        if not self.heli_connection.pilot_awake:
+            return
+        try:
+            demands = self.send_policy.poll()
+            if demands:
+                self.heli_connection.send_input_demands(demands)
+        except OSError as e:
+            # The sticks may be still, so there might not be any reports coming in to notice
+            print(f"Error sending demands: {e}")
+            if self.heli_connection.session_token:
+                self.start_reconnecting()
+            return
+        self._schedule_poll()
+
+    def _schedule_poll(self):
+        """ Set the timer for whenever the send policy will next have something to send """
+        if self._poll_timer:
+            self._poll_timer.cancel()
+            self._poll_timer = None
+        due = self.send_policy.next_poll_time()
+        if due is not None:
+            self._poll_timer = self.loop.call_later(max(0, due - self.send_policy.clock()), self.send_pending_demands)
+
+    def _start_reading_telemetry(self):
+        """ Read the telemetry (if there is any) as it arrives """
+        if self.heli_connection.telemetry:
+            self._telemetry_socket = self.heli_connection.s
+            self.loop.add_reader(self._telemetry_socket, self.read_telemetry)
+
+    def _stop_reading_telemetry(self):
+        if self._telemetry_socket is not None:
+            self.loop.remove_reader(self._telemetry_socket)
+            self._telemetry_socket = None
+
+    def read_telemetry(self):
+        if not self.heli_connection.telemetry.read_available():
+            # The connection's closed - get back to the heli now, rather than when the next send notices
+            self._stop_reading_telemetry()
+            if self.heli_connection.session_token and not self.heli_connection.reconnecting:
+                self.start_reconnecting()
+
+    def start_reconnecting(self):
+        """ Reconnect to the heli and resume control, after the connection's dropped (unless that's already underway) """
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self.reconnect())
+
+    async def reconnect(self):
+        print("Connection to heli lost. Reconnecting...")
+        # (Before the connection's replaced underneath it)
+        self._stop_reading_telemetry()
+        if await self.handshake(self.heli_connection.reconnect):
+            self._start_reading_telemetry()
+            # Put the sticks back where they are now, rather than waiting for them to move (or the next heartbeat)
+            try:
+                if self.send_policy.latest:
+                    self.heli_connection.send_input_demands(self.send_policy.latest)
+            except OSError as e:
+                # Dropped again already - the next send will notice and try again
+                print(f"Error sending demands after reconnecting: {e}")
+            self._schedule_poll()
 
     def exit_thread(self):
+        """ Stop the controller (from any thread) """
         self.run_thread = False
+        if self.loop:
+            self._hand_to_loop(None)
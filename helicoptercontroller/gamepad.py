@@ -14,20 +14,40 @@ Startup Procedure:
  5. Press both (upper) triggers simulateously to start the motor spinning
 
  Press the Xbox button at any time to stop the motor
+ Press B to hand control over to another controller (which then takes it by pressing A)
+ Press X to switch to the next input profile (see input_mapping.json)
+
+That's the default mapping - which input does what, and the sticks' response curves, come from input_mapping.json.
 
 """
-from inputs import devices
+import os
+import sys
+from collections import namedtuple
+from inputs import devices, iter_unpack, EVENT_SIZE, UnknownEventCode, UnknownEventType
+import shared_modules
+from flight_log import FlightLog
+from input_mapping import InputMapping, AXIS_MIN
+
+# An event read straight off the gamepad's evdev device (the parts of an inputs event that are used here)
+GamePadEvent = namedtuple('GamePadEvent', ['code', 'state'])
 
 class GamePad:
 
-    _max_joystick_value = 32000
+    # Most events to take off the device in one read
+    _read_events = 64
 
-    def __init__(self):
-        # Check there is a gamepad present!
-        if len(devices.gamepads) == 0:
-            raise IOError("No gamepad found.")
-        # If so, get reference to it
-        self.gamepad = devices.gamepads[0]
+    def __init__(self, gamepad=None, mapping=None):
+        """
+        'gamepad' is the inputs device to read (or anything with the same read()), else the first gamepad found.
+        'mapping' is the InputMapping to use, else the one in input_mapping.json
+        """
+        if gamepad is None:
+            # Check there is a gamepad present!
+            if len(devices.gamepads) == 0:
+                raise IOError("No gamepad found.")
+            # If so, get reference to it
+            gamepad = devices.gamepads[0]
+        self.gamepad = gamepad
         # Initialise the status of all the possible inputs
         self.stop_demand = False
         self.start_demand = False
@@ -39,112 +59,210 @@ class GamePad:
         self.init_connection_demand = False
         self.battery_connected = False
         self.request_gyro_state = False
+        self.handover_demand = False
         # Make a note of the button states, for compound button press requirements
         self.left_trigger_pressed = False
         self.right_trigger_pressed = False
+        # Whether the report being read so far has changed anything
+        self._report_updated = False
+        # The evdev device, once fileno() has opened it
+        self._fd = None
+        # Log the button presses from a background thread, rather than printing from inside the input loop.
+        # Holding both triggers re-sends the start request on every report (and the analogue triggers report every movement),
+        # so only mention those now and again
+        self.log = FlightLog(name='gamepad', rate_limits_hz={'start': 1, 'unused': 1}).start()
+        # What each input does. Each event's handler is looked up by its code, in the table made from the profile
+        self.mapping = mapping or InputMapping.from_file()
+        # The last raw value of each axis, to put the sticks back through a new profile's curves
+        self._axis_states = {}
+        self._handlers = {}
+        self._use_profile(self.mapping.profile)
 
     def update_inputs(self):
-        events = self.gamepad.read()
-        for event in events:
-            # print(event.code)
-            # if abs(event.state) > (0.8*self._max_joystick_value):
-            # print(event.state)
-            if event.code == 'SYN_REPORT':
-                # Ignore system sync reports - otherwise we end up with 2 events for every input action.
-                return False
-            if event.code == 'ABS_X':
-                # Yaw - needs inverting to make 'left' on the controller +ve (i.e. +ve about an 'upwards' Z axis)
-                self.yaw_demand = -min(1,max(-1,event.state/self._max_joystick_value))
-            if event.code == 'ABS_Y':
-                # Throttle
-                # TODO: Filter the throttle demand so it only starts after has been fully down, or move it to right trigger
-                self.throttle_demand = -min(1,max(-1,event.state/self._max_joystick_value))
-            if event.code == 'ABS_RX':
-                # Roll
-                self.roll_demand = min(1,max(-1,event.state/self._max_joystick_value))
-            if event.code == 'ABS_RY':
-                # Pitch - needs inverting to make 'up' on the controller = +1
-                self.pitch_demand = -min(1,max(-1,event.state/self._max_joystick_value))
-            if event.code == 'ABS_Z':
-                # Left lower trigger
-                print("Left lower trigger pressed, but currently does nothing")
-                # self.?_demand = Math.min(1,Math.max(-1,event.state/self._max_joystick_value))
-            if event.code == 'ABS_RZ':
-                # Right lower trigger
-                print("Right lower trigger pressed, but currently does nothing")
-                # self.?_demand = Math.min(1,Math.max(-1,event.state/self._max_joystick_value))
-            if event.code == 'BTN_NORTH':   ## NOTE: BTN_NORTH should be 'Y', but for some reason it's coming in as the wrong code (X&Y are reversed) - known bug in inputs
-                # 'X' button
-                print("X button pressed, but currently does nothing")
-            if event.code == 'BTN_WEST':
-                # 'Y' button
-                if event.state == 1:
-                    print("Y button pressed, requesting gyro readings")
-                    self.request_gyro_state = True
-                else:
-                    print("Y button released, not requesting gyro readings")
-                    self.request_gyro_state = False
-            if event.code == 'BTN_EAST':
-                # 'B' button
-                print("B button pressed, but currently does nothing")
-            if event.code == 'BTN_SOUTH':
-                # 'A' button
-                if event.state == 1:
-                    print("A button pressed, waking up the pilot...")
-                    self.battery_connected = True
-            if event.code == 'BTN_SELECT':
-                # 'Select' button
-                if event.state == 1:
-                    self.calibration_demand = True
-                    print("Select button pressed, initiating Gyro calibration")
-                else:
-                    self.calibration_demand = False
-            if event.code == 'BTN_START' and event.state == 0:
-                # 'Start' button (just released)
-                print("Start button pressed, Trying to connect to helicopter server.")
-                self.init_connection_demand = True
-            if event.code == 'BTN_MODE':
-                # 'XBox' button
-                print("XBox button pressed, stopping the motor!")
-                if event.state == 1:
-                    self.stop_demand = True
-                    self.start_demand = False
-            if event.code == 'BTN_TR':
-                # Right trigger button
-                if event.state == 1:
-                    print("Right trigger button pressed")
-                    self.right_trigger_pressed = True
-                else:
-                    print("Right trigger button released")
-                    self.right_trigger_pressed = False
-            if event.code == 'BTN_TL':
-                # Left trigger button
-                if event.state == 1:
-                    print("Left trigger button pressed")
-                    self.left_trigger_pressed = True
-                else:
-                    print("Left trigger button released")
-                    self.left_trigger_pressed = False
+        """
+        Apply all of the gamepad's events up to the end of the next report (marked by a sync report), so a report
+        that moves several axes at once only produces one update. Returns False if there was nothing but sync reports
+        """
+        updated = False
+        report_complete = False
+        while not report_complete:
+            for event in self.gamepad.read():
+                if event.code == 'SYN_REPORT':
+                    report_complete = True
+                updated = self._take_event(event) or updated
+        return updated
+
+    def fileno(self):
+        """
+        The gamepad's evdev device, to wait on (e.g. with an event loop) and then call read_demands() once there's
+        something to read - rather than blocking in get_demands(). None if it doesn't have one (e.g. not on Linux)
+        """
+        if self._fd is None:
+            if hasattr(self.gamepad, 'fileno'):
+                # A stand-in device
+                self._fd = self.gamepad.fileno()
+            elif sys.platform.startswith('linux') and hasattr(self.gamepad, 'get_char_device_path'):
+                # A handle of our own, rather than the inputs device's buffered one - events sat in its buffer wouldn't
+                # wake anything waiting on the device
+                self._fd = os.open(self.gamepad.get_char_device_path(), os.O_RDONLY)
+            else:
+                return None
+            os.set_blocking(self._fd, False)
+        return self._fd
+
+    def read_demands(self):
+        """
+        Apply every event waiting on the evdev device (see fileno()), without blocking. Returns the demands as of the
+        end of each report that changed something, oldest first - so a button pressed and let go between reads
+        isn't missed
+        """
+        reports = []
+        read_size = self._read_events * EVENT_SIZE
+        while True:
+            try:
+                data = os.read(self._fd, read_size)
+            except BlockingIOError:
+                break
+            if not data:
+                raise IOError("Gamepad disconnected.")
+            for _, _, event_type, code, state in iter_unpack(data):
+                try:
+                    event_type = devices.get_event_type(event_type)
+                    event = GamePadEvent(devices.get_event_string(event_type, code), state)
+                except (UnknownEventType, UnknownEventCode):
+                    continue
+                if self._take_event(event):
+                    reports.append(self.demands())
+            if len(data) < read_size:
+                # That was everything
+                break
+        return reports
+
+    def _take_event(self, event):
+        """ Apply a single gamepad event. Returns True if it's the end of a report that changed something """
+        if event.code != 'SYN_REPORT':
+            handler = self._handlers.get(event.code)
+            # (Inputs that aren't mapped to anything don't change anything)
+            if handler is not None and handler(event):
+                self._report_updated = True
+            return False
         # Check for a motor start request
         if self.left_trigger_pressed and self.right_trigger_pressed:
-            print("Both right and left triggers depressed")
+            self.log.info('start', "Both right and left triggers depressed")
             self.stop_demand = False
             self.start_demand = True
+        updated, self._report_updated = self._report_updated, False
+        return updated
+
+    def use_profile(self, name:str):
+        """ Switch to the mapping's input profile 'name' - takes effect from the next event """
+        self._use_profile(self.mapping.use(name))
+        self.log.info('button', "Using the '%s' input profile", name)
+
+    def _use_profile(self, profile):
+        """ Make the handler table for 'profile', and put the sticks (where they are now) through its curves """
+        handlers = {code: self._axis_handler(code, demand, table) for code, (demand, table) in profile.axes.items()}
+        handlers.update({code: getattr(self, f'_on_{action}') for code, action in profile.actions.items()})
+        self._handlers = handlers
+        for code, state in self._axis_states.items():
+            if code in profile.axes:
+                demand, table = profile.axes[code]
+                setattr(self, demand, table[state - AXIS_MIN])
+
+    def _axis_handler(self, code, demand, table):
+        """ Handler setting 'demand' from an axis event, through its response curve's lookup table """
+        axis_states = self._axis_states
+        def set_demand(event):
+            axis_states[code] = event.state
+            value = table[event.state - AXIS_MIN]
+            if value == getattr(self, demand):
+                # e.g. moving about within the deadzone
+                return False
+            setattr(self, demand, value)
+            return True
+        return set_demand
+
+    # What each action does with an event - see input_mapping.ACTIONS. Each returns whether it's changed anything
+
+    def _on_connect(self, event):
+        if event.state == 0:
+            # (Just released)
+            self.log.info('button', "Start button pressed, Trying to connect to helicopter server.")
+            self.init_connection_demand = True
+        return True
+
+    def _on_wake_pilot(self, event):
+        if event.state == 1:
+            self.log.info('button', "A button pressed, waking up the pilot...")
+            self.battery_connected = True
+        return True
+
+    def _on_calibrate(self, event):
+        if event.state == 1:
+            self.calibration_demand = True
+            self.log.info('button', "Select button pressed, initiating Gyro calibration")
+        else:
+            self.calibration_demand = False
+        return True
+
+    def _on_stop_motor(self, event):
+        self.log.info('button', "XBox button pressed, stopping the motor!")
+        if event.state == 1:
+            self.stop_demand = True
+            self.start_demand = False
+        return True
+
+    def _on_left_trigger(self, event):
+        self.left_trigger_pressed = event.state == 1
+        self.log.info('button', "Left trigger button %s", "pressed" if self.left_trigger_pressed else "released")
+        return True
+
+    def _on_right_trigger(self, event):
+        self.right_trigger_pressed = event.state == 1
+        self.log.info('button', "Right trigger button %s", "pressed" if self.right_trigger_pressed else "released")
         return True
 
+    def _on_request_gyro_state(self, event):
+        self.request_gyro_state = event.state == 1
+        self.log.info('button', "Y button %s", "pressed, requesting gyro readings" if self.request_gyro_state else "released, not requesting gyro readings")
+        return True
+
+    def _on_handover(self, event):
+        if event.state == 1:
+            self.log.info('button', "B button pressed, handing over control")
+        self.handover_demand = event.state == 1
+        return True
+
+    def _on_next_profile(self, event):
+        if event.state != 1:
+            return False
+        profile = self.mapping.next()
+        self._use_profile(profile)
+        self.log.info('button', "X button pressed, switching to the '%s' input profile", profile)
+        return True
+
+    def _on_unused(self, event):
+        self.log.info('unused', "%s pressed, but currently does nothing", event.code)
+        return False
+
     def get_demands(self):
+        """ Wait for the next report, and return the demands if it changed anything (otherwise None) """
         legit_update = self.update_inputs()
         if legit_update:
-            return {
-                'stop_demand':self.stop_demand,
-                'start_demand':self.start_demand,
-                'calibration_demand':self.calibration_demand,
-                'throttle_demand': self.throttle_demand,
-                'yaw_demand': self.yaw_demand,
-                'pitch_demand': self.pitch_demand,
-                'roll_demand': self.roll_demand,
-                'init_connection_demand': self.init_connection_demand,
-                'battery_connected': self.battery_connected,
-                'request_gyro_state_demand': self.request_gyro_state,
-            }
-    
\ No newline at end of file
+            return self.demands()
+
+    def demands(self):
+        """ The demands as they stand """
+        return {
+            'stop_demand':self.stop_demand,
+            'start_demand':self.start_demand,
+            'calibration_demand':self.calibration_demand,
+            'throttle_demand': self.throttle_demand,
+            'yaw_demand': self.yaw_demand,
+            'pitch_demand': self.pitch_demand,
+            'roll_demand': self.roll_demand,
+            'init_connection_demand': self.init_connection_demand,
+            'battery_connected': self.battery_connected,
+            'request_gyro_state_demand': self.request_gyro_state,
+            'handover_demand': self.handover_demand,
+        }
@@ -0,0 +1,121 @@
+"""
+Which gamepad input does what, loaded from a mapping file (input_mapping.json, alongside this) of named profiles.
+
+Each profile maps evdev codes to either:
+ - an axis demand, through a response curve (deadzone, expo, rate, inversion), or
+ - an action (see ACTIONS) - what a button (or an analogue trigger) does when it's pressed/released
+The curves are worked out once, when the mapping's loaded, into a lookup table over the whole 16-bit range of an
+evdev axis - so an axis event only costs indexing the table with its raw value.
+"""
+import json
+import os
+from array import array
+
+# The range of the raw value of an evdev axis
+AXIS_MIN = -32768
+AXIS_MAX = 32767
+# Raw value of a stick pushed all the way, if a curve doesn't say (the sticks don't quite reach AXIS_MAX)
+AXIS_FULL_SCALE = 32000
+
+# Demands an axis can drive
+AXIS_DEMANDS = ('throttle_demand', 'yaw_demand', 'pitch_demand', 'roll_demand')
+# What a button can do (see the GamePad's _on_<action> methods)
+ACTIONS = ('connect', 'wake_pilot', 'calibrate', 'stop_motor', 'left_trigger', 'right_trigger', 'request_gyro_state',
+           'handover', 'next_profile', 'unused')
+
+DEFAULT_MAPPING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input_mapping.json')
+
+
+class InputMappingError(ValueError):
+    pass
+
+
+def response_table(deadzone:float=0.0, expo:float=0.0, rate:float=1.0, invert:bool=False,
+                   full_scale:int=AXIS_FULL_SCALE):
+    """
+    Lookup table of the demand (-1 -> +1) for each raw axis value, indexed by (raw value - AXIS_MIN).
+    The stick's position (raw / 'full_scale', clamped to +/-1) has the 'deadzone' around the centre taken out (and
+    the rest stretched back over the full range, so there's no step at its edge), then the 'expo' curve applied
+    ((1 - expo) * x + expo * x^3 - softer around the centre for the same full throw), then it's scaled by 'rate' and
+    negated if 'invert'
+    """
+    if not 0 <= deadzone < 1:
+        raise InputMappingError(f"Deadzone should be between 0 and 1, got {deadzone}")
+    if not 0 <= expo <= 1:
+        raise InputMappingError(f"Expo should be between 0 and 1, got {expo}")
+    if full_scale <= 0:
+        raise InputMappingError(f"Full scale should be positive, got {full_scale}")
+    sign = -rate if invert else rate
+    # The curve's symmetrical, so work out one side of it and mirror it
+    def demand(raw):
+        x = min(1.0, raw / full_scale)
+        if x <= deadzone:
+            return 0.0
+        x = (x - deadzone) / (1 - deadzone)
+        return max(-1.0, min(1.0, sign * ((1 - expo) * x + expo * x * x * x)))
+    positive = [demand(raw) for raw in range(0, -AXIS_MIN + 1)]
+    return array('d', [-value for value in reversed(positive[1:])] + positive[:AXIS_MAX + 1])
+
+
+class InputProfile:
+    """
+    One profile's mapping: 'axes' is {evdev code: (demand, lookup table)}, 'actions' {evdev code: action}.
+    Curves with the same settings share a table
+    """
+
+    def __init__(self, name:str, settings:dict, tables=None):
+        self.name = name
+        tables = {} if tables is None else tables
+        self.axes = {}
+        for code, curve in settings.get('axes', {}).items():
+            curve = dict(curve)
+            demand = curve.pop('demand', None)
+            if demand not in AXIS_DEMANDS:
+                raise InputMappingError(f"Profile '{name}': {code} should drive one of {list(AXIS_DEMANDS)}, got {demand}")
+            try:
+                key = tuple(sorted(curve.items()))
+                if key not in tables:
+                    tables[key] = response_table(**curve)
+            except TypeError as e:
+                raise InputMappingError(f"Profile '{name}': bad curve for {code}: {e}")
+            self.axes[code] = (demand, tables[key])
+        self.actions = dict(settings.get('actions', {}))
+        unknown = {action for action in self.actions.values() if action not in ACTIONS}
+        if unknown:
+            raise InputMappingError(f"Profile '{name}': no such actions: {sorted(unknown)}. Expected some of {list(ACTIONS)}")
+
+    def __str__(self):
+        return self.name
+
+
+class InputMapping:
+    """
+    The profiles from a mapping file, and which one's in use. Every profile's tables are made up front, so
+    switching between them (even mid-flight) costs nothing
+    """
+
+    def __init__(self, settings:dict):
+        profiles = settings.get('profiles', {})
+        if not profiles:
+            raise InputMappingError("No input profiles found")
+        tables = {}
+        self.profiles = {name: InputProfile(name, profile, tables) for name, profile in profiles.items()}
+        self.profile = None
+        self.use(settings.get('profile', next(iter(self.profiles))))
+
+    @classmethod
+    def from_file(cls, file_path:str=DEFAULT_MAPPING_FILE):
+        with open(file_path, 'r') as mapping_file:
+            return cls(json.load(mapping_file))
+
+    def use(self, name:str):
+        """ Switch to the profile 'name'. Returns it """
+        if name not in self.profiles:
+            raise InputMappingError(f"No input profile '{name}'. Expected one of {list(self.profiles)}")
+        self.profile = self.profiles[name]
+        return self.profile
+
+    def next(self):
+        """ Switch to the profile after the one in use (round to the first, after the last). Returns it """
+        names = list(self.profiles)
+        return self.use(names[(names.index(self.profile.name) + 1) % len(names)])
@@ -0,0 +1,67 @@
+"""
+Read-only connection to the helicopter server, for watching the heli's telemetry (e.g. on a ground station display)
+alongside the controller flying it. An observer can't send demands, and can't hold up the controller's link.
+Run with: python observer.py [config_file] [telemetry_rate_hz]
+"""
+import json
+import socket
+import sys
+import time
+import shared_modules
+from heli_protocol import OBSERVER_REQUEST, TELEMETRY_RATE, SESSION_ID
+from telemetry_reader import TelemetryReader
+
+class ObserverConnection:
+    """ Connects to the server as an observer, and reads the telemetry it sends with a TelemetryReader """
+
+    def __init__(self, config_file='./heli_server_config.json', telemetry_rate_hz:int=10, display_rate_hz:float=2):
+        with open(config_file, 'r') as file:
+            self.conf = json.load(file)
+        if 'server_ip' not in self.conf or 'server_port' not in self.conf:
+            raise ValueError("Error: 'server_ip' & 'server_port required in the config file")
+        self.requested_telemetry_rate = telemetry_rate_hz
+        self.display_rate_hz = display_rate_hz
+        self.telemetry_rate = 0
+        self.session_id = None
+        self.telemetry = None
+        self.s = None
+
+    def __enter__(self):
+        self.s = socket.create_connection((self.conf['server_ip'], self.conf['server_port']))
+        self.s.sendall(bytes([OBSERVER_REQUEST]) + TELEMETRY_RATE.pack(self.requested_telemetry_rate))
+        reply = self._recv_exactly(1)
+        if reply != bytes([OBSERVER_REQUEST]):
+            self.s.close()
+            raise ConnectionRefusedError("Helicopter Server refused the observer connection (too many observers?)")
+        self.telemetry_rate, = TELEMETRY_RATE.unpack(self._recv_exactly(TELEMETRY_RATE.size))
+        self.session_id, = SESSION_ID.unpack(self._recv_exactly(SESSION_ID.size))
+        print(f"Observing the heli as session {self.session_id}, telemetry at {self.telemetry_rate}Hz")
+        self.telemetry = TelemetryReader(self.s, display_rate_hz=self.display_rate_hz)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.telemetry:
+            self.telemetry.stop()
+            print(f"Telemetry stats: {self.telemetry}")
+        self.s.close()
+
+    def _recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.s.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Connection closed by the Helicopter Server")
+            data += chunk
+        return data
+
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else './heli_server_config.json'
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    try:
+        with ObserverConnection(config_file, rate) as observer:
+            observer.telemetry.display = True
+            while observer.telemetry.running:
+                time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("Observer shutting down.")
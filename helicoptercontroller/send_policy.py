@@ -0,0 +1,106 @@
+""" Decides which demand updates are worth sending to the helicopter server """
+import time
+from threading import Lock
+import shared_modules
+from heli_protocol import DEMAND_BUTTONS, DEMAND_AXES
+
+class DemandSendPolicy:
+    """
+    Cuts the demand stream down to the updates that matter:
+     - Any change to a button goes out straight away
+     - Stick movements only go out once an axis has moved by more than its threshold since the last send, and then
+       no faster than max_rate_hz. If a movement is held back by the rate cap, it's sent as soon as the cap allows
+     - If nothing's been sent for a while, the latest demands are re-sent as a heartbeat so the link is known to be up
+
+    offer() is called with each new set of demands from the gamepad, and poll() from a timer set for next_poll_time()
+    (which can change after each call to either). Both return the demands to send (or None). Callers on different
+    threads should hold 'lock' while calling either one and sending what it returns, so frames go out in order.
+    """
+
+    def __init__(self, axis_threshold=0.01, max_rate_hz:float=100, heartbeat_rate_hz:float=5, clock=time.monotonic):
+        # Either one threshold for every axis, or a dict of thresholds per axis
+        if isinstance(axis_threshold, dict):
+            self.axis_thresholds = [axis_threshold.get(axis, 0) for axis in DEMAND_AXES]
+        else:
+            self.axis_thresholds = [axis_threshold] * len(DEMAND_AXES)
+        self.min_send_interval = 1 / max_rate_hz
+        self.heartbeat_interval = 1 / heartbeat_rate_hz
+        self.clock = clock
+        self.lock = Lock()
+        self.latest = None
+        self.last_sent = None
+        self.last_send_time = None
+        self.pending = False
+        # Counters
+        self.offered = 0
+        self.sent = 0
+        self.heartbeats = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_config(cls, conf):
+        """ Build a policy from the controller config, using the defaults for anything not set """
+        return cls(axis_threshold=conf.get('axis_change_threshold', 0.01),
+                   max_rate_hz=conf.get('max_send_rate_hz', 100),
+                   heartbeat_rate_hz=conf.get('heartbeat_rate_hz', 5))
+
+    def offer(self, demands):
+        """ Returns 'demands' if they should be sent now, otherwise None """
+        self.offered += 1
+        self.latest = demands
+        now = self.clock()
+        if self.last_sent is None or self._buttons_changed(demands):
+            return self._send(demands, now)
+        if self._axes_changed(demands):
+            if now - self.last_send_time >= self.min_send_interval:
+                return self._send(demands, now)
+            # Too soon after the last one - poll() will send it once the rate cap allows
+            self.pending = True
+        self.suppressed += 1
+        return None
+
+    def poll(self):
+        """ Returns the latest demands if a held back update or a heartbeat is due, otherwise None """
+        if self.latest is None:
+            return None
+        now = self.clock()
+        since_last_send = now - self.last_send_time
+        if self.pending and since_last_send >= self.min_send_interval:
+            return self._send(self.latest, now)
+        if since_last_send >= self.heartbeat_interval:
+            self.heartbeats += 1
+            return self._send(self.latest, now)
+        return None
+
+    def next_poll_time(self):
+        """ When (by 'clock') poll() will next have something to send, or None if nothing will be until an offer() """
+        if self.latest is None:
+            return None
+        if self.pending:
+            return self.last_send_time + self.min_send_interval
+        return self.last_send_time + self.heartbeat_interval
+
+    def _send(self, demands, now):
+        self.last_sent = demands
+        self.last_send_time = now
+        self.pending = False
+        self.sent += 1
+        return demands
+
+    def _buttons_changed(self, demands):
+        last_sent = self.last_sent
+        for button in DEMAND_BUTTONS:
+            if demands.get(button) != last_sent.get(button):
+                return True
+        return False
+
+    def _axes_changed(self, demands):
+        last_sent = self.last_sent
+        for axis, threshold in zip(DEMAND_AXES, self.axis_thresholds):
+            if abs(demands.get(axis, 0) - last_sent.get(axis, 0)) > threshold:
+                return True
+        return False
+
+    def __str__(self):
+        return (f"offered: {self.offered}, sent: {self.sent} (of which heartbeats: {self.heartbeats}), "
+                f"suppressed: {self.suppressed}")
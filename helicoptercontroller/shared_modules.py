@@ -0,0 +1,11 @@
+"""
+Makes the modules shared with the heli server importable from the controller.
+Things like the wire format live in ../helicopter, so use them from there rather than keeping a second copy in step.
+"""
+import os
+import sys
+
+helicopter_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helicopter'))
+if helicopter_dir not in sys.path:
+    # Append rather than insert, so the controller's own modules always take priority
+    sys.path.append(helicopter_dir)
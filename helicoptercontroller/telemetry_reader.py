@@ -0,0 +1,137 @@
+""" Reads the telemetry stream coming back from the helicopter server """
+import math
+import time
+from threading import Thread
+import shared_modules
+from heli_protocol import TelemetryFrameCodec, TelemetryFrameError
+from flight_log import FlightLog
+
+class TelemetryReader:
+    """
+    Reads telemetry frames off the server connection on its own thread (or whenever read_available() is called, e.g.
+    by an event loop once the connection's readable), and keeps hold of the latest one.
+    Nothing else has to wait for it - the controller just looks at 'latest' (or sets 'display' to have the
+    telemetry logged) whenever it wants. Works out the link round trip time from the demand each frame echoes back.
+    """
+
+    # How much of each new round trip time goes into the smoothed figure
+    _rtt_smoothing = 0.1
+
+    def __init__(self, sock, display_rate_hz:float=2, receive_size:int=4096, thread:bool=True):
+        """ With 'thread' False, nothing reads from 'sock' until read_available() is called """
+        self.socket = sock
+        self.codec = TelemetryFrameCodec()
+        self.receive_size = receive_size
+        self.log = FlightLog(name='telemetry', rate_limits_hz={'telemetry': display_rate_hz}).start()
+        # Latest telemetry, as decoded by TelemetryFrameCodec (plus the round trip time), or None before the first frame
+        self.latest = None
+        # Set to have each frame logged (rate limited to display_rate_hz)
+        self.display = False
+        # Counters
+        self.frames = 0
+        self.bad_frames = 0
+        self.bytes_received = 0
+        self.last_received = None
+        # Round trip times (s)
+        self.rtt = None
+        self.smoothed_rtt = None
+        self.min_rtt = math.inf
+        self.max_rtt = 0.0
+        self._last_echoed_sequence = None
+        # Whether this controller had control (and whether it'd been offered it), as of the last frame
+        self.in_control = None
+        self.control_offered = False
+        # Anything left over after the last complete frame
+        self._buffer = bytearray()
+        self.running = True
+        self.thread = None
+        if thread:
+            self.thread = Thread(target=self.read_frames, daemon=True)
+            self.thread.start()
+
+    def read_frames(self):
+        """ Read and decode frames until the connection closes """
+        while self.running and self.read_available():
+            pass
+        self.log.stop()
+
+    def read_available(self):
+        """
+        Read whatever's arrived and decode every complete frame (waiting for something to arrive first, if nothing has
+        and the socket blocks). Returns False once the connection's closed
+        """
+        try:
+            data = self.socket.recv(self.receive_size)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            self.log.warning('link', "Telemetry stopped: %s", e)
+            self.running = False
+            return False
+        if not data:
+            self.log.warning('link', "Telemetry stopped: connection closed by the Helicopter Server")
+            self.running = False
+            return False
+        received_time = time.time()
+        self.bytes_received += len(data)
+        buffer = self._buffer
+        buffer += data
+        # Decode every complete frame, and keep anything left over for next time
+        codec = self.codec
+        offset = 0
+        while True:
+            length = codec.frame_length(buffer, offset)
+            if length is None or len(buffer) - offset < length:
+                break
+            self._handle_frame(bytes(buffer[offset:offset + length]), received_time)
+            offset += length
+        del buffer[:offset]
+        return True
+
+    def _handle_frame(self, frame, received_time):
+        try:
+            telemetry = self.codec.decode(frame)
+        except TelemetryFrameError as e:
+            self.bad_frames += 1
+            self.log.warning('bad_frame', "Bad telemetry frame: %s", e)
+            return
+        self.frames += 1
+        self.last_received = received_time
+        sent_time = telemetry['demand_sent_time']
+        # Only a newly echoed demand gives a new round trip time - the same one can be echoed by several frames
+        if sent_time == sent_time and telemetry['demand_sequence'] != self._last_echoed_sequence:
+            self._last_echoed_sequence = telemetry['demand_sequence']
+            rtt = received_time - sent_time - telemetry['demand_held']
+            self.rtt = rtt
+            self.smoothed_rtt = rtt if self.smoothed_rtt is None else self.smoothed_rtt + self._rtt_smoothing * (rtt - self.smoothed_rtt)
+            self.min_rtt = min(self.min_rtt, rtt)
+            self.max_rtt = max(self.max_rtt, rtt)
+        telemetry['rtt'] = self.rtt
+        if telemetry['in_control'] != self.in_control:
+            if telemetry['in_control']:
+                self.log.info('control', "This controller has control of the heli")
+            elif self.in_control:
+                self.log.warning('control', "This controller no longer has control of the heli - its demands are being ignored")
+            self.in_control = telemetry['in_control']
+        if telemetry['control_offered'] and not self.control_offered:
+            self.log.info('control', "Control of the heli has been offered to this controller - ask for it to take it")
+        self.control_offered = telemetry['control_offered']
+        self.latest = telemetry
+        if self.display:
+            self.log.info('telemetry', "%s", telemetry)
+
+    @property
+    def age(self):
+        """ Seconds since the last frame arrived (infinite if none have) """
+        return math.inf if self.last_received is None else time.time() - self.last_received
+
+    def stop(self):
+        self.running = False
+        if self.thread is None:
+            # (The thread stops the log itself, once it's finished)
+            self.log.stop()
+
+    def __str__(self):
+        rtt = "n/a" if self.smoothed_rtt is None else (f"{1000 * self.smoothed_rtt:.2f}ms "
+                                                       f"(min {1000 * self.min_rtt:.2f}ms, max {1000 * self.max_rtt:.2f}ms)")
+        return f"frames: {self.frames}, bad frames: {self.bad_frames}, bytes: {self.bytes_received}, round trip time: {rtt}"